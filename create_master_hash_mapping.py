@@ -4,12 +4,17 @@ A script to fetch the hash mapping data for each course session in MORF buckets
 from morf.utils.docker import load_docker_image, make_docker_run_command
 from morf.utils.config import MorfJobConfig
 from morf.utils import fetch_complete_courses, fetch_sessions, fetch_raw_course_data
-from morf.utils.log import set_logger_handlers, execute_and_log_output
+from morf.utils.log import set_logger_handlers
 import logging
 import os
+import subprocess
 import tempfile
-import re
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
+import hash_mapping_store
 
 GENDER_CSV_FP = os.path.join(os.getcwd(), "data/names_for_josh.csv")  # docker doesn't like relative file paths
 GENDER_VALUES_TO_KEEP = ("male", "female")
@@ -19,46 +24,142 @@ MYSQL_DOCKER_IMG_NAME = "mysql-docker.tar"
 OUTPUT_DIR = os.path.join(os.getcwd(), "data/hash-mapping-exports")
 OUTPUT_FILENAME = "coursera_user_hash_gender_lookup.csv"
 GENDER_COL_NAME = "gender"
+HASH_MAPPING_HEADER = ("user_id", "session_user_id")  # columns which every complete session export must contain
+
+MAX_CONCURRENT_CONTAINERS = 4  # number of sessions loaded into mySQL at once
+MAX_PREFETCH_SESSIONS = 2  # number of additional sessions downloaded while containers run
+MANIFEST_FP = os.path.join(OUTPUT_DIR, ".hash_mapping_manifest.json")
 
 module_logger = logging.getLogger(__name__)
 job_config = MorfJobConfig("config.properties")
 logger = set_logger_handlers(module_logger, job_config)
+manifest_lock = threading.Lock()
+container_slots = threading.BoundedSemaphore(MAX_CONCURRENT_CONTAINERS)
+
+
+def read_manifest(manifest_fp=MANIFEST_FP):
+    """
+    Read the per-session status manifest, which records which sessions have been exported.
+    :param manifest_fp: path to manifest json file.
+    :return: dict mapping "course/session" to a dict with status, output file, and time of last update.
+    """
+    if not os.path.exists(manifest_fp):
+        return {}
+    with open(manifest_fp) as f:
+        return json.load(f)
+
+
+def update_manifest(course, session, status, output_fp=None, manifest_fp=MANIFEST_FP):
+    """
+    Record the status of a session in the manifest. The manifest is rewritten atomically so that a crashed sweep leaves it readable.
+    :param status: one of "running", "complete", "failed".
+    :return: None
+    """
+    with manifest_lock:
+        manifest = read_manifest(manifest_fp)
+        manifest["{}/{}".format(course, session)] = {"status": status, "output": output_fp, "updated": time.time()}
+        temp_fp = manifest_fp + ".tmp"
+        with open(temp_fp, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(temp_fp, manifest_fp)
+    return
+
+
+def session_is_complete(manifest, course, session):
+    entry = manifest.get("{}/{}".format(course, session))
+    return entry is not None and entry["status"] == "complete" and export_is_valid(entry["output"])
+
+
+def run_container(cmd):
+    """
+    Run a docker command, logging its output line by line.
+    :return: exit status of the command.
+    """
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    for line in proc.stdout:
+        logger.info(line.rstrip())
+    return proc.wait()
 
-for raw_data_bucket in job_config.raw_data_buckets:
-    for course in fetch_complete_courses(job_config, raw_data_bucket):
-        for session in fetch_sessions(job_config, raw_data_bucket, data_dir=MORF_DATA_DIR, course=course,
-                                      fetch_all_sessions=True):
-            with tempfile.TemporaryDirectory(dir=os.getcwd()) as working_dir:
+
+def export_is_valid(output_fp):
+    """
+    Check that a session export is a non-empty csv whose header contains HASH_MAPPING_HEADER.
+    """
+    if not os.path.exists(output_fp) or os.path.getsize(output_fp) == 0:
+        return False
+    with open(output_fp) as f:
+        header = f.readline().strip().split(",")
+    return all(col in header for col in HASH_MAPPING_HEADER)
+
+
+def export_session_hash_mapping(raw_data_bucket, course, session, image_uuid):
+    """
+    Download the data exports for one session and run the mySQL image on them. Downloads are not limited by
+    container_slots, so the next sessions are fetched while earlier containers are still running. The session is
+    recorded as complete only if the container exits successfully and writes a valid export.
+    :return: None
+    """
+    output_fp = os.path.join(OUTPUT_DIR, "hash_mapping_{}_{}.csv".format(course, session))
+    update_manifest(course, session, "running")
+    res = None
+    if os.path.exists(output_fp):  # output left by an interrupted run; never mistake it for this run's output
+        os.remove(output_fp)
+    try:
+        with tempfile.TemporaryDirectory(dir=os.getcwd()) as working_dir:
+            print("[INFO] fetching course {} session {}".format(course, session))
+            # download the data exports
+            fetch_raw_course_data(job_config, raw_data_bucket, course, session, input_dir=working_dir)
+            cmd = make_docker_run_command(job_config.docker_exec, working_dir, OUTPUT_DIR, image_uuid,
+                                          course=course, session=session, mode=None,
+                                          client_args=None)
+            with container_slots:
                 print("[INFO] processing course {} session {}".format(course, session))
-                # download the data exports
-                fetch_raw_course_data(job_config, raw_data_bucket, course, session, input_dir=working_dir)
-                # download_raw_course_data(job_config, raw_data_bucket, course=course, session=session, input_dir=working_dir,
-                #                          data_dir=MORF_DATA_DIR[:-1]) # drop trailing slash on data dir
-                # create docker run command and load image
-                image_uuid = load_docker_image(MYSQL_DOCKER_DIR, job_config, logger, image_name=MYSQL_DOCKER_IMG_NAME)
-                cmd = make_docker_run_command(job_config.docker_exec, working_dir, OUTPUT_DIR, image_uuid,
-                                              course=course, session=session, mode=None,
-                                              client_args=None)
                 # run the docker image, make sure to pass params for course and session
-                execute_and_log_output(cmd, logger)
-
-# concatenate into single file in OUTPUT_DIR
-df_list = []
-for f in os.listdir(OUTPUT_DIR):
-    if f.endswith(".csv") and not f.startswith("."):  # only use csv files, ignore system files
-        print("[INFO] reading file {}".format(f))
-        # pull course name and session from filename
-        regex = re.compile("^hash_mapping_(\S+)_([0-9\-]+).*")
-        res = re.search(regex, f)
-        course = res.group(1)
-        session = res.group(2)
-        # read dataframe and add columns for course and session
-        df = pd.read_csv(os.path.join(OUTPUT_DIR, f))
-        df["course"] = course
-        df["session"] = session
-        df_list.append(df)
-hash_mapping_df = pd.concat(df_list)
-print("[INFO] concatenated hash mapping table contains {} rows".format(hash_mapping_df.shape[0]))
+                res = run_container(cmd)
+            if res != 0:
+                print("[ERROR] container for course {} session {} exited with {}".format(course, session, res))
+    except Exception as e:
+        print("[ERROR] exception processing course {} session {}: {}".format(course, session, e))
+    status = "complete" if res == 0 and export_is_valid(output_fp) else "failed"
+    update_manifest(course, session, status, output_fp)
+    return
+
+
+def export_all_hash_mappings():
+    """
+    Run export_session_hash_mapping() for every session in the MORF raw data buckets on a bounded worker pool, loading the mySQL image only once.
+    Sessions recorded as complete in the manifest are skipped, so a crashed sweep can be resumed by running it again.
+    :return: None
+    """
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+    manifest = read_manifest()
+    image_uuid = load_docker_image(MYSQL_DOCKER_DIR, job_config, logger, image_name=MYSQL_DOCKER_IMG_NAME)
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CONTAINERS + MAX_PREFETCH_SESSIONS) as executor:
+        futures = []
+        for raw_data_bucket in job_config.raw_data_buckets:
+            for course in fetch_complete_courses(job_config, raw_data_bucket):
+                for session in fetch_sessions(job_config, raw_data_bucket, data_dir=MORF_DATA_DIR, course=course,
+                                              fetch_all_sessions=True):
+                    if session_is_complete(manifest, course, session):
+                        print("[INFO] skipping completed course {} session {}".format(course, session))
+                        continue
+                    futures.append(executor.submit(export_session_hash_mapping, raw_data_bucket, course, session, image_uuid))
+        for future in as_completed(futures):
+            future.result()
+    failed = [k for k, v in read_manifest().items() if v["status"] != "complete"]
+    if failed:
+        print("[WARNING] {} sessions did not complete; rerun to retry: {}".format(len(failed), ", ".join(sorted(failed))))
+    return
+
+
+export_all_hash_mappings()
+
+# add new or changed session exports to the indexed hash mapping store in OUTPUT_DIR
+store = hash_mapping_store.connect(os.path.join(OUTPUT_DIR, hash_mapping_store.STORE_FILENAME))
+appended = hash_mapping_store.sync_session_files(store, OUTPUT_DIR)
+n_rows = store.execute("SELECT COUNT(*) FROM hash_mapping").fetchone()[0]
+print("[INFO] added {} sessions; hash mapping store contains {} rows".format(len(appended), n_rows))
 
 # read in gender
 gender_df = pd.read_csv(GENDER_CSV_FP).drop_duplicates()
@@ -67,7 +168,8 @@ gender_df = gender_df.loc[gender_df[GENDER_COL_NAME].isin(GENDER_VALUES_TO_KEEP)
 print("[INFO] after dropping low-confidence gender guesses gender_df contains {} rows".format(gender_df.shape[0]))
 
 # merge results and write to OUTPUT_DIR
-df_out = pd.merge(hash_mapping_df, gender_df, left_on="user_id", right_on="coursera_user_id", how="inner")
+hash_mapping_store.replace_gender_table(store, gender_df)
+df_out = hash_mapping_store.gender_lookup(store)
 print("[INFO] gender balance in final output dataset:")
 print(df_out[GENDER_COL_NAME].value_counts())
 df_out.to_csv(os.path.join(OUTPUT_DIR, OUTPUT_FILENAME))
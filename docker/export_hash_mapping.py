@@ -5,15 +5,28 @@ A script to load the hash happing tables from coursera spark data exports and ex
 from morf_slice_utils import *
 import argparse
 import os
+import sys
+
+
+SNAPSHOT_DIRNAME = ".db_snapshots"  # kept inside output_dir, which persists across runs
 
 
 def main(course, session, output_dir="/output"):
+    """
+    Export the hash mapping for course and session.
+    :return: True if the export succeeded; otherwise the partial output file is removed and False is returned.
+    """
     outfilename = "hash_mapping_{}_{}.csv".format(course, session)
-    unzip_sql_dumps(course, session)
-    load_data(course, session)
-    execute_mysql_query_into_csv("SELECT * FROM hash_mapping", os.path.join(output_dir, outfilename))
+    output_fp = os.path.join(output_dir, outfilename)
+    loaded = load_data(course, session, snapshot_dir=os.path.join(output_dir, SNAPSHOT_DIRNAME))
+    res = execute_mysql_query_into_csv("SELECT * FROM hash_mapping", output_fp) if loaded else None
     print("[INFO] files in output_dir: ".format(os.listdir(output_dir)))
-    return
+    if not loaded or res != 0:
+        print("[ERROR] exporting hash mapping for course {} session {} failed".format(course, session))
+        if os.path.exists(output_fp):
+            os.remove(output_fp)
+        return False
+    return True
 
 
 if __name__ == "__main__":
@@ -22,5 +35,6 @@ if __name__ == "__main__":
     parser.add_argument("-r", "--session", required=True, help="3-digit course run number")
     parser.add_argument("--mode", required=False, help="mode; not used but automatically passed to docker by most MORF API functions")
     args = parser.parse_args()
-    main(args.course, args.session)
+    if not main(args.course, args.session):
+        sys.exit(1)
 
@@ -10,11 +10,15 @@ import tarfile
 import shutil
 import gzip
 import re
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 
 
 
 DATABASE_NAME = "course"
+MYSQL_DATA_DIR = "/var/lib/mysql"
 
 
 def extract_id_lookup_table(outfile = "id_lookup.csv"):
@@ -79,30 +83,166 @@ def execute_mysql_query_into_csv(query, file, database_name=DATABASE_NAME):
     Execute a mysql query into a file.
     :param query: valid mySQL query as string.
     :param file: csv filename to write to.
-    :return: none
+    :return: exit status of the query (nonzero if mysql or the conversion to csv failed).
     """
     mysql_to_csv_cmd = """ | tr '\t' ',' """  # string to properly format result of mysql query
     command = '''mysql -u root -proot {} -e"{}"'''.format(database_name, query)
     command += """{} > {}""".format(mysql_to_csv_cmd, file)
     print("[INFO] executing {}".format(command))
-    subprocess.call(command, shell=True)
-    return
+    # pipefail, so that a failed mysql query is not masked by the exit status of tr
+    res = subprocess.call(["bash", "-o", "pipefail", "-c", command])
+    if res != 0:
+        print("[ERROR] query exited with {}".format(res))
+    return res
 
 
 def load_dump(dump_file, dbname = DATABASE_NAME):
+    """
+    Load a .sql or .sql.gz dump into dbname; compressed dumps are streamed through gunzip into mysql rather than decompressed to disk.
+    :param dump_file: path to dump file.
+    :param dbname: database to load into.
+    :return: exit status of mysql, or of gunzip if decompression failed.
+    """
     print("[INFO] loading dump from {}".format(dump_file))
-    command = '''mysql -u root -proot {} < {}'''.format(dbname, dump_file)
-    res = subprocess.call(command, shell=True)
+    mysql_cmd = ["mysql", "-u", "root", "-proot", dbname]
+    with open(dump_file, "rb") as f:
+        if dump_file.endswith(".gz"):
+            gunzip = subprocess.Popen(["gunzip", "-c"], stdin=f, stdout=subprocess.PIPE)
+            mysql = subprocess.Popen(mysql_cmd, stdin=gunzip.stdout)
+            gunzip.stdout.close()  # lets gunzip receive SIGPIPE if mysql exits early
+            res = mysql.wait()
+            gunzip_res = gunzip.wait()
+            res = res or gunzip_res
+        else:
+            res = subprocess.call(mysql_cmd, stdin=f)
     print("[INFO] result: {}".format(res))
+    return res
+
+
+SNAPSHOT_FILE_REGEX = re.compile(r"^(.+)_([^_]+)_([0-9a-f]{64})\.tar$")  # <course>_<session>_<dump checksum>.tar
+
+
+def dump_checksum(dump_files, block_size = 2**20):
+    """
+    Content hash of a set of dump files plus the mySQL server version; used to key database snapshots, so that snapshots are never restored into an incompatible server.
+    :param dump_files: list of paths to dump files.
+    :param block_size: number of bytes to read at a time.
+    :return: hex digest (string).
+    """
+    digests = []
+    for dump_file in dump_files:
+        digest = hashlib.sha256()
+        with open(dump_file, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                digest.update(block)
+        digests.append(digest.hexdigest())
+    checksum = hashlib.sha256(subprocess.check_output("mysqld --version", shell=True))
+    for digest in sorted(digests):
+        checksum.update(digest.encode("utf-8"))
+    return checksum.hexdigest()
+
+
+def snapshot_path(snapshot_dir, course, session, checksum):
+    return os.path.join(snapshot_dir, "{}_{}_{}.tar".format(course, session, checksum))
+
+
+def _empty_dir(dir):
+    """
+    Remove the contents of dir, but not dir itself.
+    """
+    for item in os.listdir(dir):
+        fp = os.path.join(dir, item)
+        if os.path.isdir(fp) and not os.path.islink(fp):
+            shutil.rmtree(fp)
+        else:
+            os.remove(fp)
     return
 
 
-def load_data(course, session, dbname = DATABASE_NAME, data_dir = "/input"):
+def save_snapshot(course, session, checksum, snapshot_dir, mysql_data_dir = MYSQL_DATA_DIR):
+    """
+    Stop mySQL, archive its data directory to snapshot_dir, and restart it. Older snapshots of the same course and session are then removed (see prune_snapshots()).
+    :param checksum: snapshot key from dump_checksum().
+    :param snapshot_dir: directory to write snapshot into.
+    :return: path of the snapshot, or None if it could not be written.
+    """
+    snapshot_fp = snapshot_path(snapshot_dir, course, session, checksum)
+    # write to a temporary file first so that concurrent or interrupted runs never see a partial snapshot
+    fd, temp_fp = tempfile.mkstemp(dir=snapshot_dir, suffix=".tmp")
+    os.close(fd)
+    print("[INFO] saving database snapshot to {}".format(snapshot_fp))
+    subprocess.call('service mysql stop', shell=True)
+    res = subprocess.call('tar -cf {} -C {} .'.format(temp_fp, mysql_data_dir), shell=True)
+    subprocess.call('service mysql start', shell=True)
+    if res != 0:
+        print("[ERROR] saving database snapshot failed with result {}".format(res))
+        os.remove(temp_fp)
+        return None
+    os.replace(temp_fp, snapshot_fp)
+    prune_snapshots(snapshot_dir, course, session, keep=snapshot_fp)
+    return snapshot_fp
+
+
+def restore_snapshot(course, session, checksum, snapshot_dir, mysql_data_dir = MYSQL_DATA_DIR):
+    """
+    Restore the mySQL data directory from the snapshot of course and session keyed by checksum, if it exists, and (re)start mySQL.
+    The snapshot is extracted into an emptied data directory; if extraction fails, the previous contents are put back, so that the dumps can be loaded into a clean server instead.
+    :param checksum: snapshot key from dump_checksum().
+    :param snapshot_dir: directory to read snapshot from.
+    :return: True if the snapshot existed and was restored, otherwise False.
+    """
+    snapshot_fp = snapshot_path(snapshot_dir, course, session, checksum)
+    if not os.path.exists(snapshot_fp):
+        return False
+    print("[INFO] restoring database snapshot from {}".format(snapshot_fp))
+    subprocess.call('service mysql stop', shell=True)
+    backup_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(mysql_data_dir)))
+    for item in os.listdir(mysql_data_dir):
+        os.rename(os.path.join(mysql_data_dir, item), os.path.join(backup_dir, item))
+    res = subprocess.call('tar -xpf {} -C {} && chown -R mysql:mysql {}'.format(snapshot_fp, mysql_data_dir, mysql_data_dir), shell=True)
+    if res != 0:
+        print("[ERROR] restoring database snapshot failed with result {}; restoring previous data directory".format(res))
+        _empty_dir(mysql_data_dir)
+        for item in os.listdir(backup_dir):
+            os.rename(os.path.join(backup_dir, item), os.path.join(mysql_data_dir, item))
+    shutil.rmtree(backup_dir)
+    subprocess.call('service mysql start', shell=True)
+    return res == 0
+
+
+def prune_snapshots(snapshot_dir, course = None, session = None, keep = None):
+    """
+    Keep only the latest snapshot of each course and session in snapshot_dir (or only of course and session, if given), and remove any temporary files left by interrupted snapshots.
+    :param keep: optional path of a snapshot to keep, even if it is not the most recently modified of its course and session.
+    :return: list of paths removed.
+    """
+    snapshots = {}
+    removed = []
+    for f in os.listdir(snapshot_dir):
+        fp = os.path.join(snapshot_dir, f)
+        res = SNAPSHOT_FILE_REGEX.match(f)
+        if res is None:
+            if f.endswith(".tmp") and course is None:
+                removed.append(fp)
+            continue
+        if (course is None or res.group(1) == course) and (session is None or res.group(2) == session):
+            snapshots.setdefault((res.group(1), res.group(2)), []).append(fp)
+    for fps in snapshots.values():
+        latest = keep if keep in fps else max(fps, key=os.path.getmtime)
+        removed.extend(fp for fp in fps if fp != latest)
+    for fp in removed:
+        print("[INFO] removing database snapshot {}".format(fp))
+        os.remove(fp)
+    return removed
+
+
+def load_data(course, session, dbname = DATABASE_NAME, data_dir = "/input", snapshot_dir = None):
     """
     Loads data into mySQL database from database dump files.
     :param course: shortname of course.
     :param session: 3-digit session id (string).
-    :return:
+    :param snapshot_dir: optional directory of database snapshots; if given, a snapshot matching the dumps is restored instead of loading them, and a new snapshot is written after the database is created and every dump loads successfully.
+    :return: True if the database was restored from a snapshot, or created and every dump loaded successfully; otherwise False.
     """
     password = 'root'
     user = 'root'
@@ -112,22 +252,35 @@ def load_data(course, session, dbname = DATABASE_NAME, data_dir = "/input"):
     hash_mapping_sql_dump = [x for x in os.listdir(session_input_dir) if 'hash_mapping' in x and session in x][0]
     forum_sql_dump = [x for x in os.listdir(session_input_dir) if 'anonymized_forum' in x and session in x][0]
     anon_general_sql_dump = [x for x in os.listdir(session_input_dir) if 'anonymized_general' in x and session in x][0]
+    dump_files = [os.path.join(session_input_dir, x) for x in (forum_sql_dump, hash_mapping_sql_dump, anon_general_sql_dump)]
     # start mysql server
     subprocess.call('service mysql start', shell=True)
+    if snapshot_dir:
+        if not os.path.exists(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        checksum = dump_checksum(dump_files)
+        if restore_snapshot(course, session, checksum, snapshot_dir):
+            return True
     # create a database
     print("[INFO] creating database")
     res = subprocess.call('''mysql -u root -proot -e "CREATE DATABASE {}"'''.format(dbname), shell=True)
     print("RES: {}".format(res))
     # load all data dumps needed
-    load_dump(os.path.join(session_input_dir, forum_sql_dump))
-    load_dump(os.path.join(session_input_dir, hash_mapping_sql_dump))
-    load_dump(os.path.join(session_input_dir, anon_general_sql_dump))
-    return
+    # dumps contain independent tables, so decompress and load them concurrently
+    with ThreadPoolExecutor(max_workers=len(dump_files)) as executor:
+        load_results = list(executor.map(load_dump, dump_files))
+    loaded = res == 0 and all(x == 0 for x in load_results)
+    if snapshot_dir:
+        if loaded:
+            save_snapshot(course, session, checksum, snapshot_dir)
+        else:
+            print("[WARNING] not saving database snapshot; database creation or a dump load failed")
+    return loaded
 
 
 def unzip_sql_dumps(course, session, data_dir = "/input"):
     """
-    unzip all of the sql files and remove any parens from filename.
+    unzip all of the sql files and remove any parens from filename. Not needed before load_data(), which streams compressed dumps directly.
     :param course:
     :param session:
     :param data_dir:
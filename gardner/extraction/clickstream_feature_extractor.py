@@ -47,6 +47,7 @@ Usage: python3 xing_feature_extractor.py \
 import gzip, argparse, json, re, math, datetime, os, bisect, csv, itertools
 import pandas as pd
 from collections import defaultdict, Counter
+from extraction.extraction_utils import write_table
 
 MILLISECONDS_IN_SECOND = 1000
 
@@ -424,16 +425,13 @@ def generate_appended_xing_csv(df_in, dropout_weeks, week):
     return df_app
 
 
-def generate_weekly_csv(df_in, dropout_weeks, out_dir, target_week = 2, appended = True, week_only = False, sum = False):
+def generate_weekly_dfs(df_in, dropout_weeks, target_week = 2, appended = True, week_only = False, sum = False):
     """
-    Create a series of csv files containing all entries for each week in df_in
-    # todo: udpate docstring
+    Create the weekly feature sets for target_week from df_in.
     :param df_in: pandas.DataFrame of weekly features to write output for
     :param dropout_weeks: pandas.DataFrame of dropout week number by userID
-    :return: Nothing returned; writes csv files to /xing_extractor_output
+    :return: dict mapping output filename to pandas.DataFrame (indexed by userID) for each requested feature set.
     """
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
     # startwk, endwk = min(df_in['week']), max(df_in['week']) + 1
     # for i in range(startwk, endwk):
     i = target_week
@@ -448,15 +446,28 @@ def generate_weekly_csv(df_in, dropout_weeks, out_dir, target_week = 2, appended
         .sum()\
         .drop(['dropout_week', 'week'], axis=1)
     wk_appended_df = generate_appended_xing_csv(df_in, dropout_weeks, i)
+    output = {}
     if week_only:
-        wk_only_destfile = os.path.join(out_dir, "week_%s_clickstream_only_feats.csv" % i)
-        wk_only_df.to_csv(wk_only_destfile)
+        output["week_%s_clickstream_only_feats.csv" % i] = wk_only_df
     if sum:
-        wk_sum_destfile = os.path.join(out_dir, "week_%s_clickstream_sum_feats.csv" % i)
-        wk_sum_df.to_csv(wk_sum_destfile)
+        output["week_%s_clickstream_sum_feats.csv" % i] = wk_sum_df
     if appended:
-        wk_app_destfile = os.path.join(out_dir, "week_%s_clickstream_appended_feats.csv" % i)
-        wk_appended_df.to_csv(wk_app_destfile)
+        output["week_%s_clickstream_appended_feats.csv" % i] = wk_appended_df
+    return output
+
+
+def generate_weekly_csv(df_in, dropout_weeks, out_dir, target_week = 2, appended = True, week_only = False, sum = False, output_format = "csv"):
+    """
+    Create a series of csv files containing all entries for each week in df_in
+    :param df_in: pandas.DataFrame of weekly features to write output for
+    :param dropout_weeks: pandas.DataFrame of dropout week number by userID
+    :param output_format: file format; one of extraction_utils.OUTPUT_FORMATS
+    :return: Nothing returned; writes files from generate_weekly_dfs() to out_dir
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    for filename, df in generate_weekly_dfs(df_in, dropout_weeks, target_week, appended, week_only, sum).items():
+        write_table(df, os.path.join(out_dir, filename), output_format)
     return
 
 
@@ -480,7 +491,14 @@ def extract_features(coursera_clickstream_file, users, course_start, course_end)
     return features_df
 
 
-def main(course_name, run_number):
+def main(course_name, run_number, in_memory = False, output_format = "csv", feature_store_dir = None):
+    """
+    Extract clickstream features for course_name and run_number, writing weekly feature CSVs and user_dropout_weeks.csv to /output.
+    :param in_memory: if True, nothing is written; the feature sets and dropout weeks are returned instead.
+    :param output_format: format of files written; one of extraction_utils.OUTPUT_FORMATS
+    :param feature_store_dir: if given, user-week features are also written to this feature store (see extraction.feature_store)
+    :return: None, or if in_memory is True, a tuple of (list of feature pandas.DataFrames with a userID column, pandas.DataFrame of userID and dropout_week).
+    """
     session_dir = '/input/{0}/{1}/'.format(course_name, run_number)
     clickstream_file = [x for x in os.listdir(session_dir) if x.endswith('clickstream_export.gz')][0]
     clickstream_fp = os.path.join(session_dir, clickstream_file)
@@ -491,10 +509,16 @@ def main(course_name, run_number):
     users, dropout_weeks = extract_users_dropouts(clickstream_fp, course_start, course_end)
     print("Complete. Extracting features...")
     feats_df = extract_features(clickstream_fp, users, course_start, course_end)
+    if feature_store_dir:
+        from extraction.feature_store import write_partition
+        write_partition(feats_df, feature_store_dir, course_name, run_number, "clickstream")
+    if in_memory:
+        feature_dfs = [df.reset_index() for df in generate_weekly_dfs(feats_df, dropout_weeks).values()]
+        return feature_dfs, dropout_weeks.reset_index()
     # write output
-    generate_weekly_csv(feats_df, dropout_weeks, out_dir=OUTPUT_DIRECTORY)
+    generate_weekly_csv(feats_df, dropout_weeks, out_dir=OUTPUT_DIRECTORY, output_format=output_format)
     dropout_file_path = "%s/user_dropout_weeks.csv" % (OUTPUT_DIRECTORY)
-    dropout_weeks.to_csv(dropout_file_path)
+    write_table(dropout_weeks, dropout_file_path, output_format)
     print("Output written to {}".format(OUTPUT_DIRECTORY))
 
 
@@ -2,21 +2,133 @@
 Utility script to extract clickstream, forum, and assignment features
 """
 
-from extraction.sql_utils import initialize_sql_db, load_sql_dumps, extract_forum_text_csv_from_sql, extract_quiz_csv_from_sql
+from extraction.sql_utils import initialize_and_load_sql_db, extract_forum_text_csv_from_sql, extract_quiz_csv_from_sql, extract_forum_aggregates_csv_from_sql, extract_quiz_aggregates_csv_from_sql
+from extraction.extraction_utils import fetch_start_end_date
 import argparse
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from extraction.forum_feature_extractor import main as extract_forum_feats
 from extraction.quiz_feature_extractor import main as extract_quiz_feats
 from extraction.clickstream_feature_extractor import main as extract_clickstream_feats
 
+FEATURE_STORE_DIR = "/feature_store"  # optional volume; user-week features are written to a feature store here if it exists
 
-def main(course_id, run_number):
-    extract_clickstream_feats(course_id, run_number)
-    initialize_sql_db()
-    load_sql_dumps(course_id, run_number)
-    extract_forum_text_csv_from_sql(course = course_id, session = run_number, outdir='/output')
-    extract_quiz_csv_from_sql(course_id, run_number, outdir='/output')
-    extract_forum_feats(course_id, run_number)
-    extract_quiz_feats(course_id, run_number)
+
+# a stage runs once every artifact in inputs has been produced; func is called with the course, session and options
+# plus the value of each input artifact as keyword arguments, and returns a dict with a value for each of its outputs
+# (None for artifacts which are only written to /output or loaded into mySQL).
+ExtractionStage = namedtuple("ExtractionStage", ["name", "func", "inputs", "outputs"])
+
+
+def course_dates(course_id, run_number):
+    date_csv = os.path.join('/input', course_id, run_number, 'coursera_course_dates.csv')
+    return fetch_start_end_date(course_id, run_number, date_csv)
+
+
+def clickstream_stage(course_id, run_number, in_memory=False, output_format="csv", feature_store_dir=None, **kwargs):
+    if in_memory:
+        feature_dfs, dropout_df = extract_clickstream_feats(course_id, run_number, in_memory=True, feature_store_dir=feature_store_dir)
+        return {"clickstream_feats": feature_dfs, "dropout_weeks": dropout_df}
+    extract_clickstream_feats(course_id, run_number, output_format=output_format, feature_store_dir=feature_store_dir)
+    return {"clickstream_feats": [], "dropout_weeks": None}
+
+
+def sql_load_stage(course_id, run_number, **kwargs):
+    initialize_and_load_sql_db(course_id, run_number)
+    return {"database": None}
+
+
+def forum_export_stage(course_id, run_number, sql_aggregates=False, **kwargs):
+    if sql_aggregates:
+        course_start, course_end = course_dates(course_id, run_number)
+        extract_forum_aggregates_csv_from_sql(course_id, run_number, course_start, course_end, outdir='/output')
+    else:
+        extract_forum_text_csv_from_sql(course = course_id, session = run_number, outdir='/output')
+    return {"forum_export": None}
+
+
+def quiz_export_stage(course_id, run_number, sql_aggregates=False, **kwargs):
+    if sql_aggregates:
+        course_start, course_end = course_dates(course_id, run_number)
+        extract_quiz_aggregates_csv_from_sql(course_id, run_number, course_start, course_end, outdir='/output')
+    else:
+        extract_quiz_csv_from_sql(course_id, run_number, outdir='/output')
+    return {"quiz_export": None}
+
+
+def forum_feats_stage(course_id, run_number, sql_aggregates=False, in_memory=False, output_format="csv", feature_store_dir=None, dropout_weeks=None, **kwargs):
+    forum_dfs = extract_forum_feats(course_id, run_number, sql_aggregates=sql_aggregates, dropout_df=dropout_weeks, in_memory=in_memory,
+                                    output_format=output_format, feature_store_dir=feature_store_dir)
+    return {"forum_feats": forum_dfs or []}
+
+
+def quiz_feats_stage(course_id, run_number, sql_aggregates=False, in_memory=False, output_format="csv", feature_store_dir=None, dropout_weeks=None, **kwargs):
+    quiz_dfs = extract_quiz_feats(course_id, run_number, sql_aggregates=sql_aggregates, dropout_df=dropout_weeks, in_memory=in_memory,
+                                  output_format=output_format, feature_store_dir=feature_store_dir)
+    return {"quiz_feats": quiz_dfs or []}
+
+
+EXTRACTION_STAGES = [
+    ExtractionStage("clickstream", clickstream_stage, inputs=(), outputs=("clickstream_feats", "dropout_weeks")),
+    ExtractionStage("sql_load", sql_load_stage, inputs=(), outputs=("database",)),
+    ExtractionStage("forum_export", forum_export_stage, inputs=("database",), outputs=("forum_export",)),
+    ExtractionStage("quiz_export", quiz_export_stage, inputs=("database",), outputs=("quiz_export",)),
+    ExtractionStage("forum_feats", forum_feats_stage, inputs=("dropout_weeks", "forum_export"), outputs=("forum_feats",)),
+    ExtractionStage("quiz_feats", quiz_feats_stage, inputs=("dropout_weeks", "quiz_export"), outputs=("quiz_feats",)),
+]
+
+
+def run_stages(stages, max_workers=None, **kwargs):
+    """
+    Run stages on a pool of worker processes, starting each stage as soon as all of its inputs are available, so that independent stages (i.e., clickstream extraction and mySQL loading) overlap.
+    :param stages: list of ExtractionStage.
+    :param max_workers: maximum number of concurrent stages; defaults to the number of CPUs.
+    :param kwargs: keyword arguments passed to every stage.
+    :return: dict of every artifact produced by stages.
+    """
+    artifacts = {}
+    pending = list(stages)
+    running = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for stage in [x for x in pending if all(i in artifacts for i in x.inputs)]:
+                pending.remove(stage)
+                stage_kwargs = dict(kwargs)
+                stage_kwargs.update({i: artifacts[i] for i in stage.inputs})
+                print("[INFO] starting extraction stage {}".format(stage.name))
+                running[executor.submit(stage.func, **stage_kwargs)] = stage
+            if not running:
+                raise ValueError("inputs for extraction stages {} are never produced".format([x.name for x in pending]))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                result = future.result()  # re-raises any exception from the stage
+                missing = [o for o in stage.outputs if o not in result]
+                if missing:
+                    raise ValueError("extraction stage {} did not produce {}".format(stage.name, missing))
+                print("[INFO] completed extraction stage {}".format(stage.name))
+                artifacts.update(result)
+    return artifacts
+
+
+def main(course_id, run_number, sql_aggregates=False, in_memory=False, max_workers=None, output_format="csv", feature_store_dir=FEATURE_STORE_DIR):
+    """
+    Extract all features for course_id and run_number into /output. Stages in EXTRACTION_STAGES are run concurrently where their inputs allow.
+    :param sql_aggregates: if True, count and sum features for quizzes and forums are computed by mySQL and only user-week aggregates (plus forum text) are exported.
+    :param in_memory: if True, feature sets and dropout weeks are passed between extractors in memory and returned instead of written to /output; only the mySQL exports are written.
+    :param max_workers: maximum number of stages to run at once.
+    :param output_format: format of feature and dropout files written to /output; one of extraction_utils.OUTPUT_FORMATS.
+    :param feature_store_dir: if this directory exists, user-week features are also written to a feature store in it (see extraction.feature_store).
+    :return: None, or if in_memory is True, list of feature pd.DataFrames for extraction_utils.aggregate_feature_dfs().
+    """
+    if not os.path.isdir(feature_store_dir):
+        feature_store_dir = None
+    artifacts = run_stages(EXTRACTION_STAGES, max_workers=max_workers, course_id=course_id, run_number=run_number,
+                           sql_aggregates=sql_aggregates, in_memory=in_memory, output_format=output_format,
+                           feature_store_dir=feature_store_dir)
+    if in_memory:
+        return artifacts["clickstream_feats"] + artifacts["forum_feats"] + artifacts["quiz_feats"]
     return
 
 
@@ -25,6 +137,18 @@ if __name__ == "__main__":
     parser.add_argument('-c', '--course_id', required=True, help='an s3 pointer to a course', default=None)
     parser.add_argument('-r', '--run_number', required=False, help='3-digit course run number', default=None)
     parser.add_argument('--mode', required=False, help='mode')
+    parser.add_argument('--sql_aggregates', action='store_true', help='compute quiz and forum count/sum aggregates in mySQL')
+    parser.add_argument('--in_memory', action='store_true', help='pass features between extractors in memory and write only the merged feature file')
+    parser.add_argument('--output_format', default='csv', choices=['csv', 'parquet', 'feather'], help='format of feature files')
+    parser.add_argument('--feature_matrix', action='store_true', help='also write the merged features as a memory-mappable float32 matrix')
     args = parser.parse_args()
-    main(args.course_id, args.run_number)
+    if args.in_memory:
+        from extraction.extraction_utils import aggregate_feature_dfs
+        aggregate_feature_dfs(main(args.course_id, args.run_number, sql_aggregates=args.sql_aggregates, in_memory=True), output_format=args.output_format,
+                              write_matrix=args.feature_matrix)
+    else:
+        main(args.course_id, args.run_number, sql_aggregates=args.sql_aggregates, output_format=args.output_format)
+        if args.feature_matrix:
+            from extraction.extraction_utils import write_feature_matrix_from_files
+            write_feature_matrix_from_files("/output", "/output", match_substring="feats")
 
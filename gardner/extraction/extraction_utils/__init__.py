@@ -1,8 +1,13 @@
 import argparse, math, datetime, os, bisect
 import pandas as pd
-from functools import reduce
+import numpy as np
 
 MILLISECONDS_IN_SECOND = 1000
+OUTPUT_FORMATS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"} # file extension for each supported output format
+# suffixes of the dense feature matrix and its row (user id) and column (feature name) index files; see write_feature_matrix()
+FEATURE_MATRIX_SUFFIX = "_matrix.npy"
+FEATURE_MATRIX_ROWS_SUFFIX = "_rows.txt"
+FEATURE_MATRIX_COLUMNS_SUFFIX = "_columns.txt"
 
 def fetch_start_end_date(course_name, run, date_csv = "coursera_course_dates.csv"):
     """
@@ -50,41 +55,131 @@ def timestamp_week(timestamp, course_start, course_end):
     return None
 
 
-def aggregate_and_remove_feature_files(input_dir, output_dir="/output", result_filename = "feats.csv", match_substring=None, drop_cols = ["dropout_current_week", "week"]):
+def table_path(fp, output_format = "csv"):
     """
-    Read in all feature files in input_dir, merge them, and write the results to output_dir, removing the files after merging.
-    :param input_dir: directory containing feature files to be merged
-    :param output_dir: directory to write results in
-    :param result_filename: name of file to write in output_dir
-    :param match_substring: optional, only match files containg this substring
-    :return:
+    Replace the extension of fp with the extension for output_format.
+    :param fp: file path, i.e. /output/feats.csv
+    :param output_format: one of OUTPUT_FORMATS.
+    :return: file path.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("unknown output format {}; expected one of {}".format(output_format, sorted(OUTPUT_FORMATS)))
+    return os.path.splitext(fp)[0] + OUTPUT_FORMATS[output_format]
+
+
+def write_table(df, fp, output_format = "csv", index = True):
+    """
+    Write df to fp in output_format; the extension of fp is replaced to match output_format. Parquet (snappy-compressed) and Arrow IPC/feather (lz4-compressed) output keeps column types and requires pyarrow.
+    For parquet and feather the index is written as a regular column, so that files in every format have the same columns.
+    :param df: pd.DataFrame to write.
+    :param fp: file path.
+    :param output_format: one of OUTPUT_FORMATS.
+    :param index: whether to write the index of df.
+    :return: path of file written.
+    """
+    fp = table_path(fp, output_format)
+    if output_format == "csv":
+        df.to_csv(fp, index=index)
+        return fp
+    df = df.reset_index(drop=not index)
+    if output_format == "parquet":
+        df.to_parquet(fp, compression="snappy")
+    else:
+        df.to_feather(fp)
+    return fp
+
+
+def read_table(fp, **kwargs):
+    """
+    Read a file written by write_table(), using its extension to determine the format.
+    :param kwargs: additional arguments passed to pd.read_csv() for csv files.
+    :return: pd.DataFrame
+    """
+    ext = os.path.splitext(fp)[1]
+    if ext == OUTPUT_FORMATS["parquet"]:
+        return pd.read_parquet(fp)
+    if ext == OUTPUT_FORMATS["feather"]:
+        return pd.read_feather(fp)
+    return pd.read_csv(fp, **kwargs)
+
+
+USER_ID_COLNAME = "userID" # key column used for joining
+SESSION_USER_ID_COLNAME = "session_user_id" # another name for userid which will be renamed to USER_ID_COLNAME
+
+
+def read_feature_file(fp):
+    """
+    Read a feature file with a declared schema: the user id column is read as a string, and every other column must be numeric.
+    :param fp: path to feature file, in any of OUTPUT_FORMATS.
+    :return: pd.DataFrame of features.
+    """
+    if fp.endswith(OUTPUT_FORMATS["csv"]):
+        header = pd.read_csv(fp, nrows=0).columns
+        df = pd.read_csv(fp, dtype={c: str for c in header if c in (USER_ID_COLNAME, SESSION_USER_ID_COLNAME)})
+    else:
+        df = read_table(fp)
+        for c in [x for x in df.columns if x in (USER_ID_COLNAME, SESSION_USER_ID_COLNAME)]:
+            df[c] = df[c].astype(str)
+    non_numeric = [c for c in df.columns if c not in (USER_ID_COLNAME, SESSION_USER_ID_COLNAME) and not pd.api.types.is_numeric_dtype(df[c])]
+    if non_numeric:
+        raise ValueError("non-numeric feature columns {} in {}".format(non_numeric, fp))
+    return df
+
+
+def merge_feature_dfs(df_list, drop_cols = ["dropout_current_week", "week"]):
+    """
+    Join feature sets on userID with a single concatenation. Every feature set must contain exactly the same users, and feature names must not be repeated across sets.
+    :param df_list: list of pd.DataFrames, each with a userID or session_user_id column.
+    :param drop_cols: columns to drop from each feature set before merging
+    :return: pd.DataFrame of merged features, with userID as the first column.
+    """
+    indexed_dfs = []
+    for df in df_list:
+        df = df.rename(columns={SESSION_USER_ID_COLNAME: USER_ID_COLNAME})\
+            .drop(drop_cols, axis=1, errors="ignore")\
+            .set_index(USER_ID_COLNAME)
+        if not df.index.is_unique:
+            raise ValueError("duplicate {} values in feature set with columns {}".format(USER_ID_COLNAME, list(df.columns)))
+        indexed_dfs.append(df)
+    users = indexed_dfs[0].index
+    for i, df in enumerate(indexed_dfs):
+        # check to ensure every feature set describes the same users, in the row order of the first feature set
+        if not df.index.equals(users):
+            if len(df.index) != len(users) or not df.index.isin(users).all():
+                raise ValueError("feature set {} has {} users, {} of which are not in the first feature set ({} users)".format(
+                    i, len(df.index), (~df.index.isin(users)).sum(), len(users)))
+            indexed_dfs[i] = df.reindex(users)
+    df_out = pd.concat(indexed_dfs, axis=1)
+    duplicated = df_out.columns[df_out.columns.duplicated()]
+    if len(duplicated):
+        raise ValueError("feature names {} appear in more than one feature set".format(list(duplicated)))
+    return df_out.reset_index()
+
+
+def write_feature_matrix(df_out, output_dir="/output", stem = "feats"):
+    """
+    Write the features in df_out as a dense, C-ordered float32 matrix with one row per user, which can be memory-mapped with np.load(mmap_mode="r").
+    The row order (user ids) and column order (feature names) are written alongside as text files with one entry per line.
+    :param df_out: pd.DataFrame of merged features with a userID column.
+    :param stem: file name stem; files are <stem>_matrix.npy, <stem>_rows.txt, and <stem>_columns.txt.
+    :return: None
+    """
+    features = df_out.drop(USER_ID_COLNAME, axis=1)
+    np.save(os.path.join(output_dir, stem + FEATURE_MATRIX_SUFFIX), np.ascontiguousarray(features.values, dtype=np.float32))
+    with open(os.path.join(output_dir, stem + FEATURE_MATRIX_ROWS_SUFFIX), "w") as f:
+        f.writelines("{}\n".format(x) for x in df_out[USER_ID_COLNAME])
+    with open(os.path.join(output_dir, stem + FEATURE_MATRIX_COLUMNS_SUFFIX), "w") as f:
+        f.writelines("{}\n".format(x) for x in features.columns)
+    return
+
+
+def write_feature_file(df_out, output_dir="/output", result_filename = "feats.csv", output_format = "csv", write_matrix = False):
+    """
+    Remove any files in output_dir and write df_out to result_filename in output_dir; the extension of result_filename is replaced to match output_format.
+    If write_matrix is True, a dense float32 copy of the features is also written by write_feature_matrix().
+    :return: None
     """
-    user_id_colname = "userID" # key column used for joining
-    session_user_id_colname = "session_user_id" # another name for userid which will be renamed to user_id_colname
     result_fp = os.path.join(output_dir, result_filename)
-    df_list = []
-    # append all feature files to list
-    for dirpath, _, filenames in os.walk(input_dir):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            if (not match_substring) or (match_substring in f):
-                try:
-                    # read the file and remove it
-                    df = pd.read_csv(fp, dtype=object)
-                    df_list.append(df)
-                    os.remove(fp)
-                except Exception as e:
-                    print("[ERROR] in feature file aggregation {}".format(e))
-    # rename columns as necessary, from https://stackoverflow.com/questions/37221147/how-do-i-apply-transformations-to-list-of-pandas-dataframes
-    for i in range(len(df_list)):
-        # drop columns in drop_cols
-        temp = df_list[i].rename(columns={session_user_id_colname: user_id_colname})
-        temp.drop(drop_cols, axis=1, inplace=True, errors="ignore")
-        df_list[i] = temp
-    # merge dataframes on userID
-    df_out = reduce(lambda df1, df2: df1.merge(df2, on=user_id_colname), df_list)
-    # check to ensure number of columns/users has not changed via merging
-    assert(all(df.shape[0] == df_out.shape[0] for df in df_list))
     # remove any additional files in output_dir
     for dirpath, _, filenames in os.walk(output_dir):
         for f in filenames:
@@ -94,10 +189,67 @@ def aggregate_and_remove_feature_files(input_dir, output_dir="/output", result_f
             except Exception as e:
                 print("[INFO] exception when attempting to remove file {}: {}".format(fp, e))
     # write results to file in output_dir
-    df_out.to_csv(result_fp, index=False)
+    write_table(df_out, result_fp, output_format, index=False)
+    if write_matrix:
+        write_feature_matrix(df_out, output_dir, os.path.splitext(result_filename)[0])
+    return
 
 
+def aggregate_and_remove_feature_files(input_dir, output_dir="/output", result_filename = "feats.csv", match_substring=None, drop_cols = ["dropout_current_week", "week"], output_format = "csv", write_matrix = False):
+    """
+    Read in all feature files in input_dir, merge them, and write the results to output_dir, removing the files after merging.
+    :param input_dir: directory containing feature files to be merged
+    :param output_dir: directory to write results in
+    :param result_filename: name of file to write in output_dir
+    :param match_substring: optional, only match files containg this substring
+    :param output_format: format of the merged file; one of OUTPUT_FORMATS. Feature files in input_dir may be in any format.
+    :param write_matrix: if True, also write the merged features as a memory-mappable float32 matrix (see write_feature_matrix()).
+    :return:
+    :raises ValueError: if a feature file is not valid (see read_feature_file()).
+    """
+    df_list = read_feature_files(input_dir, match_substring, remove=True)
+    df_out = merge_feature_dfs(df_list, drop_cols)
+    write_feature_file(df_out, output_dir, result_filename, output_format, write_matrix)
+    return
+
+
+def read_feature_files(input_dir, match_substring=None, remove=False):
+    """
+    Read all feature files in input_dir (see read_feature_file()); invalid feature files raise, failing the extraction.
+    :param match_substring: optional, only match files containg this substring
+    :param remove: if True, remove each file after reading it.
+    :return: list of pd.DataFrames.
+    """
+    df_list = []
+    for dirpath, _, filenames in os.walk(input_dir):
+        for f in sorted(filenames):
+            fp = os.path.join(dirpath, f)
+            if (not match_substring) or (match_substring in f):
+                df_list.append(read_feature_file(fp))
+                if remove:
+                    try:
+                        os.remove(fp)
+                    except OSError as e:
+                        print("[ERROR] in feature file aggregation {}".format(e))
+    return df_list
 
 
+def write_feature_matrix_from_files(input_dir, output_dir="/output", stem="feats", match_substring=None, drop_cols = ["dropout_current_week", "week"]):
+    """
+    Merge the feature files in input_dir, leaving them in place, and write only the merged features as a dense matrix (see write_feature_matrix()).
+    :return: None
+    """
+    df_out = merge_feature_dfs(read_feature_files(input_dir, match_substring), drop_cols)
+    write_feature_matrix(df_out, output_dir, stem)
+    return
 
 
+def aggregate_feature_dfs(df_list, output_dir="/output", result_filename = "feats.csv", drop_cols = ["dropout_current_week", "week"], output_format = "csv", write_matrix = False):
+    """
+    In-memory counterpart of aggregate_and_remove_feature_files(): merge feature sets returned by the extractors' main() functions with in_memory = True, and write only the merged result to output_dir.
+    :param df_list: list of pd.DataFrames, each with a userID or session_user_id column.
+    :return: None
+    """
+    df_out = merge_feature_dfs(df_list, drop_cols)
+    write_feature_file(df_out, output_dir, result_filename, output_format, write_matrix)
+    return
@@ -0,0 +1,157 @@
+"""
+Partitioned store of long-format user-week features, shared across course sessions.
+
+Each course session's features are written once per feature group (clickstream, forum, quiz) as an uncompressed Arrow IPC
+file at <store_dir>/course=<course>/session=<session>/feature_group=<feature_group>/features.arrow, with one row per user
+and week. Queries select partitions from the directory names alone, and memory-map the files they open, selecting the
+requested columns of each record batch, so that the other columns of the matching partitions are not read from disk.
+
+Requires pyarrow.
+"""
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+PARTITION_FILENAME = "features.arrow"
+USER_ID_COLNAME = "userID"
+WEEK_COLNAME = "week"
+KEY_COLUMNS = [USER_ID_COLNAME, WEEK_COLNAME]
+
+
+def partition_dir(store_dir, course, session, feature_group):
+    return os.path.join(store_dir, "course={}".format(course), "session={}".format(session), "feature_group={}".format(feature_group))
+
+
+def write_partition(df, store_dir, course, session, feature_group, user_col = USER_ID_COLNAME):
+    """
+    Write the long-format features for one course session and feature group, replacing any existing partition.
+    :param df: pd.DataFrame with a user id column (or index) named user_col, a week column, and numeric feature columns.
+    :param store_dir: root directory of the store.
+    :param feature_group: name of the feature group, i.e. clickstream, forum, or quiz.
+    :param user_col: name of the user id column in df.
+    :return: path of the partition file.
+    """
+    if user_col in df.index.names:
+        df = df.reset_index()
+    df = df.rename(columns={user_col: USER_ID_COLNAME})
+    features = [c for c in df.columns if c not in KEY_COLUMNS]
+    arrays = [pa.array(df[USER_ID_COLNAME].astype(str).values, type=pa.string()),
+              pa.array(df[WEEK_COLNAME].values.astype(np.int32))]
+    arrays += [pa.array(pd.to_numeric(df[c]).values.astype(np.float64)) for c in features]
+    table = pa.Table.from_arrays(arrays, names=KEY_COLUMNS + features)
+    out_dir = partition_dir(store_dir, course, session, feature_group)
+    os.makedirs(out_dir, exist_ok=True)
+    # write to a temporary file first so that readers never see a partially-written partition
+    fd, temp_fp = tempfile.mkstemp(dir=out_dir, suffix=".tmp")
+    os.close(fd)
+    with pa.OSFile(temp_fp, "wb") as sink:
+        writer = pa.ipc.new_file(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+    fp = os.path.join(out_dir, PARTITION_FILENAME)
+    os.replace(temp_fp, fp)
+    return fp
+
+
+def _partition_values(parent_dir, key, allowed):
+    """
+    Yield (value, path) for each <key>=<value> subdirectory of parent_dir with value in allowed (or any value, if allowed is None).
+    """
+    if not os.path.isdir(parent_dir):
+        return
+    prefix = key + "="
+    for d in sorted(os.listdir(parent_dir)):
+        value = d[len(prefix):]
+        if d.startswith(prefix) and (allowed is None or value in allowed):
+            yield value, os.path.join(parent_dir, d)
+
+
+def list_partitions(store_dir, courses = None, sessions = None, feature_groups = None):
+    """
+    List the partitions matching the given courses, sessions, and feature groups (None matches all), without opening any files.
+    :return: list of (course, session, feature_group, path) tuples.
+    """
+    partitions = []
+    for course, course_dir in _partition_values(store_dir, "course", courses):
+        for session, session_dir in _partition_values(course_dir, "session", sessions):
+            for feature_group, group_dir in _partition_values(session_dir, "feature_group", feature_groups):
+                fp = os.path.join(group_dir, PARTITION_FILENAME)
+                if os.path.exists(fp):
+                    partitions.append((course, session, feature_group, fp))
+    return partitions
+
+
+def read_partition(fp, features = None, weeks = None):
+    """
+    Memory-map a partition and read the user id and week columns and the requested features, one record batch at a time, keeping only the requested weeks.
+    Only the buffers of the selected columns are accessed; the other columns of the file are never paged in.
+    :param fp: path of partition file.
+    :param features: list of feature names, or None for all features.
+    :param weeks: list of weeks, or None for all weeks.
+    :return: pa.Table, or None if the partition contains none of features.
+    """
+    reader = pa.ipc.open_file(pa.memory_map(fp, "r"))
+    names = reader.schema.names
+    if features is None:
+        columns = [c for c in names if c not in KEY_COLUMNS]
+    else:
+        columns = [c for c in features if c in names]
+        if not columns:
+            return None
+    indices = [names.index(c) for c in KEY_COLUMNS + columns]
+    batches = []
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        batch = pa.RecordBatch.from_arrays([batch.column(j) for j in indices], names=KEY_COLUMNS + columns)
+        if weeks is not None:
+            mask = np.isin(batch.column(KEY_COLUMNS.index(WEEK_COLNAME)).to_numpy(), list(weeks))
+            batch = batch.filter(pa.array(mask))
+        batches.append(batch)
+    schema = pa.schema([reader.schema.field(j) for j in indices])
+    return pa.Table.from_batches(batches, schema=schema)
+
+
+def query(store_dir, features = None, courses = None, sessions = None, weeks = None, feature_groups = None):
+    """
+    Fetch user-week features across course sessions as a single long-format DataFrame. Feature groups for the same session are joined on user and week.
+    :param store_dir: root directory of the store.
+    :param features: list of feature names, or None for all features.
+    :param courses: list of course names, or None for all courses.
+    :param sessions: list of session numbers, or None for all sessions.
+    :param weeks: list of weeks, or None for all weeks.
+    :param feature_groups: list of feature groups, or None for all feature groups.
+    :return: pd.DataFrame with columns course, session, userID, week, and one column per feature.
+    """
+    session_frames = {}
+    for course, session, feature_group, fp in list_partitions(store_dir, courses, sessions, feature_groups):
+        table = read_partition(fp, features, weeks)
+        if table is not None:
+            session_frames.setdefault((course, session), []).append(table.to_pandas().set_index(KEY_COLUMNS))
+    frames = []
+    for (course, session), dfs in sorted(session_frames.items()):
+        df = pd.concat(dfs, axis=1).reset_index()
+        df.insert(0, "session", session)
+        df.insert(0, "course", course)
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=["course", "session"] + KEY_COLUMNS + list(features or []))
+    df_out = pd.concat(frames, ignore_index=True)
+    if features is not None:
+        df_out = df_out[["course", "session"] + KEY_COLUMNS + [c for c in features if c in df_out.columns]]
+    return df_out
+
+
+def query_arrays(store_dir, features = None, courses = None, sessions = None, weeks = None, feature_groups = None):
+    """
+    Fetch features as arrays, one set per partition. When weeks is None, feature and week arrays are read-only views of the memory-mapped partition files, so nothing is copied into memory until it is used.
+    Arguments are as for query().
+    :return: dict mapping (course, session, feature_group) to a dict of column name to np.ndarray.
+    """
+    output = {}
+    for course, session, feature_group, fp in list_partitions(store_dir, courses, sessions, feature_groups):
+        table = read_partition(fp, features, weeks)
+        if table is not None:
+            output[(course, session, feature_group)] = {c: table.column(c).to_numpy() for c in table.schema.names}
+    return output
@@ -33,7 +33,7 @@ python3 forum_feature_extractor.py -i raw_data/thermo/ -d coursera_course_dates.
 import argparse, datetime, re, os
 import pandas as pd
 import numpy as np
-from extraction.extraction_utils import course_len, timestamp_week, fetch_start_end_date
+from extraction.extraction_utils import course_len, timestamp_week, fetch_start_end_date, write_table, table_path
 from extraction.quiz_feature_extractor import fetch_course_runs, get_users_and_weeks, gen_user_week_df, generate_appended_csv
 # from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 from textstat.textstat import textstat
@@ -42,20 +42,32 @@ import nltk
 MILLISECONDS_IN_SECOND = 1000
 
 
-def read_forum_and_comment_data(dir, run):
+def read_forum_and_comment_data(dir, run, na_values = None):
     """
     Read forum and comments data for a given run; combine into single dataframe.
     :param dir: input directory with CSV files of forum data.
     :param run: run number; must match number in filename exactly (i.e., '006' not '6').
+    :param na_values: additional strings to recognize as NA, passed to pd.read_csv().
     :return: pd.DataFrame of forum data (including both posts and comments) for run.
     """
     forum_file =  [x for x in os.listdir(dir) if x.endswith('{0}_forum_text.csv'.format(run))][0]
-    forum_df = pd.read_csv(os.path.join(dir, forum_file))
+    forum_df = pd.read_csv(os.path.join(dir, forum_file), na_values=na_values)
     # read in universal newline mode; this is due to pandas issue documented here: https://github.com/pandas-dev/pandas/issues/11166
     # forum_df = pd.read_csv(open(os.path.join(input_dir, forum_file), 'rU'), encoding='utf-8', engine='c')
     return forum_df
 
 
+def read_forum_aggregates(dir, run):
+    """
+    Read user-week forum aggregates for a given run, as exported by sql_utils.extract_forum_aggregates_csv_from_sql().
+    :param dir: input directory with CSV files of forum data.
+    :param run: run number; must match number in filename exactly (i.e., '006' not '6').
+    :return: pd.DataFrame of 'session_user_id', 'week', 'week_post_len_char', 'num_posts', 'votes_net'.
+    """
+    forum_agg_file = [x for x in os.listdir(dir) if x.endswith('{0}_forum_aggregates.csv'.format(run))][0]
+    return pd.read_csv(os.path.join(dir, forum_agg_file), na_values=['\\N'])
+
+
 def gen_thread_order(df):
     """
     Add column with order of post within each thread, by timestamp.
@@ -170,10 +182,18 @@ def gen_bigram_counts(df):
     return df_out
 
 
-def gen_forum_features(forum_df, course_start, course_end, dropout_fp = "/output/user_dropout_weeks.csv"):
-    forum_df['week'] = (forum_df['post_time']*1000).apply(timestamp_week, args = (course_start, course_end))
+def gen_forum_features(forum_df, course_start, course_end, dropout_fp = "/output/user_dropout_weeks.csv", forum_agg_df = None, dropout_df = None):
+    """
+    Generate user-week level forum features.
+    :param forum_df: pd.DataFrame of forum post data.
+    :param forum_agg_df: optional pd.DataFrame of user-week aggregates computed in the database (see read_forum_aggregates()); if given, forum_df must already have a week column and the count/sum features are taken from forum_agg_df.
+    :param dropout_df: optional pd.DataFrame of dropout weeks; if not given, it is read from dropout_fp.
+    :return: user-week level pd.DataFrame of forum features.
+    """
+    if forum_agg_df is None:
+        forum_df['week'] = (forum_df['post_time']*1000).apply(timestamp_week, args = (course_start, course_end))
     forum_df['post_text'] = forum_df['post_text'].apply(str)
-    users, weeks = get_users_and_weeks(forum_df, dropout_fp, week_col='week')
+    users, weeks = get_users_and_weeks(forum_df, dropout_fp, week_col='week', dropout_df = dropout_df)
     forum_df = gen_thread_order(forum_df)
     # initialize output dataframe with one entry per user per week
     df_out = gen_user_week_df(users, weeks)
@@ -182,12 +202,18 @@ def gen_forum_features(forum_df, course_start, course_end, dropout_fp = "/output
     df_out = df_out.merge(feat_temp, how = 'left')
     df_out['threads_started'].fillna(0, inplace = True)
     # compute feature: avg post length in characters
-    forum_df['post_len_char'] = forum_df['post_text'].apply(len)
-    feat_temp = forum_df.groupby(['session_user_id', 'week'])['post_len_char'].agg('sum').rename('week_post_len_char').reset_index()
+    if forum_agg_df is None:
+        forum_df['post_len_char'] = forum_df['post_text'].apply(len)
+        feat_temp = forum_df.groupby(['session_user_id', 'week'])['post_len_char'].agg('sum').rename('week_post_len_char').reset_index()
+    else:
+        feat_temp = forum_agg_df[['session_user_id', 'week', 'week_post_len_char']]
     df_out = df_out.merge(feat_temp, how = 'left')
     df_out['week_post_len_char'].fillna(0, inplace = True)
     # compute feature: number of posts
-    feat_temp = forum_df.groupby(['session_user_id', 'week']).size().rename('num_posts').reset_index()
+    if forum_agg_df is None:
+        feat_temp = forum_df.groupby(['session_user_id', 'week']).size().rename('num_posts').reset_index()
+    else:
+        feat_temp = forum_agg_df[['session_user_id', 'week', 'num_posts']]
     df_out = df_out.merge(feat_temp, how='left')
     df_out['num_posts'].fillna(0, inplace = True)
     # compute feature: num_replies: count of posts which were responses to other users (i.e., not first post and not self-response)
@@ -195,7 +221,10 @@ def gen_forum_features(forum_df, course_start, course_end, dropout_fp = "/output
     df_out = df_out.merge(feat_temp, how='left')
     df_out['num_replies'].fillna(0, inplace = True)
     #compute feature: votes_net : sum of upvotes minus downvotes (this is what 'votes' field is) for all posts that week
-    feat_temp = forum_df.groupby(['session_user_id', 'week'])['votes'].sum().rename('votes_net').reset_index()
+    if forum_agg_df is None:
+        feat_temp = forum_df.groupby(['session_user_id', 'week'])['votes'].sum().rename('votes_net').reset_index()
+    else:
+        feat_temp = forum_agg_df[['session_user_id', 'week', 'votes_net']]
     df_out = df_out.merge(feat_temp, how='left')
     df_out['votes_net'].fillna(0, inplace=True)
     # compute feature: avg_sentiment
@@ -218,27 +247,43 @@ def gen_forum_features(forum_df, course_start, course_end, dropout_fp = "/output
     return df_out
 
 
-def write_forum_output(forum_feature_df, output_dir, run, appended = True, week_only = False, week = 2):
+def gen_forum_output(forum_feature_df, appended = True, week_only = False, week = 2):
+    """
+    Build the forum feature sets for week.
+    :return: dict mapping output filename to pd.DataFrame (indexed by session_user_id); empty if there is no data for week.
+    """
+    output = {}
     week_df = forum_feature_df[forum_feature_df.week == week]
     if week_df.shape[0] == 0:
-        return  # no data for this week
+        return output  # no data for this week
     app_week_df = generate_appended_csv(forum_feature_df, week)
-    # write output; fill NaN values with NA so R will be happy :-D
+    # fill NaN values with NA so R will be happy :-D
     if week_only:
-        week_df.set_index('session_user_id').fillna('NA').to_csv(os.path.join(output_dir, 'week_{0}_forum_only_feats.csv'.format(week)))
+        output['week_{0}_forum_only_feats.csv'.format(week)] = week_df.set_index('session_user_id').fillna('NA')
     if appended:
-        app_week_df.set_index('session_user_id').fillna('NA').to_csv(os.path.join(output_dir, 'week_{0}_forum_appended_feats.csv'.format(week)))
+        output['week_{0}_forum_appended_feats.csv'.format(week)] = app_week_df.set_index('session_user_id').fillna('NA')
+    return output
+
+
+def write_forum_output(forum_feature_df, output_dir, run, appended = True, week_only = False, week = 2, output_format = "csv"):
+    for filename, df in gen_forum_output(forum_feature_df, appended, week_only, week).items():
+        write_table(df, os.path.join(output_dir, filename), output_format)
     return
 
 
-def main(course_name, run, output_dir = '/output', date_file = 'coursera_course_dates.csv'):
+def main(course_name, run, output_dir = '/output', date_file = 'coursera_course_dates.csv', sql_aggregates = False, dropout_df = None, in_memory = False, output_format = 'csv', feature_store_dir = None):
     """
     Main workhorse function; builds full forum dataset for course_name.
     :param course_name: course short name; should match name in coursera_course_dates.csv
     :param date_file: course dates CSV file
     :param output_dir: output directory; should be /proc_data/shortname
     :param run: run numbers in 3-digit string format
-    :return: None; writes output to output_dir subdirectories
+    :param sql_aggregates: if True, read the reduced text export and user-week aggregates from sql_utils.extract_forum_aggregates_csv_from_sql()
+    :param dropout_df: optional pd.DataFrame of dropout weeks from clickstream_feature_extractor.main(); if not given, user_dropout_weeks.csv is read from output_dir
+    :param in_memory: if True, return the feature sets instead of writing them
+    :param output_format: format of feature files written, and of user_dropout_weeks in output_dir; one of extraction_utils.OUTPUT_FORMATS
+    :param feature_store_dir: if given, user-week features are also written to this feature store (see extraction.feature_store)
+    :return: None; writes output to output_dir subdirectories. If in_memory is True, a list of feature pd.DataFrames with a session_user_id column.
     """
     input_dir = os.path.join('/input', course_name, run)
     date_file_path = os.path.join(input_dir, date_file)
@@ -246,12 +291,24 @@ def main(course_name, run, output_dir = '/output', date_file = 'coursera_course_
     # fetch start/end dates
     course_start, course_end = fetch_start_end_date(course_name, run, date_file_path)
     # read in forum data; this combines comments and posts
-    forum_df = read_forum_and_comment_data(output_dir, run)
+    if sql_aggregates:
+        # NULL weeks are exported by mySQL as \N
+        forum_df = read_forum_and_comment_data(output_dir, run, na_values=['\\N'])
+        forum_agg_df = read_forum_aggregates(output_dir, run)
+    else:
+        forum_df = read_forum_and_comment_data(output_dir, run)
+        forum_agg_df = None
     # generate derived features
-    forum_feature_df = gen_forum_features(forum_df, course_start, course_end)
+    dropout_fp = table_path(os.path.join(output_dir, 'user_dropout_weeks.csv'), output_format)
+    forum_feature_df = gen_forum_features(forum_df, course_start, course_end, dropout_fp = dropout_fp, forum_agg_df = forum_agg_df, dropout_df = dropout_df)
     assert forum_feature_df.isnull().sum().sum() == 0
+    if feature_store_dir:
+        from extraction.feature_store import write_partition
+        write_partition(forum_feature_df, feature_store_dir, course_name, run, "forum", user_col = 'session_user_id')
+    if in_memory:
+        return [df.reset_index() for df in gen_forum_output(forum_feature_df).values()]
     # write features to output_dir, by course week
-    write_forum_output(forum_feature_df, output_dir, run)
+    write_forum_output(forum_feature_df, output_dir, run, output_format = output_format)
     return None
 
 
@@ -35,7 +35,7 @@ import argparse, datetime, re, os
 import pandas as pd
 import numpy as np
 import itertools
-from extraction.extraction_utils import course_len, timestamp_week, fetch_start_end_date
+from extraction.extraction_utils import course_len, timestamp_week, fetch_start_end_date, read_table, write_table, table_path
 
 MILLISECONDS_IN_SECOND = 1000
 MILLISECONDS_IN_DAY = 86400000
@@ -65,6 +65,19 @@ def read_quiz_data(dir, run):
     return quiz_df
 
 
+def read_quiz_aggregates(dir, run):
+    """
+    Read user-week-quiz type aggregates for a given run, as exported by sql_utils.extract_quiz_aggregates_csv_from_sql().
+    :param dir: input directory with CSV files of quiz data.
+    :param run: run number; must match number in filename exactly (i.e., '006' not '6').
+    :return: pd.DataFrame of quiz aggregates for run.
+    :raises IndexError: if there is no aggregates file for run.
+    """
+    quiz_agg_file = [x for x in os.listdir(dir) if x.endswith('{0}_quiz_aggregates.csv'.format(run))][0]
+    # errors propagate, so that a missing or unreadable export fails the extraction
+    return pd.read_csv(os.path.join(dir, quiz_agg_file), na_values=['\\N'])
+
+
 def read_quiz_metadata(dir, run):
     """
     Read quiz metadata for a given run.
@@ -80,20 +93,22 @@ def read_quiz_metadata(dir, run):
     return quiz_meta_df
 
 
-def get_users_and_weeks(df, dropout_fp, df_user_col = 'session_user_id', dropout_user_col = 'userID', week_col = 'assignment_week'):
+def get_users_and_weeks(df, dropout_fp, df_user_col = 'session_user_id', dropout_user_col = 'userID', week_col = 'assignment_week', dropout_df = None):
     """
     Helper function to fetch all unique users and weeks in a course
     :param df: pd.DataFrame of course quiz data; needs columns for session_user_id and assignment_week
-    :param dropout_fp: path to droput csv from clickstream_feature_extractor
+    :param dropout_fp: path to droput csv from clickstream_feature_extractor; not read if dropout_df is given
     :param df_user_col: name of column containing unique user IDs in df.
     :param dropout_user_col: name of column containing user IDs in droput df (user_dropout_weeks.csv, in output_dir). This will be set in xing_feature_extractor.py.
     :param week_col: name of column containing weeks.
+    :param dropout_df: optional pd.DataFrame of dropout weeks, as returned by clickstream_feature_extractor.main() with in_memory = True.
     :return: series containing all unique session_user_ids in df, and zero-indexed list of all week numbers in course as integers.
     """
-    try:
-        dropout_df = pd.read_csv(dropout_fp)
-    except Exception as e:
-        print("[ERROR] reading dropout_df from {}: {}".format(dropout_fp, e))
+    if dropout_df is None:
+        try:
+            dropout_df = read_table(dropout_fp)
+        except Exception as e:
+            print("[ERROR] reading dropout_df from {}: {}".format(dropout_fp, e))
     users = dropout_df[dropout_user_col].unique()
     weeks = [x for x in range(int(max(df[week_col].dropna().unique())) + 1)]
     return users,weeks
@@ -138,18 +153,25 @@ def gen_quiz_expanding_mean(df_in, users, weeks, quiz_types = ('video', 'quiz',
     """
     # initialize dataframe with all user, week combinations
     df_out = pd.DataFrame([x for x in itertools.product(users, weeks)], columns=['session_user_id', 'assignment_week'])
+    # df_in is either submission-level (raw_score) or pre-aggregated by the database (sum_raw_score, n_scored)
+    pre_aggregated = 'raw_score' not in df_in.columns
+    score_cols = ['sum_raw_score', 'n_scored'] if pre_aggregated else ['raw_score']
     for qt in quiz_types: # for each quiz type, compute expanding mean for user by week and merge as new column onto df_out
         new_col_name = 'prior_avg_quiz_score_{0}'.format(qt)
         if qt != 'AGG':
             if not qt in df_in.quiz_type.unique():  # quiz type not used in course; set column to na and continue to next quiz type
                 df_out[new_col_name] = np.nan
                 continue
-            df = df_in[df_in.quiz_type == qt][['session_user_id', 'assignment_week', 'raw_score']]
+            df = df_in[df_in.quiz_type == qt][['session_user_id', 'assignment_week'] + score_cols]
         else:  # for AGG; get a subset of columns but keep all rows
-            df = df_in[['session_user_id', 'assignment_week', 'raw_score']]
+            df = df_in[['session_user_id', 'assignment_week'] + score_cols]
         # get expanding sums of raw scores and counts of quizzes at user-week level
-        df_feat = df.groupby(['session_user_id', 'assignment_week'])['raw_score'] \
-            .agg(('sum', 'count')) \
+        if pre_aggregated:
+            df_sums = df.groupby(['session_user_id', 'assignment_week'])[score_cols].sum() \
+                .rename(columns={'sum_raw_score': 'sum', 'n_scored': 'count'})
+        else:
+            df_sums = df.groupby(['session_user_id', 'assignment_week'])['raw_score'].agg(('sum', 'count'))
+        df_feat = df_sums \
             .reindex(pd.MultiIndex.from_product([users, weeks], names=['session_user_id', 'assignment_week'])) \
             .groupby(level=0) \
             .cumsum() \
@@ -165,6 +187,19 @@ def gen_quiz_expanding_mean(df_in, users, weeks, quiz_types = ('video', 'quiz',
     return df_out
 
 
+def user_week_submission_counts(quiz_df):
+    """
+    Helper function to count submissions by user and week, from either submission-level or pre-aggregated quiz data.
+    :param quiz_df: pd.DataFrame of quiz submission data, or of aggregates with an n_submissions column.
+    :return: pd.DataFrame with session_user_id, assignment_week, total_user_submissions_week
+    """
+    if 'n_submissions' in quiz_df.columns:
+        counts = quiz_df.groupby(['session_user_id', 'assignment_week'])['n_submissions'].sum()
+    else:
+        counts = quiz_df[['session_user_id', 'assignment_week']].groupby(['session_user_id', 'assignment_week']).size()
+    return counts.rename('total_user_submissions_week').reset_index()
+
+
 def pct_max_weekly_submissions(quiz_df, quiz_meta_df):
     """
     Helper function to compute student weekly submissions as a percentage of max # of submissions, and as a percentage of the highest number of student submissions that week.
@@ -174,7 +209,7 @@ def pct_max_weekly_submissions(quiz_df, quiz_meta_df):
     """
     # submissions as percentage of maximum instructor-allowed submissions that week
     max_submission_df = quiz_meta_df.groupby('assignment_week')['maximum_submissions'].agg('sum').rename('max_allowed_submissions_week').reset_index()
-    total_submission_df = quiz_df[['session_user_id', 'assignment_week']].groupby(['session_user_id', 'assignment_week']).size().rename('total_user_submissions_week').reset_index()
+    total_submission_df = user_week_submission_counts(quiz_df)
     df_out = total_submission_df.merge(max_submission_df)
     df_out['weekly_pct_max_allowed_submissions'] = df_out['total_user_submissions_week']/df_out['max_allowed_submissions_week']
     df_out.drop('max_allowed_submissions_week', axis = 1, inplace = True)
@@ -187,13 +222,10 @@ def pct_max_weekly_submissions(quiz_df, quiz_meta_df):
 
 
 def raw_points_per_submission(quiz_df):
-    total_submission_df = quiz_df[['session_user_id', 'assignment_week']]\
-        .groupby(['session_user_id', 'assignment_week'])\
-        .size()\
-        .rename('total_user_submissions_week')\
-        .reset_index()
+    total_submission_df = user_week_submission_counts(quiz_df)
+    score_col = 'sum_raw_score' if 'sum_raw_score' in quiz_df.columns else 'raw_score'
     total_raw_points_df = quiz_df\
-        .groupby(['session_user_id', 'assignment_week'])['raw_score']\
+        .groupby(['session_user_id', 'assignment_week'])[score_col]\
         .agg('sum')\
         .rename('total_raw_points_week')\
         .reset_index()
@@ -217,7 +249,7 @@ def pre_dl_submissions(quiz_df, submission_bins = [-np.inf, 0, MILLISECONDS_IN_D
     return temp
 
 
-def gen_quiz_features(quiz_df, quiz_meta_df, course_start, course_end, quiz_types = ('video', 'quiz', 'homework'), dropout_fp = "/output/user_dropout_weeks.csv"):
+def gen_quiz_features(quiz_df, quiz_meta_df, course_start, course_end, quiz_types = ('video', 'quiz', 'homework'), dropout_fp = "/output/user_dropout_weeks.csv", dropout_df = None):
     """
     Generates derived features for quiz_df.
     :param quiz_df: raw pd.DataFrame of submission-level quiz data as pd.DataFrame; this is also used to append any new columns needed for deriving complex features.
@@ -234,7 +266,7 @@ def gen_quiz_features(quiz_df, quiz_meta_df, course_start, course_end, quiz_type
     quiz_meta_df['assignment_week'] = (quiz_meta_df['soft_close_time']*1000).apply(timestamp_week, args = (course_start, course_end))
     quiz_df['pre_dl_submission_time'] = quiz_df['soft_close_time'] - quiz_df['submission_time']
     # drop submissions outside of course window
-    users, weeks = get_users_and_weeks(quiz_df, dropout_fp)
+    users, weeks = get_users_and_weeks(quiz_df, dropout_fp, dropout_df = dropout_df)
     quiz_df = quiz_df[pd.notnull(quiz_df["submission_week"]) & pd.notnull(quiz_df["assignment_week"])]
     # fetch users and weeks from df
     # create dataframe of users and weeks; this is user-week level dataframe for output.
@@ -276,6 +308,54 @@ def gen_quiz_features(quiz_df, quiz_meta_df, course_start, course_end, quiz_type
     return df_out
 
 
+def gen_quiz_features_from_aggregates(quiz_agg_df, quiz_meta_df, course_start, course_end, quiz_types = ('video', 'quiz', 'homework'), dropout_fp = "/output/user_dropout_weeks.csv", dropout_df = None):
+    """
+    Generates the same derived features as gen_quiz_features(), from user-week-quiz type aggregates computed in the database.
+    :param quiz_agg_df: pd.DataFrame from sql_utils.extract_quiz_aggregates_csv_from_sql(); one row per user, assignment_week and quiz_type.
+    :param quiz_meta_df: pd.DataFrame of quiz-level metadata
+    :param course_start:
+    :param course_end:
+    :quiz_types: list of quiz types to consider; other quiz types are excluded.
+    :return: df_out, user-week level pd.DataFrame of quiz data with derived features (one entry per user per week).
+    """
+    quiz_meta_df['assignment_week'] = (quiz_meta_df['soft_close_time']*1000).apply(timestamp_week, args = (course_start, course_end))
+    users, weeks = get_users_and_weeks(quiz_agg_df, dropout_fp, dropout_df = dropout_df)
+    # drop groups with no submissions inside the course window; these only contribute to the number of weeks
+    quiz_agg_df = quiz_agg_df[quiz_agg_df['n_submissions'] > 0]
+    df_out = gen_user_week_df(users, weeks)
+    # compute feature: counts of submissions by time before deadline, by user/week
+    bin_cols = [x for x in quiz_agg_df.columns if x.startswith('pre_dl_submission_count')]
+    feat_temp = quiz_agg_df.groupby(['session_user_id', 'assignment_week'])[bin_cols].sum().reset_index()
+    df_out = merge_feat_df(df_out, feat_temp, zero_fill_prefix="pre_dl_submission_count")
+    # compute feature: average grade across all submissions within quiz_types by user/week
+    typed_agg_df = quiz_agg_df[quiz_agg_df.quiz_type.isin(quiz_types)]
+    feat_temp = typed_agg_df.groupby(['assignment_week', 'session_user_id'])[['sum_raw_score', 'n_scored']].sum()
+    feat_temp = (feat_temp['sum_raw_score'] / feat_temp['n_scored']).rename('avg_raw_score_week').reset_index()
+    df_out = merge_feat_df(df_out, feat_temp, zero_fill_cols=['avg_raw_score_week'])
+    # compute feature: average grade by quiz type by user/week
+    feat_temp = typed_agg_df.set_index(['assignment_week', 'session_user_id', 'quiz_type'])
+    feat_temp = (feat_temp['sum_raw_score'] / feat_temp['n_scored']).unstack(
+        level=-1).rename(columns=lambda x: 'weekly_avg_score_' + x + '_quiz_type').reset_index()
+    missing_quiz_types = [x for x in quiz_types if x not in quiz_agg_df.quiz_type.unique()]
+    for qt in missing_quiz_types:
+        feat_temp['weekly_avg_score_{0}_quiz_type'.format(qt)] = np.nan
+    df_out = merge_feat_df(df_out, feat_temp, zero_fill_prefix="weekly_avg_score_")
+    # compute feature: difference between weekly quiz avg and prior quiz avg
+    feat_temp = gen_quiz_expanding_mean(quiz_agg_df, users, weeks)
+    df_out = merge_feat_df(df_out, feat_temp)
+    for qt in quiz_types:
+        df_out['week_avg_change_{0}_quiz_type'.format(qt)] = df_out['weekly_avg_score_{0}_quiz_type'.format(qt)] - df_out['prior_avg_quiz_score_{0}'.format(qt)]
+        df_out['week_avg_change_{0}_quiz_type'.format(qt)].fillna(0, inplace = True)
+    df_out.drop([x for x in df_out.columns if 'prior_avg_quiz_score' in x], axis = 1, inplace = True)
+    # compute features: submissions as percent of maximum allowed and of maximum actual student submissions
+    feat_temp = pct_max_weekly_submissions(quiz_agg_df, quiz_meta_df)
+    df_out = merge_feat_df(df_out, feat_temp)
+    # compute feature: Avg quiz grade/number of submissions (raw_points_per_submission)
+    feat_temp = raw_points_per_submission(quiz_agg_df)
+    df_out = merge_feat_df(df_out, feat_temp, zero_fill_cols=['raw_points_per_submission', 'total_raw_points_week', 'weekly_pct_max_allowed_submissions', 'weekly_pct_max_student_submissions', 'total_user_submissions_week'])
+    return df_out
+
+
 def generate_appended_csv(df_in, week):
     """
     Helper function to generate 'wide' appended dataframe from 'long' feature set.
@@ -297,26 +377,42 @@ def generate_appended_csv(df_in, week):
     return df_app
 
 
-def write_quiz_output(quiz_feature_df, output_dir, appended = True, week_only = False, week = 2):
+def gen_quiz_output(quiz_feature_df, appended = True, week_only = False, week = 2):
+    """
+    Build the quiz feature sets for week.
+    :return: dict mapping output filename to pd.DataFrame (indexed by session_user_id); empty if there is no data for week.
+    """
+    output = {}
     week_df = quiz_feature_df[quiz_feature_df.week == week]
     if week_df.shape[0] == 0:
-        return  # no data for this week
+        return output  # no data for this week
     app_week_df = generate_appended_csv(quiz_feature_df, week)
-    # write output; fill NaN values with NA so R will be happy :-D
+    # fill NaN values with NA so R will be happy :-D
     if week_only:
-        week_df.set_index('session_user_id').fillna('NA').to_csv(os.path.join(output_dir, 'week_{0}_quiz_only_feats.csv'.format(week)))
+        output['week_{0}_quiz_only_feats.csv'.format(week)] = week_df.set_index('session_user_id').fillna('NA')
     if appended:
-        app_week_df.set_index('session_user_id').fillna('NA').to_csv(os.path.join(output_dir, 'week_{0}_quiz_appended_feats.csv'.format(week)))
+        output['week_{0}_quiz_appended_feats.csv'.format(week)] = app_week_df.set_index('session_user_id').fillna('NA')
+    return output
+
+
+def write_quiz_output(quiz_feature_df, output_dir, appended = True, week_only = False, week = 2, output_format = "csv"):
+    for filename, df in gen_quiz_output(quiz_feature_df, appended, week_only, week).items():
+        write_table(df, os.path.join(output_dir, filename), output_format)
     return
 
 
-def main(course_name, run,  output_dir = '/output', date_file = 'coursera_course_dates.csv'):
+def main(course_name, run,  output_dir = '/output', date_file = 'coursera_course_dates.csv', sql_aggregates = False, dropout_df = None, in_memory = False, output_format = 'csv', feature_store_dir = None):
     """
     Main workhorse function; builds full quiz datasets (appended and week-only) for course_name and writes as CSVs to ouput_dir.
     :param course_name: course short name; should match name in coursera_course_dates.csv
     :param date_file: course dates CSV file
     :param output_dir: output directory
-    :return: None; writes output to output_dir
+    :param sql_aggregates: if True, read aggregates from sql_utils.extract_quiz_aggregates_csv_from_sql() instead of submission-level data
+    :param dropout_df: optional pd.DataFrame of dropout weeks from clickstream_feature_extractor.main(); if not given, user_dropout_weeks.csv is read from output_dir
+    :param in_memory: if True, return the feature sets instead of writing them
+    :param output_format: format of feature files written, and of user_dropout_weeks in output_dir; one of extraction_utils.OUTPUT_FORMATS
+    :param feature_store_dir: if given, user-week features are also written to this feature store (see extraction.feature_store)
+    :return: None; writes output to output_dir. If in_memory is True, a list of feature pd.DataFrames with a session_user_id column.
     """
     input_dir = os.path.join('/input', course_name, run)
     print('fetching data for run {0}'.format(run))
@@ -325,13 +421,23 @@ def main(course_name, run,  output_dir = '/output', date_file = 'coursera_course
     course_start, course_end = fetch_start_end_date(course_name, run, date_file_path)
     # n_weeks = course_len(course_start, course_end)
     # read in quiz data
-    quiz_df = read_quiz_data(output_dir, run)
     quiz_meta_df = read_quiz_metadata(output_dir, run)
+    dropout_fp = table_path(os.path.join(output_dir, 'user_dropout_weeks.csv'), output_format)
     # generate derived features
-    quiz_feature_df = gen_quiz_features(quiz_df, quiz_meta_df, course_start, course_end)
+    if sql_aggregates:
+        quiz_agg_df = read_quiz_aggregates(output_dir, run)
+        quiz_feature_df = gen_quiz_features_from_aggregates(quiz_agg_df, quiz_meta_df, course_start, course_end, dropout_fp = dropout_fp, dropout_df = dropout_df)
+    else:
+        quiz_df = read_quiz_data(output_dir, run)
+        quiz_feature_df = gen_quiz_features(quiz_df, quiz_meta_df, course_start, course_end, dropout_fp = dropout_fp, dropout_df = dropout_df)
     assert quiz_feature_df.isnull().sum().sum() == 0
+    if feature_store_dir:
+        from extraction.feature_store import write_partition
+        write_partition(quiz_feature_df, feature_store_dir, course_name, run, "quiz", user_col = 'session_user_id')
+    if in_memory:
+        return [df.reset_index() for df in gen_quiz_output(quiz_feature_df).values()]
     # write features to output_dir, by course week; note that many courses won't have any data for week zero (no quizzes due in first week)
-    write_quiz_output(quiz_feature_df, output_dir)
+    write_quiz_output(quiz_feature_df, output_dir, output_format = output_format)
     return
 
 
@@ -2,9 +2,24 @@ import os
 import subprocess
 import re
 import shutil
+import hashlib
+import tempfile
+import calendar
+from concurrent.futures import ThreadPoolExecutor
+from extraction.extraction_utils import course_len
 
 DATABASE_NAME = "course"
+MYSQL_DATA_DIR = "/var/lib/mysql"
 MYSQL_DEFAULT_OUTPUT_DIR = "/var/lib/mysql/{}/".format(DATABASE_NAME)  # this is the only location mysql can write to
+SNAPSHOT_DIR = "/snapshots"  # optional volume; loaded databases are snapshotted here and reused across runs
+SECONDS_IN_WEEK = 604800
+MILLISECONDS_IN_DAY = 86400000
+# (label, lower bound, upper bound) of pre-deadline submission bins; must match quiz_feature_extractor.pre_dl_submissions()
+PRE_DL_SUBMISSION_BINS = (('pre_dl_submission_count_late', None, 0),
+                          ('pre_dl_submission_count_0_1_day', 0, MILLISECONDS_IN_DAY),
+                          ('pre_dl_submission_count_1_3_day', MILLISECONDS_IN_DAY, 3*MILLISECONDS_IN_DAY),
+                          ('pre_dl_submission_count_3_7_day', 3*MILLISECONDS_IN_DAY, 7*MILLISECONDS_IN_DAY),
+                          ('pre_dl_submission_count_greater_7_day', 7*MILLISECONDS_IN_DAY, None))
 
 
 def initialize_sql_db(user = 'root', pw = 'root', db_name = DATABASE_NAME):
@@ -12,25 +27,196 @@ def initialize_sql_db(user = 'root', pw = 'root', db_name = DATABASE_NAME):
     Start mySQL service and initialize mysql database.
     :param user:
     :param pw:
-    :return:
+    :return: exit status of mysql.
     """
     subprocess.call('service mysql start', shell=True)
     # command to create a database
     cmd = '''mysql -u {} -p{} -e "CREATE DATABASE {}"'''.format(user, pw, db_name)
     res = subprocess.call(cmd, shell=True)
-    return None
+    if res != 0:
+        print("[ERROR] creating database {}: mysql exited with {}".format(db_name, res))
+    return res
 
 def load_sql_dump(file, course, run, pw = 'root', user = 'root', db_name = DATABASE_NAME):
-    command = '''mysql -u {} -p{} {} < /input/{}/{}/{}'''.format(user, pw, db_name, course, run, file)
-    res = subprocess.call(command, shell=True)
+    """
+    Load a .sql or .sql.gz dump into db_name. Compressed dumps are decompressed by gunzip and piped straight into
+    mysql, so the uncompressed dump is never written to disk.
+    :return: exit status of mysql, or of gunzip if decompression failed.
+    """
+    mysql_cmd = ['mysql', '-u', user, '-p{}'.format(pw), db_name]
+    with open(os.path.join('/input', course, run, file), 'rb') as f:
+        if not file.endswith('.gz'):
+            return subprocess.call(mysql_cmd, stdin=f)
+        gunzip = subprocess.Popen(['gunzip', '-c'], stdin=f, stdout=subprocess.PIPE)
+        mysql = subprocess.Popen(mysql_cmd, stdin=gunzip.stdout)
+        gunzip.stdout.close()  # so gunzip receives SIGPIPE if mysql exits early
+        res = mysql.wait()
+        gunzip.wait()
+    if res != 0 or gunzip.returncode != 0:
+        print("[ERROR] loading {}: gunzip exited with {}, mysql exited with {}".format(file, gunzip.returncode, res))
+    return res or gunzip.returncode
+
+
+def list_sql_dumps(course, session):
+    sql_dir = '/input/{}/{}/'.format(course, session)
+    return [x for x in os.listdir(sql_dir) if re.search('\.sql(\.gz)?$', x)]
+
+
+def load_sql_dumps(course, session, max_threads = 4):
+    """
+    Load all dumps for course and session. Each dump holds independent tables, so dumps are decompressed and loaded
+    concurrently on up to max_threads threads (each thread only waits on its own gunzip/mysql pipeline).
+    :return: True if every dump was loaded successfully, otherwise False.
+    """
+    sql_files = list_sql_dumps(course, session)
+    if not sql_files:
+        return True
+    with ThreadPoolExecutor(max_workers=min(max_threads, len(sql_files))) as executor:
+        results = list(executor.map(lambda file: load_sql_dump(file, course, session), sql_files))
+    return all(res == 0 for res in results)
+
+
+SNAPSHOT_FILE_REGEX = re.compile(r"^(.+)_([^_]+)_([0-9a-f]{64})\.tar$")  # <course>_<session>_<dump checksum>.tar
+
+
+def dump_checksum(dump_files, block_size = 2**20):
+    """
+    Content hash of a set of dump files plus the mySQL server version; used to key database snapshots, so that snapshots are never restored into an incompatible server.
+    :param dump_files: list of paths to dump files.
+    :param block_size: number of bytes to read at a time.
+    :return: hex digest (string).
+    """
+    digests = []
+    for dump_file in dump_files:
+        digest = hashlib.sha256()
+        with open(dump_file, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                digest.update(block)
+        digests.append(digest.hexdigest())
+    checksum = hashlib.sha256(subprocess.check_output("mysqld --version", shell=True))
+    for digest in sorted(digests):
+        checksum.update(digest.encode("utf-8"))
+    return checksum.hexdigest()
+
+
+def snapshot_path(snapshot_dir, course, session, checksum):
+    return os.path.join(snapshot_dir, "{}_{}_{}.tar".format(course, session, checksum))
+
+
+def _empty_dir(dir):
+    """
+    Remove the contents of dir, but not dir itself.
+    """
+    for item in os.listdir(dir):
+        fp = os.path.join(dir, item)
+        if os.path.isdir(fp) and not os.path.islink(fp):
+            shutil.rmtree(fp)
+        else:
+            os.remove(fp)
     return
 
 
-def load_sql_dumps(course, session):
+def save_snapshot(course, session, checksum, snapshot_dir, mysql_data_dir = MYSQL_DATA_DIR):
+    """
+    Stop mySQL, archive its data directory to snapshot_dir, and restart it. Older snapshots of the same course and session are then removed (see prune_snapshots()).
+    :param checksum: snapshot key from dump_checksum().
+    :param snapshot_dir: directory to write snapshot into.
+    :return: path of the snapshot, or None if it could not be written.
+    """
+    snapshot_fp = snapshot_path(snapshot_dir, course, session, checksum)
+    # write to a temporary file first so that concurrent or interrupted runs never see a partial snapshot
+    fd, temp_fp = tempfile.mkstemp(dir=snapshot_dir, suffix=".tmp")
+    os.close(fd)
+    print("[INFO] saving database snapshot to {}".format(snapshot_fp))
+    subprocess.call('service mysql stop', shell=True)
+    res = subprocess.call('tar -cf {} -C {} .'.format(temp_fp, mysql_data_dir), shell=True)
+    subprocess.call('service mysql start', shell=True)
+    if res != 0:
+        print("[ERROR] saving database snapshot failed with result {}".format(res))
+        os.remove(temp_fp)
+        return None
+    os.replace(temp_fp, snapshot_fp)
+    prune_snapshots(snapshot_dir, course, session, keep=snapshot_fp)
+    return snapshot_fp
+
+
+def restore_snapshot(course, session, checksum, snapshot_dir, mysql_data_dir = MYSQL_DATA_DIR):
+    """
+    Restore the mySQL data directory from the snapshot of course and session keyed by checksum, if it exists, and (re)start mySQL.
+    The snapshot is extracted into an emptied data directory; if extraction fails, the previous contents are put back, so that the dumps can be loaded into a clean server instead.
+    :param checksum: snapshot key from dump_checksum().
+    :param snapshot_dir: directory to read snapshot from.
+    :return: True if the snapshot existed and was restored, otherwise False.
+    """
+    snapshot_fp = snapshot_path(snapshot_dir, course, session, checksum)
+    if not os.path.exists(snapshot_fp):
+        return False
+    print("[INFO] restoring database snapshot from {}".format(snapshot_fp))
+    subprocess.call('service mysql stop', shell=True)
+    backup_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(mysql_data_dir)))
+    for item in os.listdir(mysql_data_dir):
+        os.rename(os.path.join(mysql_data_dir, item), os.path.join(backup_dir, item))
+    res = subprocess.call('tar -xpf {} -C {} && chown -R mysql:mysql {}'.format(snapshot_fp, mysql_data_dir, mysql_data_dir), shell=True)
+    if res != 0:
+        print("[ERROR] restoring database snapshot failed with result {}; restoring previous data directory".format(res))
+        _empty_dir(mysql_data_dir)
+        for item in os.listdir(backup_dir):
+            os.rename(os.path.join(backup_dir, item), os.path.join(mysql_data_dir, item))
+    shutil.rmtree(backup_dir)
+    subprocess.call('service mysql start', shell=True)
+    return res == 0
+
+
+def prune_snapshots(snapshot_dir, course = None, session = None, keep = None):
+    """
+    Keep only the latest snapshot of each course and session in snapshot_dir (or only of course and session, if given), and remove any temporary files left by interrupted snapshots.
+    :param keep: optional path of a snapshot to keep, even if it is not the most recently modified of its course and session.
+    :return: list of paths removed.
+    """
+    snapshots = {}
+    removed = []
+    for f in os.listdir(snapshot_dir):
+        fp = os.path.join(snapshot_dir, f)
+        res = SNAPSHOT_FILE_REGEX.match(f)
+        if res is None:
+            if f.endswith(".tmp") and course is None:
+                removed.append(fp)
+            continue
+        if (course is None or res.group(1) == course) and (session is None or res.group(2) == session):
+            snapshots.setdefault((res.group(1), res.group(2)), []).append(fp)
+    for fps in snapshots.values():
+        latest = keep if keep in fps else max(fps, key=os.path.getmtime)
+        removed.extend(fp for fp in fps if fp != latest)
+    for fp in removed:
+        print("[INFO] removing database snapshot {}".format(fp))
+        os.remove(fp)
+    return removed
+
+
+def initialize_and_load_sql_db(course, session, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Initialize the database and load all dumps for course and session. If snapshot_dir exists, a snapshot of the loaded
+    database is restored when one matches the dump contents, and written after loading otherwise; a snapshot is only
+    written if the database was created and every dump loaded successfully, so that a failed load is never reused.
+    :param course: course shortname.
+    :param session: 3-digit session id (string).
+    :param snapshot_dir: directory containing database snapshots; usually a volume mounted into the container.
+    :return: None
+    """
+    if not os.path.isdir(snapshot_dir):
+        initialize_sql_db()
+        load_sql_dumps(course, session)
+        return
     sql_dir = '/input/{}/{}/'.format(course, session)
-    sql_files = [x for x in os.listdir(sql_dir) if re.search('\.sql$', x)]
-    for file in sql_files:
-        load_sql_dump(file, course, session)
+    checksum = dump_checksum([os.path.join(sql_dir, x) for x in list_sql_dumps(course, session)])
+    if restore_snapshot(course, session, checksum, snapshot_dir):
+        return
+    created = initialize_sql_db() == 0
+    loaded = load_sql_dumps(course, session)
+    if created and loaded:
+        save_snapshot(course, session, checksum, snapshot_dir)
+    else:
+        print("[WARNING] not writing database snapshot for {} {}; database was not loaded successfully".format(course, session))
     return
 
 
@@ -89,3 +275,79 @@ def extract_quiz_csv_from_sql(course, session, outdir):
     query = """SELECT 'id', 'parent_id', 'open_time', 'soft_close_time', 'hard_close_time', 'maximum_submissions', 'duration', 'quiz_type', 'proctoring_requirement', 'authentication_required', 'deleted', 'last_updated' UNION ALL SELECT * FROM (SELECT id, parent_id, open_time, soft_close_time, hard_close_time, maximum_submissions, duration, quiz_type, proctoring_requirement, authentication_required, deleted, last_updated FROM quiz_metadata WHERE parent_id = -1 AND open_time IS NOT NULL AND deleted = 0) AS temp2 """
     execute_mysql_query_into_csv(query, os.path.join(outdir, quiz_meta_csvname))
     return
+
+
+def sql_week_expr(timestamp_col, course_start, course_end):
+    """
+    Build a SQL expression for the (zero-indexed) course week of a column of UTC timestamps in seconds. This matches
+    extraction_utils.timestamp_week(): NULL before the course start, and timestamps after the course end fall into the final week.
+    :param timestamp_col: name of timestamp column (seconds since epoch).
+    :param course_start: datetime object for first day of course.
+    :param course_end: datetime object for last day of course.
+    :return: SQL expression (string).
+    """
+    n_weeks = course_len(course_start, course_end)
+    if n_weeks < 1:
+        return "NULL"
+    start = calendar.timegm(course_start.timetuple())
+    return "(CASE WHEN {col} > {start} THEN LEAST(CEIL(({col} - {start}) / {week}), {n_weeks}) - 1 END)".format(
+        col=timestamp_col, start=start, week=SECONDS_IN_WEEK, n_weeks=n_weeks)
+
+
+# length of post_text as computed by gen_forum_features() from the exported text: mysql writes NULL as \N (2 characters)
+# and escapes tabs, newlines and backslashes with a backslash, and pd.read_csv() reads an empty field as NaN, i.e. 'nan'
+SQL_POST_LEN_CHAR = "CASE WHEN post_text IS NULL THEN 2 WHEN post_text = '' THEN 3 ELSE CHAR_LENGTH(post_text) + {} END".format(
+    " + ".join("(CHAR_LENGTH(post_text) - CHAR_LENGTH(REPLACE(post_text, CHAR({} USING utf8), '')))".format(c) for c in (9, 10, 92)))
+
+
+def extract_forum_aggregates_csv_from_sql(course, session, course_start, course_end, outdir='/output'):
+    """
+    Execute queries to generate discussion forum CSVs, computing count and sum features per user-week in the database.
+    Writes the user-week aggregates (num_posts, week_post_len_char, votes_net) and a reduced text export with only the
+    columns needed for thread-level and NLP features, with week already assigned. Post lengths are counted as in the
+    exported text read by forum_feature_extractor.gen_forum_features() (see SQL_POST_LEN_CHAR).
+    :return:
+    """
+    week = sql_week_expr('post_time', course_start, course_end)
+    posts = """SELECT a.thread_id, a.post_time, a.votes, REPLACE(a.post_text, '\\"', '') AS post_text, b.session_user_id FROM forum_posts AS a LEFT JOIN hash_mapping AS b ON a.user_id = b.user_id WHERE a.is_spam != 1 UNION ALL SELECT a.thread_id, a.post_time, a.votes, REPLACE(a.comment_text, '\\"', '') AS post_text, b.session_user_id FROM forum_comments AS a LEFT JOIN hash_mapping AS b ON a.user_id = b.user_id WHERE a.is_spam != 1"""
+    # per user-week aggregates
+    csvname = '{}_{}_forum_aggregates.csv'.format(course, session)
+    query = """SELECT 'session_user_id', 'week', 'week_post_len_char', 'num_posts', 'votes_net' UNION ALL SELECT * FROM (SELECT session_user_id, week, SUM({post_len}), COUNT(*), IFNULL(SUM(votes), 0) FROM (SELECT session_user_id, post_text, votes, {week} AS week FROM ({posts}) AS temp1) AS temp2 WHERE session_user_id IS NOT NULL AND week IS NOT NULL GROUP BY session_user_id, week) AS temp3 """.format(week=week, posts=posts, post_len=SQL_POST_LEN_CHAR)
+    execute_mysql_query_into_csv(query, os.path.join(outdir, csvname))
+    # text, for features which cannot be computed in the database
+    csvname = '{}_{}_forum_text.csv'.format(course, session)
+    query = """SELECT 'thread_id', 'post_time', 'session_user_id', 'post_text', 'week' UNION ALL SELECT * FROM (SELECT thread_id, post_time, session_user_id, post_text, {week} AS week FROM ({posts}) AS temp1 ORDER BY post_time) AS temp2 """.format(week=week, posts=posts)
+    execute_mysql_query_into_csv(query, os.path.join(outdir, csvname))
+    return
+
+
+def extract_quiz_aggregates_csv_from_sql(course, session, course_start, course_end, outdir):
+    """
+    Execute queries to generate quiz CSVs, computing submission counts, raw point sums, and pre-deadline submission bin
+    counts per user, assignment week, and quiz type in the database instead of exporting every submission.
+    Groups are kept for every valid assignment week, but only submissions in a valid submission week are counted, so
+    the rows with n_submissions = 0 still determine the number of course weeks as in gen_quiz_features().
+    :return:
+    """
+    quiz_csvname = '{}_{}_quiz_aggregates.csv'.format(course, session)
+    quiz_meta_csvname = '{}_{}_quiz_metadata.csv'.format(course, session)
+    counted = "submission_week IS NOT NULL"
+    bin_exprs = []
+    for label, lower, upper in PRE_DL_SUBMISSION_BINS:
+        # bins are closed on the right, as in pd.cut()
+        conditions = [counted]
+        if lower is not None:
+            conditions.append("pre_dl_submission_time > {}".format(lower))
+        if upper is not None:
+            conditions.append("pre_dl_submission_time <= {}".format(upper))
+        bin_exprs.append("IFNULL(SUM({}), 0)".format(" AND ".join(conditions)))
+    header = ", ".join("'{}'".format(x) for x in ['session_user_id', 'assignment_week', 'quiz_type', 'n_submissions', 'n_scored', 'sum_raw_score'] + [x[0] for x in PRE_DL_SUBMISSION_BINS])
+    query = """SELECT {header} UNION ALL SELECT * FROM (SELECT session_user_id, assignment_week, quiz_type, IFNULL(SUM({counted}), 0), COUNT(CASE WHEN {counted} THEN raw_score END), IFNULL(SUM(CASE WHEN {counted} THEN raw_score END), 0), {bins} FROM (SELECT a.session_user_id, a.raw_score, b.quiz_type, b.soft_close_time - a.submission_time AS pre_dl_submission_time, {submission_week} AS submission_week, {assignment_week} AS assignment_week FROM quiz_submission_metadata as a JOIN quiz_metadata as b on a.item_id = b.id where parent_id = -1 AND grading_error = 0) AS temp1 WHERE assignment_week IS NOT NULL GROUP BY session_user_id, assignment_week, quiz_type) AS temp2 """.format(
+        header=header, counted=counted, bins=", ".join(bin_exprs),
+        submission_week=sql_week_expr('a.submission_time', course_start, course_end),
+        assignment_week=sql_week_expr('b.soft_close_time', course_start, course_end))
+    execute_mysql_query_into_csv(query, os.path.join(outdir, quiz_csvname))
+    # quiz meta
+    query = """SELECT 'id', 'parent_id', 'open_time', 'soft_close_time', 'hard_close_time', 'maximum_submissions', 'duration', 'quiz_type', 'proctoring_requirement', 'authentication_required', 'deleted', 'last_updated' UNION ALL SELECT * FROM (SELECT id, parent_id, open_time, soft_close_time, hard_close_time, maximum_submissions, duration, quiz_type, proctoring_requirement, authentication_required, deleted, last_updated FROM quiz_metadata WHERE parent_id = -1 AND open_time IS NOT NULL AND deleted = 0) AS temp2 """
+    execute_mysql_query_into_csv(query, os.path.join(outdir, quiz_meta_csvname))
+    return
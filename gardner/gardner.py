@@ -14,13 +14,21 @@ if __name__ == "__main__":
     parser.add_argument("-r", "--session", required=False, help="3-digit course run number")
     parser.add_argument("-m", "--mode", required=True, help="mode to run image in; {extract, train, test}")
     parser.add_argument("--model_type", required = True, help="type of model to use for training/testing")
+    parser.add_argument("--sql_aggregates", action="store_true", help="in extract mode, compute quiz and forum count/sum aggregates in mySQL")
+    parser.add_argument("--in_memory", action="store_true", help="in extract mode, pass features between extractors in memory and write only the merged feature file")
+    parser.add_argument("--feature_matrix", action="store_true", help="in extract mode, also write the merged features as a memory-mappable float32 matrix")
+    parser.add_argument("--output_format", default="csv", choices=["csv", "parquet", "feather"], help="in extract mode, format of feature files; parquet and feather (Arrow IPC) require pyarrow")
 
     args = parser.parse_args()
     if args.mode == "extract":
         from extraction.extract_features import main as extract_features
-        from extraction.extraction_utils import aggregate_and_remove_feature_files
-        extract_features(args.course, args.session)
-        aggregate_and_remove_feature_files(input_dir="/output", match_substring="feats")
+        from extraction.extraction_utils import aggregate_and_remove_feature_files, aggregate_feature_dfs
+        if args.in_memory:
+            feature_dfs = extract_features(args.course, args.session, sql_aggregates=args.sql_aggregates, in_memory=True)
+            aggregate_feature_dfs(feature_dfs, output_dir="/output", output_format=args.output_format, write_matrix=args.feature_matrix)
+        else:
+            extract_features(args.course, args.session, sql_aggregates=args.sql_aggregates, output_format=args.output_format)
+            aggregate_and_remove_feature_files(input_dir="/output", match_substring="feats", output_format=args.output_format, write_matrix=args.feature_matrix)
     elif args.mode == "train":
         cmd = "Rscript modeling/train.R --course {} --input_dir /input --output_dir /output --model_type {}".format(args.course, args.model_type)
         subprocess.call(cmd, shell=True)
@@ -5,9 +5,27 @@ import re
 import tarfile
 import tempfile
 import configparser
+import hashlib
+import threading
+import errno
+import time
+import shlex
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 from utils.model_evaluation import calculate_simple_average, make_pub_simple_avg_df, generate_frequentist_comparison, generate_posterior_comparison
 
 _properties = None
+IMAGE_CACHE_REPOSITORY = "slicing-analysis-cache"  # loaded images are tagged <repository>:<tarball digest>
+_owned_images = {}  # tarball digest -> image tag, for images this process loaded with docker load (and so removes in cleanup_images())
+_file_digests = {}  # (path, size, mtime) -> sha256 of file contents
+_image_lock = threading.Lock()
+PIPELINE_MANIFEST_FILENAME = ".pipeline_manifest.json"  # written to proc_data_dir unless a manifest_fp is given
+_pipeline_manifest_lock = threading.Lock()
+# suffixes of the dense feature matrix files written by the extraction image; must match extraction.extraction_utils
+FEATURE_MATRIX_SUFFIX = "_matrix.npy"
+FEATURE_MATRIX_ROWS_SUFFIX = "_rows.txt"
+FEATURE_MATRIX_COLUMNS_SUFFIX = "_columns.txt"
 
 def get_properties(config_file = "config.properties"):
     '''
@@ -42,68 +60,406 @@ def fetch_courses_and_sessions(dir):
     return outlist
 
 
+def link_or_copy(src, dest):
+    """
+    Hardlink src to dest, falling back to a copy when they are on different filesystems.
+    :return: dest
+    """
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        print("[WARNING] cannot hardlink {} ({}); copying instead".format(src, e))
+        shutil.copy2(src, dest)
+    return dest
+
+
+def stage_session_inputs(source_data_dir, session_data_dir, extra_files = ()):
+    """
+    Present the files in source_data_dir, plus extra_files, in session_data_dir with special characters removed from their names, without copying any data.
+    Files are hardlinked rather than symlinked because symlinks to paths outside the mounted volume do not resolve inside a container; the staged directory should therefore be mounted read-only.
+    :param source_data_dir: directory containing raw data for a session.
+    :param session_data_dir: staging directory to create.
+    :param extra_files: additional file paths to stage alongside the session data (i.e., course dates file).
+    :return: None
+    """
+    os.makedirs(session_data_dir)
+    sources = [os.path.join(source_data_dir, f) for f in os.listdir(source_data_dir)] + list(extra_files)
+    for src in sources:
+        # remove bad characters from filename
+        dest = os.path.join(session_data_dir, re.sub('[\s\(\)":!&]', "", os.path.basename(src)))
+        if os.path.isdir(src):
+            shutil.copytree(src, dest, copy_function=link_or_copy)
+        else:
+            link_or_copy(src, dest)
+    return
+
+
+def feature_matrix_dir(proc_data_dir, course, session):
+    return os.path.join(proc_data_dir, "matrices", course, session)
+
+
+def collect_feature_matrix(output_dir, proc_data_dir, course, session, stem = "feats"):
+    """
+    Move the dense feature matrix and its index files (if the extraction image wrote them) out of output_dir into feature_matrix_dir(), so they are stored uncompressed and can be memory-mapped instead of being packed into the session tarfile.
+    :return: None
+    """
+    filenames = [stem + x for x in (FEATURE_MATRIX_SUFFIX, FEATURE_MATRIX_ROWS_SUFFIX, FEATURE_MATRIX_COLUMNS_SUFFIX)]
+    if not all(os.path.exists(os.path.join(output_dir, f)) for f in filenames):
+        return
+    dest_dir = feature_matrix_dir(proc_data_dir, course, session)
+    os.makedirs(dest_dir, exist_ok = True)
+    for f in filenames:
+        shutil.move(os.path.join(output_dir, f), os.path.join(dest_dir, f))
+    return
+
+
+def open_feature_matrix(proc_data_dir, course, session, stem = "feats"):
+    """
+    Open the dense feature matrix for course and session without reading it into memory. The matrix is a read-only memory map, so several processes fitting models on the same session share one page-cached copy.
+    :return: tuple of (np.memmap of float32 features with one row per user, list of user ids, list of feature names).
+    """
+    matrix_dir = feature_matrix_dir(proc_data_dir, course, session)
+    matrix = np.load(os.path.join(matrix_dir, stem + FEATURE_MATRIX_SUFFIX), mmap_mode = "r")
+    with open(os.path.join(matrix_dir, stem + FEATURE_MATRIX_ROWS_SUFFIX)) as f:
+        user_ids = f.read().splitlines()
+    with open(os.path.join(matrix_dir, stem + FEATURE_MATRIX_COLUMNS_SUFFIX)) as f:
+        feature_names = f.read().splitlines()
+    assert matrix.shape == (len(user_ids), len(feature_names))
+    return matrix, user_ids, feature_names
+
+
 def make_tarfile(course, session, source_dir, dest_dir):
     tarname = "{}-{}-data.tar".format(course, session)
     with tarfile.open(tarname, "w") as tar:
         tar.add(source_dir, arcname=os.path.basename(source_dir))
-    shutil.move(tarname, dest_dir)
+    # move to an explicit path so output from an earlier (stale) run is replaced
+    shutil.move(tarname, os.path.join(dest_dir, tarname))
     return
 
 
-def load_run_cleanup_image(course, session, working_data_dir, output_dir, image_url, docker_exec):
-    # load image
-    image_name = image_url.split('/')[-1]
+def file_digest(fp, block_size = 2**20):
+    """
+    Compute the sha256 digest of the contents of fp. Digests are memoized by path, size and modification time, so large image tarballs are only read once per process.
+    :param fp: path to file.
+    :return: hex digest (string).
+    """
+    stat = os.stat(fp)
+    key = (os.path.abspath(fp), stat.st_size, stat.st_mtime)
+    if key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(fp, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                digest.update(block)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+def load_image(image_url, docker_exec):
+    """
+    Load the docker image tarball at image_url, unless it is already loaded on this host. Images are tagged with the digest of their tarball, so a tarball is loaded once per host and reused by every session (and every process) until it is evicted.
+    The host is checked on every call, since another process may have removed the image.
+    :param image_url: path to image tarball.
+    :param docker_exec: path to docker executable.
+    :return: tag of the loaded image.
+    """
+    digest = file_digest(image_url)
+    image_tag = "{}:{}".format(IMAGE_CACHE_REPOSITORY, digest)
+    with _image_lock:
+        res = subprocess.check_output('{} images -q {}'.format(docker_exec, image_tag), shell=True)
+        if not res.strip():
+            print("[INFO] loading image {}".format(image_url))
+            res = subprocess.check_output('{} load -i {}'.format(docker_exec, image_url), shell=True)
+            print(str(res))
+            res = res.decode("utf-8").strip()
+            if 'sha256:' in res:
+                image_ref = res.split('sha256:')[-1]
+            else:  # tarball was saved from a named image; output is "Loaded image: <name>"
+                image_ref = res.split('Loaded image:')[-1].strip()
+            subprocess.check_output('{} tag {} {}'.format(docker_exec, image_ref, image_tag), shell=True)
+            _owned_images[digest] = image_tag
+        else:
+            print("[INFO] using cached image {}".format(image_tag))
+    return image_tag
+
+
+def evict_image(image_url, docker_exec):
+    """
+    Remove the cached image for the tarball at image_url from the host.
+    :param image_url: path to image tarball.
+    :param docker_exec: path to docker executable.
+    :return: None
+    """
+    digest = file_digest(image_url)
+    image_tag = "{}:{}".format(IMAGE_CACHE_REPOSITORY, digest)
+    with _image_lock:
+        cmd = '{} rmi --force {}'.format(docker_exec, image_tag)
+        print("running {}".format(cmd))
+        subprocess.call(cmd, shell=True)
+        _owned_images.pop(digest, None)
+    return
+
+
+def cleanup_images(docker_exec):
+    """
+    Remove every image this process loaded itself; call at the end of a batch of sessions. Images found already cached on the host may be in use by other processes, and are left in place.
+    :param docker_exec: path to docker executable.
+    :return: None
+    """
+    with _image_lock:
+        for image_tag in _owned_images.values():
+            cmd = '{} rmi --force {}'.format(docker_exec, image_tag)
+            print("running {}".format(cmd))
+            subprocess.call(cmd, shell=True)
+        _owned_images.clear()
+    return
+
+
+def read_pipeline_manifest(manifest_fp):
+    """
+    Read the pipeline manifest, which records the inputs, code version and output of each completed (course, session, stage).
+    :param manifest_fp: path to manifest json file.
+    :return: dict with keys "stages" (mapping "course/session/stage" to an entry) and "digests" (content digests of input files by path).
+    """
+    if not os.path.exists(manifest_fp):
+        return {"stages": {}, "digests": {}}
+    with open(manifest_fp) as f:
+        return json.load(f)
+
+
+def update_pipeline_manifest(manifest_fp, course, session, stage, status, input_hash = None, code_version = None, output = None, digests = None):
+    """
+    Record the status of a stage in the manifest, along with any newly computed content digests. The manifest is rewritten atomically so that a crashed sweep leaves it readable.
+    :param status: one of "running", "complete", "failed".
+    :return: None
+    """
+    with _pipeline_manifest_lock:
+        manifest = read_pipeline_manifest(manifest_fp)
+        manifest["stages"]["{}/{}/{}".format(course, session, stage)] = {"status": status, "input_hash": input_hash, "code_version": code_version, "output": output, "updated": time.time()}
+        if digests:
+            manifest["digests"].update(digests)
+        temp_fp = "{}.{}.tmp".format(manifest_fp, threading.get_ident())
+        with open(temp_fp, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(temp_fp, manifest_fp)
+    return
+
+
+def stage_is_current(manifest, course, session, stage, input_hash, code_version):
+    """
+    Check whether stage completed for course and session with the same inputs and code version, and its output (a path, or a list of paths) still exists.
+    """
+    entry = manifest["stages"].get("{}/{}/{}".format(course, session, stage))
+    if entry is None or entry["status"] != "complete" or entry["input_hash"] != input_hash or entry["code_version"] != code_version:
+        return False
+    outputs = entry["output"] if isinstance(entry["output"], list) else [entry["output"]]
+    return len(outputs) > 0 and all(x is not None and os.path.exists(x) for x in outputs)
+
+
+def content_digest(fp, manifest):
+    """
+    Compute the sha256 digest of the contents of fp, reusing the digest stored in manifest if the file's size and modification time are unchanged; new digests are added to manifest["digests"].
+    :return: hex digest (string).
+    """
+    stat = os.stat(fp)
+    key = os.path.abspath(fp)
+    cached = manifest["digests"].get(key)
+    if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+        return cached[2]
+    digest = file_digest(fp)
+    manifest["digests"][key] = [stat.st_size, stat.st_mtime, digest]
+    return digest
+
+
+def inputs_digest(paths, manifest):
+    """
+    Compute a single digest over the names and contents of every file in paths (files, or directories which are searched recursively).
+    :param paths: list of file or directory paths.
+    :param manifest: manifest from read_pipeline_manifest(), used to memoize per-file digests.
+    :return: hex digest (string).
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        root = os.path.dirname(os.path.abspath(path))
+        if os.path.isdir(path):
+            files = sorted(os.path.join(dirpath, f) for dirpath, _, filenames in os.walk(path) for f in filenames)
+        else:
+            files = [path]
+        for fp in files:
+            digest.update(os.path.relpath(os.path.abspath(fp), root).encode("utf-8"))
+            digest.update(content_digest(fp, manifest).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def parse_memory_limit(memory):
+    """
+    Convert a memory limit in docker notation (i.e., 8g, 512m, or a number of bytes) to bytes.
+    :param memory: string or int.
+    :return: limit in bytes (int), or None if memory is None.
+    """
+    if memory is None:
+        return None
+    units = {"b": 1, "k": 2**10, "m": 2**20, "g": 2**30}
+    memory = str(memory).strip().lower()
+    if memory[-1] in units:
+        return int(float(memory[:-1]) * units[memory[-1]])
+    return int(memory)
+
+
+def load_run_cleanup_image(course, session, working_data_dir, output_dir, image_url, docker_exec, snapshot_dir = None, evict = False, cpus = None, memory = None, feature_store_dir = None, image_args = ()):
+    """
+    Run the image in tarball image_url on data for course and session. The image is loaded only if it is not already cached on the host, and is kept for later sessions unless evict is True.
+    :param cpus: optional limit on the number of CPUs available to the container (docker --cpus).
+    :param memory: optional limit on container memory, i.e. 8g (docker --memory).
+    :param feature_store_dir: optional directory mounted at /feature_store, where the image writes user-week features for every session (see extraction.feature_store).
+    :param image_args: additional command-line flags passed to the image, i.e. ["--feature_matrix"].
+    :return: None
+    """
     print("extracting features for course {} session {}".format(course, session))
-    cmd = '{} load -i {}'.format(docker_exec, image_name)
-    res = subprocess.check_output(cmd, shell=True)
-    print(str(res))
-    image_uuid = str(res).split('sha256:')[-1].replace("\\n", "").replace("'", "")
-    # run image
-    cmd = '''{} run --rm=true --volume={}:/input --volume={}:/output {} --course_id {} --run_number {}'''.format(
-        docker_exec, working_data_dir, output_dir, image_uuid, course, session)
+    image_tag = load_image(image_url, docker_exec)
+    # run image; if snapshot_dir is given it is mounted so loaded databases can be reused across runs
+    extra_volumes = "--volume={}:/snapshots ".format(snapshot_dir) if snapshot_dir else ""
+    if feature_store_dir:
+        extra_volumes += "--volume={}:/feature_store ".format(os.path.abspath(feature_store_dir))
+    limits = ""
+    if cpus:
+        limits += "--cpus={} ".format(cpus)
+    if memory:
+        limits += "--memory={} ".format(memory)
+    cmd = '''{} run --rm=true {}--volume={}:/input:ro --volume={}:/output {}{} --course_id {} --run_number {}'''.format(
+        docker_exec, limits, working_data_dir, output_dir, extra_volumes, image_tag, course, session)
+    for arg in image_args:
+        cmd += " {}".format(arg)
     print("running {}".format(cmd))
     res = subprocess.check_output(cmd, shell=True)
-    # cleanup
-    cmd = '''{} rmi --force {}'''.format(docker_exec, image_uuid)
-    print("running {}".format(cmd))
-    res = subprocess.check_output(cmd, shell=True)
-    print("result: {}".format(res))
+    if evict:
+        evict_image(image_url, docker_exec)
     return
 
 
-def run_extraction_image(dir, course, session, data_dir, proc_data_dir, docker_exec = get_properties()['docker_exec'], image_url = get_properties()['extraction_image']):
-    with tempfile.TemporaryDirectory(dir=dir) as working_dir:
-        output_dir = os.path.join(working_dir, 'output')
-        os.makedirs(output_dir)
-        print("[INFO] initializing docker image and data course {} session {}".format(course, session))
-        shutil.copy(image_url, working_dir)
-        source_data_dir = os.path.join(data_dir, course, session)
-        working_data_dir = working_dir + '/input'
-        session_data_dir = os.path.join(working_data_dir, course, session)
-        shutil.copytree(source_data_dir, session_data_dir)
-        # move files into course data dir; unzip all of the sql files
-        for f in os.listdir(session_data_dir):
-            fp_raw = os.path.join(session_data_dir, f)
-            fp = re.sub('[\s\(\)":!&]', "", fp_raw)
-            # remove bad characters from filename
-            shutil.move(fp_raw, fp)
-        datefile = 'coursera_course_dates.csv'
-        shutil.copy(os.path.join(data_dir, datefile), os.path.join(session_data_dir, datefile))
-        unzip_sql_cmd = """for i in `find {} -name "*.sql.gz"`; do gunzip "$i" ; done""".format(session_data_dir)
-        subprocess.call(unzip_sql_cmd, shell=True, stdout=open(os.devnull, 'wb'), stderr=open(os.devnull, 'wb'))
-        load_run_cleanup_image(course, session, working_data_dir, output_dir, image_url, docker_exec)
-        make_tarfile(course, session, output_dir, proc_data_dir)
+def run_extraction_image(dir, course, session, data_dir, proc_data_dir, docker_exec = get_properties()['docker_exec'], image_url = get_properties()['extraction_image'], snapshot_dir = get_properties().get('snapshot_dir'), cpus = None, memory = None, manifest_fp = None, force = False, feature_store_dir = get_properties().get('feature_store_dir'), feature_matrix = False, in_memory = False, sql_aggregates = False, output_format = "csv"):
+    """
+    Extract features for course and session, writing a tarfile of the output to proc_data_dir. Extraction is skipped if the manifest shows it already completed with the same session data, image, and options, unless force is True.
+    :param manifest_fp: path to pipeline manifest; defaults to PIPELINE_MANIFEST_FILENAME in proc_data_dir.
+    :param feature_matrix: if True, the image also writes a dense feature matrix, which is kept uncompressed in feature_matrix_dir() (see open_feature_matrix()).
+    :param in_memory: if True, the image passes features between extractors in memory.
+    :param sql_aggregates: if True, the image computes quiz and forum aggregates in mySQL.
+    :param output_format: format of feature files written by the image; one of csv, parquet, feather.
+    :return: None
+    """
+    image_args = ["--output_format", output_format]
+    for flag, value in (("--feature_matrix", feature_matrix), ("--in_memory", in_memory), ("--sql_aggregates", sql_aggregates)):
+        if value:
+            image_args.append(flag)
+    manifest_fp = manifest_fp or os.path.join(proc_data_dir, PIPELINE_MANIFEST_FILENAME)
+    source_data_dir = os.path.join(data_dir, course, session)
+    datefile = 'coursera_course_dates.csv'
+    datefile_fp = os.path.join(data_dir, datefile)
+    output_fp = os.path.join(proc_data_dir, "{}-{}-data.tar".format(course, session))
+    manifest = read_pipeline_manifest(manifest_fp)
+    input_hash = inputs_digest([source_data_dir, datefile_fp], manifest)
+    code_version = hashlib.sha256((content_digest(image_url, manifest) + " ".join(image_args)).encode("utf-8")).hexdigest()
+    if not force and stage_is_current(manifest, course, session, "extract", input_hash, code_version):
+        print("[INFO] extraction up to date for course {} session {}; skipping".format(course, session))
+        return
+    update_pipeline_manifest(manifest_fp, course, session, "extract", "running", input_hash, code_version, output_fp, manifest["digests"])
+    try:
+        with tempfile.TemporaryDirectory(dir=dir) as working_dir:
+            output_dir = os.path.join(working_dir, 'output')
+            os.makedirs(output_dir)
+            print("[INFO] initializing data course {} session {}".format(course, session))
+            working_data_dir = working_dir + '/input'
+            session_data_dir = os.path.join(working_data_dir, course, session)
+            # link files into course data dir (mounted read-only); sql dumps stay compressed and are streamed into mySQL by the image
+            stage_session_inputs(source_data_dir, session_data_dir, extra_files = [datefile_fp])
+            load_run_cleanup_image(course, session, working_data_dir, output_dir, image_url, docker_exec, snapshot_dir = snapshot_dir, cpus = cpus, memory = memory, feature_store_dir = feature_store_dir, image_args = image_args)
+            collect_feature_matrix(output_dir, proc_data_dir, course, session)
+            make_tarfile(course, session, output_dir, proc_data_dir)
+    except Exception:
+        update_pipeline_manifest(manifest_fp, course, session, "extract", "failed", input_hash, code_version, output_fp)
+        raise
+    update_pipeline_manifest(manifest_fp, course, session, "extract", "complete", input_hash, code_version, output_fp)
     return
 
 
-def run_modeling_job(dir, course, session, proc_data_dir, modeling_script = "build_models.R", log_file = "modeling_log.txt"):
-    with tempfile.TemporaryDirectory(dir=dir) as working_dir:
-        output_dir = os.path.join(working_dir, 'output')
-        print("[INFO] initializing modeling data course {} session {}".format(course, session))
-        # initialize preprocessed data inside working_dir
-        tarname = "{}-{}-data.tar".format(course, session)
-        preprocessed_data_fp = os.path.join(proc_data_dir, tarname)
-        if os.path.exists(preprocessed_data_fp):
+_systemd_scope = {}  # memo of systemd_scope_available()
+
+
+def systemd_scope_available():
+    """
+    Check, once per process, that commands can be run in a transient systemd scope: systemd-run must exist, systemd must be running as the init system, and the user must be allowed to create scopes.
+    :return: True if a trivial command runs with systemd-run --scope, otherwise False.
+    """
+    if "available" not in _systemd_scope:
+        available = False
+        if shutil.which("systemd-run"):
+            with open(os.devnull, "w") as devnull:
+                available = subprocess.call(["systemd-run", "--scope", "--quiet", "true"], stdout=devnull, stderr=devnull) == 0
+        _systemd_scope["available"] = available
+    return _systemd_scope["available"]
+
+
+def limit_process_resources(cmd, cpus = None, memory = None):
+    """
+    Limit the shell command cmd to cpus threads and memory bytes of memory. Threads are limited through the BLAS/OpenMP environment variables; memory (and CPU time) through a transient systemd scope, i.e. a cgroup, which limits the memory actually used rather than the address space reserved by R and BLAS. If scopes cannot be created (see systemd_scope_available()), the command is run without a memory limit.
+    :param cmd: shell command.
+    :param cpus: number of threads for BLAS/OpenMP in the child process.
+    :param memory: memory limit in docker notation (i.e., 8g).
+    :return: tuple of (cmd, env), the command to run and its environment (None to inherit the current environment).
+    """
+    env = None
+    if cpus:
+        env = dict(os.environ)
+        n_threads = str(max(1, int(float(cpus))))
+        for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+            env[var] = n_threads
+    memory_bytes = parse_memory_limit(memory)
+    if memory_bytes:
+        if systemd_scope_available():
+            properties = "-p MemoryMax={} ".format(memory_bytes)
+            if cpus:
+                properties += "-p CPUQuota={}% ".format(int(float(cpus) * 100))
+            cmd = "systemd-run --scope --quiet {}-- sh -c {}".format(properties, shlex.quote(cmd))
+        else:
+            print("[WARNING] cannot run commands in a systemd scope; running without a memory limit: {}".format(cmd))
+    return cmd, env
+
+
+def run_modeling_job(dir, course, session, proc_data_dir, modeling_script = "build_models.R", log_file = "modeling_log.txt", cpus = None, memory = None, manifest_fp = None, force = False):
+    """
+    Run modeling_script on the extracted features for course and session. Modeling is skipped if the manifest shows it already completed with the same extracted features and R scripts, unless force is True.
+    The result files written by modeling_script are moved into results_dir and recorded in the manifest as the output of the stage.
+    :param manifest_fp: path to pipeline manifest; defaults to PIPELINE_MANIFEST_FILENAME in proc_data_dir.
+    :return: None
+    """
+    manifest_fp = manifest_fp or os.path.join(proc_data_dir, PIPELINE_MANIFEST_FILENAME)
+    tarname = "{}-{}-data.tar".format(course, session)
+    preprocessed_data_fp = os.path.join(proc_data_dir, tarname)
+    if not os.path.exists(preprocessed_data_fp):
+        msg = "[WARNING] no data exists for course {} session {}; skipping".format(course, session)
+        print(msg)
+        with open(os.path.join(dir, log_file), "a") as f:
+            f.write(msg + '\n')
+        return
+    modeling_dir = get_properties()['modeling_dir']
+    results_dir = get_properties()['results_dir']
+    r_scripts = sorted(os.path.join(modeling_dir, file) for file in os.listdir(modeling_dir) if file.endswith(".R"))
+    manifest = read_pipeline_manifest(manifest_fp)
+    input_hash = inputs_digest([preprocessed_data_fp], manifest)
+    code_version = hashlib.sha256((modeling_script + inputs_digest(r_scripts, manifest)).encode("utf-8")).hexdigest()
+    if not force and stage_is_current(manifest, course, session, "model", input_hash, code_version):
+        print("[INFO] modeling up to date for course {} session {}; skipping".format(course, session))
+        return
+    update_pipeline_manifest(manifest_fp, course, session, "model", "running", input_hash, code_version, None, manifest["digests"])
+    try:
+        with tempfile.TemporaryDirectory(dir=dir) as working_dir:
+            output_dir = os.path.join(working_dir, 'output')
+            # the script writes into a directory of its own, so the result files of this session are known exactly even when sessions run concurrently
+            session_results_dir = os.path.join(working_dir, 'results')
+            os.makedirs(session_results_dir)
+            print("[INFO] initializing modeling data course {} session {}".format(course, session))
+            # initialize preprocessed data inside working_dir
             shutil.copy(preprocessed_data_fp, working_dir)
             tar = tarfile.open(os.path.join(working_dir, tarname))
             tar.extractall(working_dir)
@@ -114,22 +470,88 @@ def run_modeling_job(dir, course, session, proc_data_dir, modeling_script = "bui
             # remove old 'outout' directory from tar file; if necessary, should be replaced with a new one (to erase any permissions)
             os.rmdir(output_dir)
             # copy R scripts into working_dir
-            modeling_dir = get_properties()['modeling_dir']
-            for file in os.listdir(modeling_dir):
-                if file.endswith(".R"):
-                    shutil.copy(os.path.join(modeling_dir, file), working_dir)
+            for file in r_scripts:
+                shutil.copy(file, working_dir)
             # run modeling script
             modeling_script_fp = os.path.join(working_dir, modeling_script)
-            cmd = "Rscript {} --course {} --session {} --working_dir {} --output_dir {}".format(modeling_script_fp, course, session, working_dir, get_properties()['results_dir'])
+            cmd = "Rscript {} --course {} --session {} --working_dir {} --output_dir {}".format(modeling_script_fp, course, session, working_dir, session_results_dir)
+            cmd, env = limit_process_resources(cmd, cpus, memory)
             print("[INFO] running {}".format(cmd))
-            subprocess.call(cmd, shell = True)
+            res = subprocess.call(cmd, shell = True, env = env)
+            if res != 0:
+                raise subprocess.CalledProcessError(res, cmd)
+            result_fps = move_result_files(session_results_dir, results_dir)
+            if not result_fps:
+                raise RuntimeError("{} wrote no results for course {} session {}".format(modeling_script, course, session))
             print("[INFO] modeling complete course {} session {}".format(course, session))
-        else:
-            msg = "[WARNING] no data exists for course {} session {}; skipping".format(course, session)
-            print(msg)
-            with open(os.path.join(dir, log_file), "a") as f:
-                f.write(msg + '\n')
-        return
+    except Exception:
+        update_pipeline_manifest(manifest_fp, course, session, "model", "failed", input_hash, code_version)
+        raise
+    update_pipeline_manifest(manifest_fp, course, session, "model", "complete", input_hash, code_version, result_fps)
+    return
+
+
+def move_result_files(src_dir, dest_dir):
+    """
+    Move every file in src_dir into dest_dir, keeping their paths relative to src_dir and replacing any existing files.
+    :return: sorted list of the paths of the files in dest_dir.
+    """
+    moved = []
+    for dirpath, _, filenames in os.walk(src_dir):
+        for f in filenames:
+            dest_fp = os.path.join(dest_dir, os.path.relpath(os.path.join(dirpath, f), src_dir))
+            os.makedirs(os.path.dirname(dest_fp), exist_ok=True)
+            shutil.move(os.path.join(dirpath, f), dest_fp)
+            moved.append(dest_fp)
+    return sorted(moved)
+
+
+def session_input_size(data_dir, course, session):
+    """
+    Total size in bytes of the files for course and session in data_dir (a raw data directory or a directory of preprocessed tarfiles).
+    """
+    session_dir = os.path.join(data_dir, course, session)
+    if not os.path.isdir(session_dir):
+        tar_fp = os.path.join(data_dir, "{}-{}-data.tar".format(course, session))
+        return os.path.getsize(tar_fp) if os.path.exists(tar_fp) else 0
+    size = 0
+    for dirpath, _, filenames in os.walk(session_dir):
+        for f in filenames:
+            size += os.path.getsize(os.path.join(dirpath, f))
+    return size
+
+
+def run_jobs(job, course_sessions, size_dir, max_jobs = int(get_properties().get('max_jobs', 1)), cpus = get_properties().get('job_cpus'), memory = get_properties().get('job_memory'), **kwargs):
+    """
+    Run job (i.e., run_extraction_image or run_modeling_job) for each course and session on a pool of up to max_jobs concurrent jobs. Each job runs its work in its own container or Rscript process, limited to cpus and memory.
+    Jobs are started largest-first by input size, so the biggest sessions do not end up running alone at the end of the sweep.
+    :param job: function called as job(course=course, session=session, cpus=cpus, memory=memory, **kwargs).
+    :param course_sessions: list of (course, session) tuples, i.e. from fetch_courses_and_sessions().
+    :param size_dir: directory used to estimate the size of each job; data_dir for extraction, proc_data_dir for modeling.
+    :param max_jobs: maximum number of concurrent jobs.
+    :param cpus: per-job CPU limit.
+    :param memory: per-job memory limit, i.e. 8g.
+    :return: list of (course, session, exception) tuples for jobs which failed.
+    """
+    course_sessions = sorted(course_sessions, key = lambda cs: session_input_size(size_dir, *cs), reverse = True)
+    n_jobs = len(course_sessions)
+    failed = []
+    start = time.time()
+    with ThreadPoolExecutor(max_workers = max_jobs) as executor:
+        futures = {executor.submit(job, course = course, session = session, cpus = cpus, memory = memory, **kwargs): (course, session)
+                   for course, session in course_sessions}
+        for i, future in enumerate(as_completed(futures), 1):
+            course, session = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print("[ERROR] job failed for course {} session {}: {}".format(course, session, e))
+                failed.append((course, session, e))
+            print("[INFO] completed {}/{} jobs ({} failed); course {} session {} finished after {:.0f}s".format(
+                i, n_jobs, len(failed), course, session, time.time() - start))
+    if _owned_images:
+        cleanup_images(kwargs.get('docker_exec', get_properties()['docker_exec']))
+    return failed
 
 
 def evaluate_results(methods = ['simple_average', 'frequentist', 'bayesian'], exp_results_dir = get_properties()['results_dir'], analysis_dir = get_properties()['analysis_dir'], summary_csvname = 'complete_comparison_results.csv'):
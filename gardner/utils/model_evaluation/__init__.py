@@ -1,36 +1,92 @@
 import pandas as pd
+import numpy as np
 import os
+import hashlib
+import numbers
 import Orange
 import matplotlib.pyplot as plt
-import itertools
-from utils.model_evaluation.bayesiantests import signtest, signtest_MC, plot_posterior
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from utils.model_evaluation.bayesiantests import signtest_pairs
 
-def read_experiment_data(dir, use_cols = ['ROC', 'Resample', 'model', 'feat_type', 'course', 'session', 'model_id'], drop_incompletes = True):
+RESULTS_CACHE_PREFIX = ".results_cache_"
+CATEGORICAL_COLS = ['model_id', 'course', 'Resample']
+POSTERIOR_CACHE_FILENAME = ".posterior_pairs_cache.csv"
+_experiment_data = {}  # consolidated results, by directory and cache key; shared by the report functions
+
+
+def _results_cache_key(dir, csv_files, use_cols):
+    """
+    Hash the listing, sizes, and modification times of the results files in dir, so that adding or changing any of them invalidates the cache.
+    """
+    h = hashlib.sha256()
+    h.update(repr(sorted(use_cols)).encode("utf-8"))
+    for f in csv_files:
+        stat = os.stat(os.path.join(dir, f))
+        h.update("{}:{}:{}\n".format(f, stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _results_cache_prefix(use_cols):
+    """
+    File name prefix of the results caches for use_cols; caches of other column sets are kept when the results files change.
+    """
+    return "{}{}_".format(RESULTS_CACHE_PREFIX, hashlib.sha256(repr(sorted(use_cols)).encode("utf-8")).hexdigest()[:16])
+
+
+def _read_results_file(resultsfile, use_cols):
+    df = pd.read_csv(resultsfile, usecols = lambda c: c in use_cols, dtype = {c: str for c in CATEGORICAL_COLS})
+    if not set(use_cols).issubset(df.columns):
+        print("error reading file {}".format(resultsfile))
+        return None
+    return df[use_cols]
+
+
+def read_experiment_data(dir, use_cols = ['ROC', 'Resample', 'model', 'feat_type', 'course', 'session', 'model_id'], drop_incompletes = True, max_workers = None):
     """
     Utility function to read and compile individual course/feature results into single dataframe.
+    Files are read in parallel, and the consolidated table is cached in dir as parquet (if pyarrow is available) and in memory, keyed by the listing and modification times of the results files; the in-memory result is shared between callers and must not be modified.
     :param dir:
-    :param outfile: just needed to check and make sure previous simple average results aren't read in as "new" data
+    :param use_cols: columns to read from each results file; files without all of them are skipped.
+    :param drop_incompletes: only keep courses and sessions with results for all models.
+    :param max_workers: number of files read at once.
     :return:
     """
-    results_df_list = []
-    for f in os.listdir(dir):
-        if f.endswith(".csv"):
-            resultsfile = os.path.join(dir, f)
-            df = pd.read_csv(resultsfile)
-            try:
-                results_df_list.append(df[use_cols])
-            except:
-                print("error reading file {}".format(resultsfile))
-    results_df = pd.concat(results_df_list, axis=0)
+    csv_files = sorted(f for f in os.listdir(dir) if f.endswith(".csv"))
+    key = _results_cache_key(dir, csv_files, use_cols)
+    memo_key = (os.path.abspath(dir), key, drop_incompletes)
+    if memo_key in _experiment_data:
+        return _experiment_data[memo_key]
+    cache_prefix = _results_cache_prefix(use_cols)
+    cache_fp = os.path.join(dir, cache_prefix + key + ".parquet")
+    results_df = None
+    if os.path.exists(cache_fp):
+        try:
+            results_df = pd.read_parquet(cache_fp)
+        except ImportError:
+            pass
+    if results_df is None:
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            results_df_list = [df for df in executor.map(partial(_read_results_file, use_cols = use_cols), [os.path.join(dir, f) for f in csv_files]) if df is not None]
+        results_df = pd.concat(results_df_list, axis=0, ignore_index=True)
+        for c in CATEGORICAL_COLS:
+            if c in results_df.columns:
+                results_df[c] = results_df[c].astype('category')
+        try:
+            for f in os.listdir(dir):  # remove caches of earlier listings with the same columns
+                if f.startswith(cache_prefix):
+                    os.remove(os.path.join(dir, f))
+            results_df.to_parquet(cache_fp, index = False)
+        except ImportError:
+            print("[WARNING] pyarrow is not installed; not caching experiment results")
     if drop_incompletes:
         # only keep courses and sessions where all models successfully trained/tested
-        course_obs = results_df.groupby(['course', 'session']).size()
+        course_obs = results_df.groupby(['course', 'session'], observed = True).size()
         max_cs_obs = course_obs.max()
         temp = results_df.merge(course_obs.reset_index().rename(columns={0: 'num_obs'}), on = ['course', 'session'])
         temp = temp[temp.num_obs == max_cs_obs].drop(['num_obs'], axis = 1)
         results_df = temp
+    _experiment_data[memo_key] = results_df
     return results_df
 
 
@@ -45,7 +101,7 @@ def calculate_simple_average(dir, outfile, avg_by = ['model_id'], avg_metric ='R
     :return:
     """
     results_df = read_experiment_data(dir)
-    simple_average_df = results_df.groupby(avg_by)[avg_metric].mean().reset_index().rename(columns = {avg_metric: 'simple_avg_' + avg_metric})
+    simple_average_df = results_df.groupby(avg_by, observed = True)[avg_metric].mean().reset_index().rename(columns = {avg_metric: 'simple_avg_' + avg_metric})
     simple_average_df.to_csv(outfile, header = True, index = False)
     return simple_average_df
 
@@ -68,18 +124,15 @@ def make_pub_simple_avg_df(df, dest_dir, csvname = "simple_avg_feats_pubversion.
 
 def compute_avg_ranks(df):
     """
-    :param df:
-    :return:
+    Rank models by ROC within each course, session and resample, and average the ranks across them.
+    :param df: pd.DataFrame from read_experiment_data(); not modified.
+    :return: pd.DataFrame of average rank (ROC_rank) indexed by model_id, in descending order of rank.
     """
-    df.drop(['feat_type', 'model'], inplace = True, axis = 1)
-    def generate_ranks(group):
-        frame=group
-        frame = frame.set_index(["model_id"])
-        rks = frame["ROC"].rank(ascending = False)
-        return(rks)
-    rank_df = df.groupby(['course', 'session', 'Resample']).apply(generate_ranks)
-    temp = pd.melt(rank_df.reset_index(), id_vars = ['course', 'session', 'Resample'], value_vars = df.model_id.unique().tolist()).rename(columns={'value':'rank'})
-    avg_ranks = temp.groupby(['model_id']).mean().rename(columns = {"rank": "ROC_rank"})
+    score_df = df.pivot(index=['course', 'session', 'Resample'], columns='model_id', values='ROC')
+    # models missing from a replicate are left unranked, and skipped in the average
+    rank_df = score_df.rank(axis = 1, ascending = False)
+    avg_ranks = rank_df.mean(axis = 0).rename("ROC_rank").to_frame()
+    avg_ranks.index = avg_ranks.index.astype(str).rename('model_id')
     return avg_ranks.sort_values("ROC_rank", ascending=False)
 
 
@@ -91,12 +144,16 @@ def output_cd_results(avranks_df, results_df, cd, outdir, csvname = 'nemenyi_avg
     :param outdir:
     :return:
     """
-    avresults_df = results_df.groupby(['model_id'])['ROC'].mean().reset_index().rename(columns = {'ROC':'avg_auc'})
-    avranks_df.reset_index(inplace=True)
-    avranks_df['join_key'] = '1'
-    avranks_df = avranks_df.merge(avresults_df, on = 'model_id')
-    diff_df = avranks_df.merge(avranks_df, on = 'join_key').drop(['join_key'], axis=1)
-    diff_df = diff_df[diff_df.model_id_x > diff_df.model_id_y]
+    avresults_df = results_df.groupby(['model_id'], observed = True)['ROC'].mean().rename('avg_auc')
+    avresults_df.index = avresults_df.index.astype(str)
+    models = np.asarray(avranks_df.index.tolist(), dtype=str)
+    ranks = avranks_df['ROC_rank'].to_numpy()
+    aucs = avresults_df.reindex(models).to_numpy()
+    # all pairs x, y with model_id_x > model_id_y, from broadcast comparisons of the model ids
+    x, y = np.nonzero(models[:, None] > models[None, :])
+    diff_df = pd.DataFrame({'model_id_x': models[x], 'ROC_rank_x': ranks[x], 'avg_auc_x': aucs[x],
+                            'model_id_y': models[y], 'ROC_rank_y': ranks[y], 'avg_auc_y': aucs[y]},
+                           columns = ['model_id_x', 'ROC_rank_x', 'avg_auc_x', 'model_id_y', 'ROC_rank_y', 'avg_auc_y'])
     diff_df['rank_x-rank_y'] = diff_df['ROC_rank_x'] - diff_df['ROC_rank_y']
     diff_df['avg_auc_x=avg_auc_y'] = diff_df['avg_auc_x'] - diff_df['avg_auc_y']
     diff_df['rank_x-rank_y_greater_cd_{}'.format(round(cd, 4))] = abs(diff_df['rank_x-rank_y']) > cd
@@ -141,60 +198,92 @@ def generate_frequentist_comparison(dir, outdir):
     return cd_results_df
 
 
-def posterior_compare_models(models, results_df, outdir, plot_thresh = 0.8):
+def build_score_matrix(results_df, metric = 'ROC'):
     """
-    Conduct a posterior comparison of models in results_df; only generate a posterior plot if at least one posterior probability is below plot_thresh.
-    :param models:
-    :param results_df:
-    :param outdir:
-    :param plot_thresh:
-    :return:
+    Build the (replicate x model) matrix of metric, with one row per course, session and resample.
+    :param results_df: pd.DataFrame from read_experiment_data().
+    :param metric: name of the column of results_df to compare models on.
+    :return: pd.DataFrame indexed by replicate id, with one column per model_id; NaN where a model has no result for a replicate.
+    """
+    temp = results_df[['course', 'session', 'Resample', 'model_id', metric]].copy()
+    temp['rep_id'] = temp["course"].astype(str) + temp["session"].astype(str) + temp["Resample"].astype(str)
+    return temp.pivot(index='rep_id', columns='model_id', values=metric)
+
+
+def _score_column_hash(score_df, model):
     """
-    print('Conducting comparison for {0}'.format(models))
-    temp = results_df[results_df['model_id'].isin(models)][['course', 'session', 'Resample', 'model_id', 'ROC']]
-    temp['rep_id'] = temp["course"] + temp["session"].map(str) + temp["Resample"]
-    temp = temp.pivot(index='rep_id', columns='model_id', values='ROC')
-    scores = temp.loc[:, models].as_matrix()
-    left, within, right = signtest(scores, rope=0.01)
-    # The first value (left) is the probability that the first classifier (the left column of x) has a higher score than the second (or that the differences are negative, if x is given as a vector).
-    # If we add arguments verbose and names, the function also prints out the probabilities.
-    left, within, right = signtest(scores, rope=0.01, verbose=True, names=models)
-    ## The posterior distribution can be plotted out:
-    ## using the function signtest_MC(x, rope, prior_strength=1, prior_place=ROPE, nsamples=50000) we generate the samples of the posterior
-    ## using the function plot_posterior(samples,names=('C1', 'C2')) we then plot the posterior in the probability simplex
-    # if sum(x < plot_thresh for x in [left, within, right]) > 0:  # don't create plots when there is a clear decision
-    #     try:
-    #         samples = signtest_MC(scores, rope=0.01)
-    #         fig = plot_posterior(samples, models)
-    #         # NOTE that in order to get positioning on plots right, I adjusted these lines in bayesiantests:
-    #         # fig.gca().set_xlim(-0.5, 1.5)
-    #         # fig.gca().set_ylim(-0.5, 1.5)
-    #         png_name = '{0}_{1}_posterior_plot.png'.format(models[0], models[1])
-    #         fig.savefig(os.path.join(outdir, png_name), pad_inches=0.25)
-    #     except:
-    #         print("[WARINING] exception when writing posterior plot for {}".format(models))
-    #         pass
-    return [models[0], models[1], left, within, right]
-
-
-def generate_posterior_comparison(dir, outdir, outfile = "posterior_results.csv"):
+    Hash the replicate ids and scores of one model, so that cached comparisons are invalidated when its results change.
+    """
+    col = score_df[model]
+    h = hashlib.sha256()
+    h.update("\n".join(str(x) for x in score_df.index).encode("utf-8"))
+    h.update(np.ascontiguousarray(col.to_numpy(dtype=float)).tobytes())
+    return h.hexdigest()
+
+
+def _pair_cache_key(model_1, model_2, hash_1, hash_2, settings):
+    return hashlib.sha256(repr((model_1, model_2, hash_1, hash_2, settings)).encode("utf-8")).hexdigest()
+
+
+def _pair_seed(random_state, model_1, model_2):
+    """
+    Seed for the posterior samples of one pair of models, derived from random_state and the pair, so that a pair gets the same samples whichever other pairs are computed with it.
+    """
+    pair_hash = hashlib.sha256(repr((model_1, model_2)).encode("utf-8")).hexdigest()
+    return np.random.SeedSequence(random_state, spawn_key=(int(pair_hash[:16], 16),))
+
+
+def generate_posterior_comparison(dir, outdir, outfile = "posterior_results.csv", random_state = None, verbose = True, rope = 0.01, nsamples = 50000, use_cache = True):
     """
     Generate output file with tripartite posterior probability estimates, and average AUC.
+    The (replicate x model) score matrix is built once, and the sign test is run for all pairs of models in a single batch.
+    Results for each pair are cached in outdir, keyed by the two models, the hashes of their scores, and the test settings; only pairs which are not in the cache (i.e., involving new or changed models) are computed.
     :param dir:
     :param outdir:
+    :param random_state: seed or np.random.Generator for the posterior samples, for reproducible results; cached results are only reused for the same seed (or None), and not used with a Generator. With an integer seed each pair is sampled from its own stream, derived from the seed and the pair, so incremental and full runs give the same results.
+    :param verbose: print the posterior probabilities for each pair of models.
+    :param rope: width of the region of practical equivalence.
+    :param nsamples: number of posterior samples per pair.
+    :param use_cache: read and update the cache of pair results.
     :return:
     """
     results_df = read_experiment_data(dir)
     models = sorted(results_df.model_id.unique(), reverse=True)
-    model_combos = itertools.combinations(models, 2)
-    with Pool() as pool:
-        bt_results = pool.map_async(partial(posterior_compare_models, results_df = results_df, outdir = outdir), model_combos)
-        pool.close()
-        pool.join()
-    bt_results_df = pd.DataFrame.from_records([x for x in bt_results.get()])
-    bt_results_df.columns = ['model_id_1', 'model_id_2', 'left', 'rope', 'right']
+    score_df = build_score_matrix(results_df)[models]
+    score_matrix = score_df.values
+    pairs = np.column_stack(np.triu_indices(len(models), k=1))
+    if not (random_state is None or isinstance(random_state, numbers.Integral)):
+        use_cache = False  # the state of a Generator cannot be part of the key
+    elif random_state is not None:
+        random_state = int(random_state)  # so that numpy and Python integer seeds share cache keys
+    settings = (rope, nsamples, random_state)
+    col_hashes = [_score_column_hash(score_df, m) for m in models]
+    keys = [_pair_cache_key(models[i], models[j], col_hashes[i], col_hashes[j], settings) for i, j in pairs]
+    cache_fp = os.path.join(outdir, POSTERIOR_CACHE_FILENAME)
+    cached = {}
+    if use_cache and os.path.exists(cache_fp):
+        cache_df = pd.read_csv(cache_fp)
+        cached = {k: (l, e, r) for k, l, e, r in zip(cache_df['key'], cache_df['left'], cache_df['rope'], cache_df['right'])}
+    probs = np.array([cached.get(k, (np.nan,) * 3) for k in keys], dtype=float).reshape(-1, 3)
+    todo = np.array([k not in cached for k in keys], dtype=bool)
+    if todo.any():
+        print("[INFO] computing posterior comparisons for {} of {} pairs of models".format(todo.sum(), len(keys)))
+        pair_seeds = None
+        if isinstance(random_state, numbers.Integral):
+            pair_seeds = [_pair_seed(random_state, models[i], models[j]) for i, j in pairs[todo]]
+        _, probs[todo] = signtest_pairs(score_matrix, rope=rope, pairs=pairs[todo], nsamples=nsamples, random_state=random_state, pair_seeds=pair_seeds)
+    bt_results_df = pd.DataFrame({'model_id_1': [models[i] for i in pairs[:, 0]],
+                                  'model_id_2': [models[j] for j in pairs[:, 1]],
+                                  'left': probs[:, 0], 'rope': probs[:, 1], 'right': probs[:, 2]},
+                                 columns=['model_id_1', 'model_id_2', 'left', 'rope', 'right'])
+    if use_cache and todo.any():
+        # only the pairs of the current models are kept, so the cache does not grow with removed or changed models
+        cache_df = bt_results_df.assign(key=keys)
+        cache_df.to_csv(cache_fp + ".tmp", index = False)
+        os.replace(cache_fp + ".tmp", cache_fp)
+    if verbose:
+        for row in bt_results_df.itertuples(index=False):
+            print('P({0} > {1}) = {2}, P(rope) = {3}, P({1} > {0}) = {4}'.format(*row))
     outpath = os.path.join(outdir, outfile)
     bt_results_df.to_csv(outpath, index = False)
     return bt_results_df
-
-
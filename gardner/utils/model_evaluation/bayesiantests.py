@@ -1,5 +1,8 @@
+import os
+import pickle
+import hashlib
+import tempfile
 import numpy as np
-import numpy.matlib
 
 LEFT, ROPE, RIGHT = range(3)
 
@@ -16,7 +19,7 @@ def correlated_ttest_MC(x, rope, runs=1,  nsamples=50000):
     # Nadeau's and Bengio's corrected variance
     var = np.var(diff, ddof=1) * (1 / n + 1 / (nfolds - 1))
     if var == 0:
-        return int(x < rope), int(-rope <= x <= rope), int(rope < x)
+        return int(x < -rope), int(-rope <= x <= rope), int(rope < x)
     
     return x+np.sqrt(var)*np.random.standard_t( n - 1, nsamples)
                                   
@@ -61,7 +64,7 @@ def correlated_ttest(x, rope, runs=1, verbose=False, names=('C1', 'C2')):
     # Nadeau's and Bengio's corrected variance
     var = np.var(diff, ddof=1) * (1 / n + 1 / (nfolds - 1))
     if var == 0:
-        return int(x < rope), int(-rope <= x <= rope), int(rope < x)
+        return int(x < -rope), int(-rope <= x <= rope), int(rope < x)
     pr = 1-stats.t.cdf(rope, n - 1, x, np.sqrt(var))
     pl = stats.t.cdf(-rope, n - 1, x, np.sqrt(var))
     pe=1-pl-pr
@@ -70,6 +73,46 @@ def correlated_ttest(x, rope, runs=1, verbose=False, names=('C1', 'C2')):
               format(c1=names[0], c2=names[1], pl=pl, pe=pe, pr=pr))
     return pl, pe, pr
     
+def correlated_ttest_batch(x, rope, runs=1, aggregate=None):
+    """
+    Compute the correlated t-test for many pairs of classifiers and data sets
+    in one vectorized call; see `correlated_ttest` for details.
+
+    Args:
+    x (array): a 3d array of differences with axes (pairs, data sets, folds),
+        or a 4d array whose last axis holds pairs of scores.
+    rope (float): the width of the rope
+    runs (int): number of repetitions of cross validation (default: 1)
+    aggregate (None or 'mean'): if 'mean', average the probabilities across
+        data sets (default: None)
+    return: array of probabilities that differences are below -rope, within
+        rope or above rope, with shape (pairs, data sets, 3), or (pairs, 3)
+        if aggregated
+    """
+    import scipy.stats as stats
+    x = np.asarray(x, dtype=float)
+    if x.ndim == 4:
+        x = x[..., 1] - x[..., 0]
+    n = x.shape[-1]
+    nfolds = n / runs
+    mean = np.mean(x, axis=-1)
+    # Nadeau's and Bengio's corrected variance
+    var = np.var(x, axis=-1, ddof=1) * (1 / n + 1 / (nfolds - 1))
+    zero_var = var == 0
+    scale = np.sqrt(np.where(zero_var, 1, var))
+    probs = np.empty(mean.shape + (3,))
+    probs[..., 2] = 1-stats.t.cdf(rope, n - 1, mean, scale)
+    probs[..., 0] = stats.t.cdf(-rope, n - 1, mean, scale)
+    # with no variance the posterior is a point mass at the mean difference
+    probs[..., 2] = np.where(zero_var, rope < mean, probs[..., 2])
+    probs[..., 0] = np.where(zero_var, mean < -rope, probs[..., 0])
+    probs[..., 1] = 1-probs[..., 0]-probs[..., 2]
+    if aggregate == 'mean':
+        probs = probs.mean(axis=1)
+    elif aggregate is not None:
+        raise ValueError('Unknown aggregate: {}'.format(aggregate))
+    return probs
+
 ## SIGN TEST
 def signtest_MC(x, rope, prior_strength=1, prior_place=ROPE, nsamples=50000):
     """
@@ -127,6 +170,78 @@ def signtest(x, rope, prior_strength=1, prior_place=ROPE, nsamples=50000,
               format(c1=names[0], c2=names[1], pl=pl, pe=pe, pr=pr))
     return pl, pe, pr
 
+def signtest_pairs(scores, rope, pairs=None, prior_strength=1, prior_place=ROPE, nsamples=50000,
+                   random_state=None, max_block_bytes=2**26, pair_seeds=None):
+    """
+    Batched sign test for many pairs of classifiers scored on the same datasets.
+
+    The counts for every pair are computed at once by broadcasting over the
+    score matrix. Since the argmax of a Dirichlet sample equals the argmax of
+    the independent gamma variates it is normalized from, the posterior
+    samples for a block of pairs are drawn in a single call to
+    `standard_gamma`, with blocks sized to stay below `max_block_bytes`.
+
+    Args:
+        scores (array): 2d array of scores, rows corresponding to datasets
+            (replicates) and columns to classifiers. Rows where both scores
+            of a pair are NaN are ignored for that pair; rows where only one
+            is NaN count toward the rope, as in `signtest`.
+        rope (float): the width of the rope
+        pairs (array): 2d array of column index pairs `(i, j)`; x = scores[:, j] - scores[:, i]
+            as for `signtest` on `scores[:, [i, j]]` (default: all pairs i < j)
+        prior_strength (float): prior strength (default: 1)
+        prior_place (LEFT, ROPE or RIGHT): the region to which the prior is
+            assigned (default: ROPE)
+        nsamples (int): the number of Monte Carlo samples per pair
+        random_state (None, int or np.random.Generator): seed or generator,
+            for reproducible results
+        max_block_bytes (int): upper bound on the memory used for samples
+        pair_seeds (list): optional seed (anything accepted by
+            `np.random.default_rng`) for each pair; the samples of each pair
+            are then drawn from their own generator, so the result of a pair
+            does not depend on which other pairs are computed with it, and
+            `random_state` is not used
+
+    Returns:
+        pairs, 2-d array of `(i, j)` column indices, and 2-d array with rows
+        corresponding to pairs and columns to `[p_left, p_rope, p_right]`
+    """
+    if prior_strength < 0:
+        raise ValueError('Prior strength must be nonegative')
+    if nsamples < 0:
+        raise ValueError('Number of samples must be a positive integer')
+    if rope < 0:
+        raise ValueError('Rope must be a positive number')
+
+    scores = np.asarray(scores, dtype=float)
+    if pairs is None:
+        pairs = np.column_stack(np.triu_indices(scores.shape[1], k=1))
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    rng = np.random.default_rng(random_state)
+
+    first, second = scores[:, pairs[:, 0]], scores[:, pairs[:, 1]]
+    x = second - first
+    nleft = np.sum(x < -rope, axis=0)
+    nright = np.sum(x > rope, axis=0)
+    nrope = np.sum(~(np.isnan(first) & np.isnan(second)), axis=0) - nleft - nright
+    alpha = np.column_stack([nleft, nrope, nright]).astype(float)
+    alpha += 0.0001  # for numerical stability
+    alpha[:, prior_place] += prior_strength
+
+    probs = np.empty((len(pairs), 3))
+    if pair_seeds is not None:
+        for k, seed in enumerate(pair_seeds):
+            winners = np.argmax(np.random.default_rng(seed).standard_gamma(alpha[k], size=(nsamples, 3)), axis=1)
+            probs[k] = np.bincount(winners, minlength=3)[[LEFT, ROPE, RIGHT]] / nsamples
+        return pairs, probs
+    block = max(1, int(max_block_bytes // (nsamples * 3 * 8)))
+    for start in range(0, len(pairs), block):
+        a = alpha[start:start + block]
+        samples = rng.standard_gamma(a[:, None, :], size=(len(a), nsamples, 3))
+        winners = np.argmax(samples, axis=2)
+        probs[start:start + block] = np.stack([np.sum(winners == k, axis=1) for k in (LEFT, ROPE, RIGHT)], axis=1) / nsamples
+    return pairs, probs
+
 ## SIGNEDRANK
 def heaviside(X):
     Y = np.zeros(X.shape);
@@ -134,7 +249,8 @@ def heaviside(X):
     Y[np.where(X == 0)] = 0.5;
     return Y #1 * (x > 0)
 
-def signrank_MC(x, rope, prior_strength=0.6, prior_place=ROPE, nsamples=50000):
+def signrank_MC(x, rope, prior_strength=0.6, prior_place=ROPE, nsamples=50000,
+                random_state=None, max_block_bytes=2**26):
     """
     Args:
         x (array): a vector of differences or a 2d array with pairs of scores.
@@ -143,6 +259,10 @@ def signrank_MC(x, rope, prior_strength=0.6, prior_place=ROPE, nsamples=50000):
         prior_place (LEFT, ROPE or RIGHT): the region to which the prior is
             assigned (default: ROPE)
         nsamples (int): the number of Monte Carlo samples
+        random_state (None, int or np.random.Generator): seed or generator,
+            for reproducible results
+        max_block_bytes (int): upper bound on the memory used for each block
+            of Dirichlet samples
     
     Returns:
         2-d array with rows corresponding to samples and columns to
@@ -150,6 +270,8 @@ def signrank_MC(x, rope, prior_strength=0.6, prior_place=ROPE, nsamples=50000):
     """
     if x.ndim == 2:
         zm = x[:, 1] - x[:, 0]
+    else:
+        zm = x
     nm=len(zm)
     if prior_place==ROPE:
         z0=[0]
@@ -159,25 +281,24 @@ def signrank_MC(x, rope, prior_strength=0.6, prior_place=ROPE, nsamples=50000):
         z0=[float('inf')]
     z=np.concatenate((zm,z0))
     n=len(z)
-    z=np.transpose(np.asmatrix(z))
-    X=np.matlib.repmat(z,1,n)
-    Y=np.matlib.repmat(-np.transpose(z)+2*rope,n,1)
-    Aright = heaviside(X-Y)
-    X=np.matlib.repmat(-z,1,n)
-    Y=np.matlib.repmat(np.transpose(z)+2*rope,n,1)
-    Aleft = heaviside(X-Y)
+    pair_sums = z[:, None] + z[None, :]
+    Aright = heaviside(pair_sums - 2*rope)
+    Aleft = heaviside(-pair_sums - 2*rope)
     alpha=np.concatenate((np.ones(nm),[prior_strength]),axis=0)
+    rng = np.random.default_rng(random_state)
     samples=np.zeros((nsamples,3), dtype=float)
-    for i in range(0,nsamples):
-        data = np.random.dirichlet(alpha, 1)
-        samples[i,2]=numpy.inner(np.dot(data,Aright),data)
-        samples[i,0]=numpy.inner(np.dot(data,Aleft),data)
-        samples[i,1]=1-samples[i,0]-samples[i,2]
-     
+    # draw the Dirichlet samples in blocks, and evaluate the quadratic forms for a whole block at once
+    block = max(1, int(max_block_bytes // (3 * n * 8)))
+    for start in range(0, nsamples, block):
+        data = rng.dirichlet(alpha, min(block, nsamples - start))
+        stop = start + len(data)
+        samples[start:stop, 2] = np.einsum('ij,ij->i', data @ Aright, data)
+        samples[start:stop, 0] = np.einsum('ij,ij->i', data @ Aleft, data)
+    samples[:, 1] = 1 - samples[:, 0] - samples[:, 2]
     return samples
 
 def signrank(x, rope, prior_strength=0.6, prior_place=ROPE, nsamples=50000,
-             verbose=False, names=('C1', 'C2')):
+             verbose=False, names=('C1', 'C2'), random_state=None):
     """
     Args:
         x (array): a vector of differences or a 2d array with pairs of scores.
@@ -188,11 +309,13 @@ def signrank(x, rope, prior_strength=0.6, prior_place=ROPE, nsamples=50000,
         nsamples (int): the number of Monte Carlo samples
         verbose (bool): report the computed probabilities
         names (pair of str): the names of the two classifiers
+        random_state (None, int or np.random.Generator): seed or generator,
+            for reproducible results
 
     Returns:
         p_left, p_rope, p_right
     """
-    samples = signrank_MC(x, rope, prior_strength, prior_place, nsamples)
+    samples = signrank_MC(x, rope, prior_strength, prior_place, nsamples, random_state)
     
     winners = np.argmax(samples, axis=1)
     pl, pe, pr = np.bincount(winners, minlength=3) / len(winners)
@@ -202,41 +325,8 @@ def signrank(x, rope, prior_strength=0.6, prior_place=ROPE, nsamples=50000,
     return pl, pe, pr
 
 
-def hierarchical(diff, rope, rho,  upperAlpha=2, lowerAlpha =1, lowerBeta = 0.01, upperBeta = 0.1,std_upper_bound=1000, verbose=False, names=('C1', 'C2') ):
-     # upperAlpha, lowerAlpha, upperBeta, lowerBeta, are the upper and lower bound for alpha and beta, which are the parameters of 
-    #the  Gamma distribution used as a prior for the degress of freedom.
-    #std_upper_bound is a constant which multiplies the sample standard deviation, to set the upper limit of the prior on the
-    #standard deviation.  Posterior inferences are insensitive to this value as this is large enough, such as 100 or 1000.
-    
-    samples=hierarchical_MC(diff, rope, rho, upperAlpha, lowerAlpha, lowerBeta, upperBeta, std_upper_bound,names )
-    winners = np.argmax(samples, axis=1)
-    pl, pe, pr = np.bincount(winners, minlength=3) / len(winners)
-    if verbose:
-        print('P({c1} > {c2}) = {pl}, P(rope) = {pe}, P({c2} > {c1}) = {pr}'.
-              format(c1=names[0], c2=names[1], pl=pl, pe=pe, pr=pr))
-    return pl, pe, pr
-
-def hierarchical_MC(diff, rope, rho,   upperAlpha=2, lowerAlpha =1, lowerBeta = 0.01, upperBeta = 0.1, std_upper_bound=1000, names=('C1', 'C2') ):
-    # upperAlpha, lowerAlpha, upperBeta, lowerBeta, are the upper and lower bound for alpha and beta, which are the parameters of 
-    #the  Gamma distribution used as a prior for the degress of freedom.
-    #std_upper_bound is a constant which multiplies the sample standard deviation, to set the upper limit of the prior on the
-    #standard deviation.  Posterior inferences are insensitive to this value as this is large enough, such as 100 or 1000.
-
-    import scipy.stats as stats
-    import pystan
-    #data rescaling, to have homogenous scale among all dsets
-    stdX = np.mean(np.std(diff,1)) #we scale all the data by the mean of the standard deviation of data sets
-    x = diff/stdX
-    rope=rope/stdX
-    
-    #to avoid numerical problems with zero variance
-    for i in range(0,len(x)):
-        if np.std(x[i,:])==0:
-            x[i,:]=x[i,:]+np.random.normal(0,np.min(1/1000000000,np.abs(np.mean(x[i,:])/100000000)))
-  
-    
-    #This is the Hierarchical model written in Stan
-    hierarchical_code = """
+#This is the Hierarchical model written in Stan
+HIERARCHICAL_CODE = """
     /*Hierarchical Bayesian model for the analysis of competing cross-validated classifiers on multiple data sets.
     */
 
@@ -381,6 +471,77 @@ def hierarchical_MC(diff, rope, rho,   upperAlpha=2, lowerAlpha =1, lowerBeta =
         increment_log_prob(sum(logLik));   
      }
     """
+
+_hierarchical_models = {}
+
+
+def hierarchical_model(cache_dir=None):
+    """
+    Load the compiled hierarchical Stan model, compiling it only if it is not
+    cached yet. Compiled models are pickled to cache_dir, under a file name
+    keyed by the hash of the model code, so that a changed model is recompiled.
+
+    Args:
+        cache_dir (str): directory for the compiled model (default:
+            ~/.cache/bayesiantests)
+
+    Returns:
+        pystan.StanModel
+    """
+    import pystan
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'bayesiantests')
+    code_hash = hashlib.sha256(HIERARCHICAL_CODE.encode('utf-8')).hexdigest()
+    fp = os.path.join(cache_dir, 'hierarchical_{}.pkl'.format(code_hash))
+    if fp in _hierarchical_models:
+        return _hierarchical_models[fp]
+    if os.path.exists(fp):
+        with open(fp, 'rb') as f:
+            model = pickle.load(f)
+    else:
+        model = pystan.StanModel(model_code=HIERARCHICAL_CODE)
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first so that concurrent readers never load a partial model
+        fd, temp_fp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(model, f)
+        os.replace(temp_fp, fp)
+    _hierarchical_models[fp] = model
+    return model
+
+def hierarchical(diff, rope, rho,  upperAlpha=2, lowerAlpha =1, lowerBeta = 0.01, upperBeta = 0.1,std_upper_bound=1000, verbose=False, names=('C1', 'C2'), cache_dir=None, n_jobs=-1 ):
+     # upperAlpha, lowerAlpha, upperBeta, lowerBeta, are the upper and lower bound for alpha and beta, which are the parameters of 
+    #the  Gamma distribution used as a prior for the degress of freedom.
+    #std_upper_bound is a constant which multiplies the sample standard deviation, to set the upper limit of the prior on the
+    #standard deviation.  Posterior inferences are insensitive to this value as this is large enough, such as 100 or 1000.
+    
+    samples=hierarchical_MC(diff, rope, rho, upperAlpha, lowerAlpha, lowerBeta, upperBeta, std_upper_bound,names, cache_dir, n_jobs )
+    winners = np.argmax(samples, axis=1)
+    pl, pe, pr = np.bincount(winners, minlength=3) / len(winners)
+    if verbose:
+        print('P({c1} > {c2}) = {pl}, P(rope) = {pe}, P({c2} > {c1}) = {pr}'.
+              format(c1=names[0], c2=names[1], pl=pl, pe=pe, pr=pr))
+    return pl, pe, pr
+
+def hierarchical_MC(diff, rope, rho,   upperAlpha=2, lowerAlpha =1, lowerBeta = 0.01, upperBeta = 0.1, std_upper_bound=1000, names=('C1', 'C2'), cache_dir=None, n_jobs=-1 ):
+    # upperAlpha, lowerAlpha, upperBeta, lowerBeta, are the upper and lower bound for alpha and beta, which are the parameters of 
+    #the  Gamma distribution used as a prior for the degress of freedom.
+    #std_upper_bound is a constant which multiplies the sample standard deviation, to set the upper limit of the prior on the
+    #standard deviation.  Posterior inferences are insensitive to this value as this is large enough, such as 100 or 1000.
+    #cache_dir is the directory of the compiled model (see hierarchical_model), and n_jobs the number of chains run in parallel.
+
+    import scipy.stats as stats
+    #data rescaling, to have homogenous scale among all dsets
+    stdX = np.mean(np.std(diff,1)) #we scale all the data by the mean of the standard deviation of data sets
+    x = diff/stdX
+    rope=rope/stdX
+    
+    #to avoid numerical problems with zero variance
+    for i in range(0,len(x)):
+        if np.std(x[i,:])==0:
+            x[i,:]=x[i,:]+np.random.normal(0,min(1/1000000000,np.abs(np.mean(x[i,:])/100000000)),x.shape[1])
+  
+    
     datatable=x
     std_within=np.mean(np.std(datatable,1))
 
@@ -407,9 +568,9 @@ def hierarchical_MC(diff, rope, rho,   upperAlpha=2, lowerAlpha =1, lowerBeta =
                    'upperBeta' : upperBeta,
                    'lowerBeta' : lowerBeta}
 
-    #Call to Stan code
-    fit = pystan.stan(model_code=hierarchical_code, data=hierachical_dat,
-                      iter=1000, chains=4)
+    #Call to Stan code; the model is compiled once and then reused
+    fit = hierarchical_model(cache_dir).sampling(data=hierachical_dat,
+                      iter=1000, chains=4, n_jobs=n_jobs)
     
     la = fit.extract(permuted=True)  # return a dictionary of arrays
     mu = la['delta0']
@@ -417,13 +578,43 @@ def hierarchical_MC(diff, rope, rho,   upperAlpha=2, lowerAlpha =1, lowerBeta =
     nu = la['nu']
     
     samples=np.zeros((len(mu),3), dtype=float)
-    for i in range(0,len(mu)):
-        samples[i,2]=1-stats.t.cdf(rope, nu[i], mu[i], stdh[i])
-        samples[i,0]=stats.t.cdf(-rope, nu[i], mu[i],  stdh[i])
-        samples[i,1]=1-samples[i,0]-samples[i,2]
+    samples[:,2]=1-stats.t.cdf(rope, nu, mu, stdh)
+    samples[:,0]=stats.t.cdf(-rope, nu, mu,  stdh)
+    samples[:,1]=1-samples[:,0]-samples[:,2]
      
     return samples
 
+def _hierarchical_pair(args):
+    diff, rope, rho, kwargs = args
+    return hierarchical(diff, rope, rho, n_jobs=1, **kwargs)
+
+def hierarchical_pairs(diffs, rope, rho, max_workers=None, cache_dir=None, **kwargs):
+    """
+    Run the hierarchical test for several pairs of classifiers, fitting the
+    pairs in parallel with a single compiled model.
+
+    Args:
+        diffs (list): one 2d array of differences per pair, with rows
+            corresponding to data sets and columns to folds, as for `hierarchical`
+        rope (float): the width of the rope
+        rho (float): the correlation due to cross-validation
+        max_workers (int): the number of pairs fitted at once (default: the
+            number of processors); each fit runs its chains sequentially
+        cache_dir (str): directory for the compiled model
+        kwargs: further arguments to `hierarchical`
+
+    Returns:
+        2-d array with rows corresponding to pairs and columns to
+        `[p_left, p_rope, p_right]`
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    # compile (or load) the model before starting the workers, which then load it from the cache
+    hierarchical_model(cache_dir)
+    kwargs['cache_dir'] = cache_dir
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_hierarchical_pair, [(diff, rope, rho, kwargs) for diff in diffs]))
+    return np.array(results, dtype=float).reshape(-1, 3)
+
 def plot_posterior(samples, names=('C1', 'C2')):
     """
     Args:
@@ -0,0 +1,327 @@
+"""
+Slicing analysis: the absolute area between ROC curves (ABROCA) of the majority and minority groups of a protected attribute.
+
+This is a Python port of compute_slice_statistic in slice/slice_utils.R. Instead of interpolating each ROC curve onto a
+grid and integrating numerically, the area is computed exactly: both curves are piecewise linear, so between the merged
+breakpoints of two curves their difference is linear, and the integral of its absolute value has a closed form. The
+predictions of all courses are sorted once; each course is then a contiguous range of the sorted observations, and the
+ROC curves and areas for all of its groups are computed in a single vectorized pass.
+
+The same sort is reused for bootstrap confidence intervals and permutation tests: resamples only change the weights
+(bootstrap counts) or group indicators (permuted groups) of the sorted observations, so the resampled ROC curves are
+weighted cumulative sums. Resamples are spread across a process pool, with independent random streams.
+"""
+import os
+import warnings
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+SortedPredictions = namedtuple("SortedPredictions", ["order", "labels", "curve_ids", "threshold_ends", "n_curves"])
+
+
+def sort_predictions(preds, labels, curve_ids):
+    """
+    Sort predictions once, by curve and then by descending predicted probability, so that ROC curves for any weighting of the observations can be computed with cumulative sums.
+    :param preds: np.array of predicted probabilities.
+    :param labels: np.array of true labels (0 or 1).
+    :param curve_ids: np.array of integer ids (0, ..., n_curves - 1) of the curve (e.g. course and group) each observation belongs to.
+    :return: SortedPredictions; order is the permutation which sorts the inputs, and threshold_ends marks the last observation of each run of tied predictions within a curve, i.e. the points of the ROC curve.
+    """
+    preds = np.asarray(preds, dtype=float)
+    curve_ids = np.asarray(curve_ids, dtype=np.int64)
+    order = np.lexsort((-preds, curve_ids))
+    sorted_preds, sorted_curves = preds[order], curve_ids[order]
+    threshold_ends = np.ones(len(order), dtype=bool)
+    threshold_ends[:-1] = (sorted_preds[1:] != sorted_preds[:-1]) | (sorted_curves[1:] != sorted_curves[:-1])
+    n_curves = int(curve_ids.max()) + 1 if len(curve_ids) else 0
+    return SortedPredictions(order, np.asarray(labels, dtype=float)[order], sorted_curves, threshold_ends, n_curves)
+
+
+def roc_points(sorted_preds, weights = None):
+    """
+    Compute the ROC curves of every curve id, optionally weighting the observations (e.g. by bootstrap counts).
+    :param sorted_preds: SortedPredictions from sort_predictions().
+    :param weights: None, or np.array of observation weights in the sorted order, of shape (n,) or (n_resamples, n); the ROC curves for every row of weights are computed at once.
+    :return: tuple of (fpr, tpr, curve): fpr and tpr have shape (m,) or (n_resamples, m), and curve is the sorted (m,) array of the curve id of each point. Each curve starts at (0, 0) and ends at (1, 1); curves without positive or negative observations are NaN.
+    """
+    labels = sorted_preds.labels
+    w = np.ones_like(labels) if weights is None else np.asarray(weights, dtype=float)
+    starts = np.searchsorted(sorted_preds.curve_ids, np.arange(sorted_preds.n_curves))
+    keep = np.nonzero(sorted_preds.threshold_ends)[0]
+    curve = sorted_preds.curve_ids[keep]
+    tpr = _cumulative_rates(w * labels, starts, keep, curve)
+    fpr = _cumulative_rates(w * (1 - labels), starts, keep, curve)
+    # prepend the origin to each curve
+    origin = np.searchsorted(curve, np.arange(sorted_preds.n_curves))
+    fpr = np.insert(fpr, origin, 0.0, axis=-1)
+    tpr = np.insert(tpr, origin, 0.0, axis=-1)
+    curve = np.insert(curve, origin, np.arange(sorted_preds.n_curves))
+    return fpr, tpr, curve
+
+
+def _cumulative_rates(counts, starts, keep, curve):
+    """
+    Cumulative sums of counts over all curves at once, restarted at the first observation of each curve and divided by each curve's total, at the observations in keep.
+    """
+    cum = np.cumsum(counts, axis=-1)
+    before = np.concatenate([np.zeros(cum.shape[:-1] + (1,)), cum], axis=-1)[..., starts]
+    totals = np.concatenate([before[..., 1:], cum[..., -1:]], axis=-1) - before
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rates = (cum[..., keep] - before[..., curve]) / totals[..., curve]
+    # curves without positives (or negatives) are undefined
+    return np.where(totals[..., curve] > 0, rates, np.nan)
+
+
+def _ranges(starts, lengths):
+    """
+    Concatenation of np.arange(start, start + length) for each start and length.
+    """
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+
+def _limits(x, xp, yp, side):
+    """
+    Evaluate the piecewise-linear curves (xp, yp) at x, taking the value just after x (side="right") or just before x (side="left"), so that vertical segments of ROC curves are handled exactly.
+    """
+    if side == "right":
+        i = np.clip(np.searchsorted(xp, x, side="right") - 1, 0, len(xp) - 2)
+    else:
+        i = np.clip(np.searchsorted(xp, x, side="left") - 1, 0, len(xp) - 2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return yp[i] + (x - xp[i]) * (yp[i + 1] - yp[i]) / (xp[i + 1] - xp[i])
+
+
+def area_between_curves(fpr, tpr, curve, pairs):
+    """
+    Compute the exact absolute area between pairs of ROC curves.
+    :param fpr: np.array of false positive rates, as returned by roc_points().
+    :param tpr: np.array of true positive rates.
+    :param curve: sorted np.array of the curve id of each point.
+    :param pairs: (n_pairs, 2) np.array of curve ids to compare.
+    :return: np.array of n_pairs areas; NaN for pairs including an undefined curve.
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    n_curves = int(curve.max()) + 1 if len(curve) else 0
+    starts = np.searchsorted(curve, np.arange(n_curves))
+    lengths = np.searchsorted(curve, np.arange(n_curves), side="right") - starts
+    defined = np.ones(n_curves, dtype=bool)
+    defined[curve[~(np.isfinite(fpr) & np.isfinite(tpr))]] = False
+    areas = np.full(len(pairs), np.nan)
+    valid_pairs = np.nonzero(defined[pairs].all(axis=1))[0]
+    if not len(valid_pairs):
+        return areas
+    # shift the points of the k-th pair by 2k, so that the curves of all pairs form single sorted arrays
+    xs, ys = [], []
+    for col in (0, 1):
+        c = pairs[valid_pairs, col]
+        idx = _ranges(starts[c], lengths[c])
+        xs.append(fpr[idx] + 2.0 * np.repeat(np.arange(len(valid_pairs)), lengths[c]))
+        ys.append(tpr[idx])
+    grid = np.unique(np.concatenate(xs))
+    grid_pair = np.floor(grid / 2).astype(np.int64)
+    a, b = grid[:-1], grid[1:]
+    interval = grid_pair[:-1] == grid_pair[1:]
+    a, b, interval_pair = a[interval], b[interval], grid_pair[:-1][interval]
+    # between consecutive breakpoints both curves are linear, and so is their difference d
+    d_a = _limits(a, xs[0], ys[0], "right") - _limits(a, xs[1], ys[1], "right")
+    d_b = _limits(b, xs[0], ys[0], "left") - _limits(b, xs[1], ys[1], "left")
+    width = b - a
+    abs_sum = np.abs(d_a) + np.abs(d_b)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        crossing = width * (d_a ** 2 + d_b ** 2) / (2 * abs_sum)
+    interval_area = np.where(d_a * d_b >= 0, width * abs_sum / 2, crossing)
+    areas[valid_pairs] = np.bincount(interval_pair, weights=interval_area, minlength=len(valid_pairs))
+    return areas
+
+
+SliceInputs = namedtuple("SliceInputs", ["courses", "sorted_preds", "groups", "n_groups", "majority_group"])
+
+
+def slice_inputs(df, pred_col = "prob", label_col = "label_value", protected_attr_col = "gender", majority_protected_attr_val = "male", course_col = "course"):
+    """
+    Sort the predictions of every course once; the ROC curve of each group is then computed by weighting the observations of the course with the group's indicator.
+    Courses with fewer than two label values, or without the majority group, are skipped with a warning.
+    :return: SliceInputs; groups are the integer group codes of the observations in the sorted order.
+    """
+    df = df[[course_col, protected_attr_col, pred_col, label_col]]
+    keep = []
+    for course_name, course_df in df.groupby(course_col, sort = True):
+        if course_df[label_col].nunique() <= 1:
+            print("[WARNING] skipping course {}; must be at least 2 unique label values".format(course_name))
+        elif not (course_df[protected_attr_col] == majority_protected_attr_val).any():
+            print("[WARNING] skipping course {}; no observations with {} {}".format(course_name, protected_attr_col, majority_protected_attr_val))
+        else:
+            keep.append(course_name)
+    df = df[df[course_col].isin(keep)]
+    courses = sorted(keep)
+    course_ids = pd.Categorical(df[course_col], categories=courses).codes
+    group_ids, group_names = pd.factorize(df[protected_attr_col].astype(str))
+    sorted_preds = sort_predictions(df[pred_col].values, df[label_col].values, course_ids)
+    majority_group = int(np.nonzero(np.asarray(group_names) == str(majority_protected_attr_val))[0][0])
+    return SliceInputs(courses, sorted_preds, group_ids[sorted_preds.order], len(group_names), majority_group)
+
+
+def _course_ranges(sorted_preds):
+    """
+    Start and end of the contiguous range of each course's observations in the sorted order.
+    """
+    course_ids = sorted_preds.curve_ids
+    return np.searchsorted(course_ids, np.arange(sorted_preds.n_curves)), np.searchsorted(course_ids, np.arange(sorted_preds.n_curves), side="right")
+
+
+def _slice_statistics(inputs, counts = None, groups = None):
+    """
+    Compute the slice statistic of every course for each row of counts (observation weights, e.g. bootstrap counts) and groups (group codes, e.g. permuted), both of shape (n_resamples, n) in the sorted order.
+    Courses are evaluated one at a time, so memory use is proportional to the size of the largest course rather than of all courses.
+    :return: np.array of shape (n_resamples, n_courses).
+    """
+    sorted_preds = inputs.sorted_preds
+    n = len(sorted_preds.order)
+    counts = np.ones((1, n)) if counts is None else np.atleast_2d(counts)
+    groups = np.atleast_2d(inputs.groups if groups is None else groups)
+    n_resamples = max(len(counts), len(groups))
+    results = np.empty((n_resamples, sorted_preds.n_curves))
+    for c, (start, end) in enumerate(zip(*_course_ranges(sorted_preds))):
+        course_preds = SortedPredictions(sorted_preds.order[start:end], sorted_preds.labels[start:end], np.zeros(end - start, dtype=np.int64), sorted_preds.threshold_ends[start:end], 1)
+        # groups without observations in the course do not contribute to its slice statistic
+        present = np.bincount(inputs.groups[start:end], minlength=inputs.n_groups) > 0
+        results[:, c] = _course_slice_statistics(course_preds, counts[:, start:end], groups[:, start:end], inputs.n_groups, inputs.majority_group, present)
+    return results
+
+
+def _course_slice_statistics(sorted_preds, counts, groups, n_groups, majority, present):
+    """
+    Compute the slice statistic of a single course for each row of counts and groups.
+    :param present: boolean np.array of the groups with observations in the course; a resample without observations of a present group is undefined (NaN).
+    :return: np.array of shape (n_resamples,).
+    """
+    n = len(sorted_preds.order)
+    n_resamples = max(len(counts), len(groups))
+    # one weighted ROC curve per resample and group
+    weights = counts[:, None, :] * (groups[:, None, :] == np.arange(n_groups)[None, :, None])
+    weights = np.broadcast_to(weights, (n_resamples, n_groups, n)).reshape(-1, n)
+    fpr, tpr, curve = roc_points(sorted_preds, weights)
+    curve = (np.arange(len(weights))[:, None] + curve[None, :]).ravel()
+    # compare each minority group with the majority group, within each resample
+    minority = np.array([g for g in range(n_groups) if g != majority and present[g]], dtype=np.int64)
+    r, g = [x.ravel() for x in np.meshgrid(np.arange(n_resamples), minority, indexing="ij")]
+    pairs = np.column_stack([r * n_groups + majority, r * n_groups + g])
+    areas = area_between_curves(fpr.ravel(), tpr.ravel(), curve, pairs)
+    group_size = weights.sum(axis=1)
+    areas = np.where((group_size[pairs[:, 0]] > 0) & (group_size[pairs[:, 1]] > 0), areas, np.nan)
+    return np.bincount(r, weights=areas, minlength=n_resamples)
+
+
+def slice_statistics(df, pred_col = "prob", label_col = "label_value", protected_attr_col = "gender", majority_protected_attr_val = "male", course_col = "course"):
+    """
+    Compute the slice statistic of every course: the sum, over the minority groups of protected_attr_col, of the absolute area between the group's ROC curve and the majority group's ROC curve.
+    :param df: pd.DataFrame with one row per user and course, containing course_col, pred_col, label_col, and protected_attr_col.
+    :param pred_col: name of column containing predicted probabilities.
+    :param label_col: name of column containing true labels (should be 0,1 only).
+    :param protected_attr_col: name of column containing protected attr.
+    :param majority_protected_attr_val: "majority" group wrt protected attribute.
+    :param course_col: name of column containing course names.
+    :return: pd.Series of slice statistics indexed by course; NaN for courses where a group has only one label value.
+    """
+    inputs = slice_inputs(df, pred_col, label_col, protected_attr_col, majority_protected_attr_val, course_col)
+    return pd.Series(_slice_statistics(inputs)[0], index=pd.Index(inputs.courses, name=course_col), name="Slice.Statistic")
+
+
+_worker_inputs = None  # SliceInputs of the resampling workers, set once per process by _init_worker()
+
+
+def _init_worker(inputs):
+    global _worker_inputs
+    _worker_inputs = inputs
+
+
+def _resample_chunk(inputs, method, n_resamples, seed_seq):
+    """
+    Compute the slice statistics for n_resamples bootstrap resamples (method="bootstrap") or within-course permutations of the groups (method="permutation"), drawn from the random stream seed_seq.
+    :param inputs: SliceInputs, or None to use those passed to the worker process by _init_worker().
+    """
+    inputs = inputs if inputs is not None else _worker_inputs
+    rng = np.random.default_rng(seed_seq)
+    course_ids = inputs.sorted_preds.curve_ids
+    n = len(course_ids)
+    # the observations of each course are contiguous in the sorted order
+    starts, ends = _course_ranges(inputs.sorted_preds)
+    sizes = ends - starts
+    if method == "bootstrap":
+        # resample the users of each course with replacement, as counts of each observation
+        draws = starts[course_ids] + (rng.random((n_resamples, n)) * sizes[course_ids]).astype(np.int64)
+        counts = np.bincount((np.arange(n_resamples)[:, None] * n + draws).ravel(), minlength=n_resamples * n).reshape(n_resamples, n)
+        return _slice_statistics(inputs, counts=counts)
+    elif method == "permutation":
+        # shuffle the group labels within each course
+        perm = np.argsort(course_ids[None, :] + rng.random((n_resamples, n)), axis=1)
+        return _slice_statistics(inputs, groups=inputs.groups[perm])
+    raise ValueError("unknown resampling method: {}".format(method))
+
+
+def _resample(inputs, method, n_resamples, random_state, max_workers, chunk_size):
+    """
+    Spread n_resamples over a process pool in chunks of chunk_size, each with an independent random stream spawned from random_state. The inputs are sent to each worker once, rather than with every chunk.
+    :return: np.array of shape (n_resamples, n_courses).
+    """
+    chunks = [min(chunk_size, n_resamples - i) for i in range(0, n_resamples, chunk_size)]
+    seed_seqs = np.random.SeedSequence(random_state).spawn(len(chunks))
+    max_workers = min(max_workers or os.cpu_count() or 1, len(chunks))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(inputs,)) as executor:
+        results = list(executor.map(_resample_chunk, [None] * len(chunks), [method] * len(chunks), chunks, seed_seqs))
+    return np.concatenate(results, axis=0)
+
+
+def bootstrap_slice_statistics(df, n_resamples = 1000, alpha = 0.05, random_state = None, max_workers = None, chunk_size = 20, pred_col = "prob", label_col = "label_value", protected_attr_col = "gender", majority_protected_attr_val = "male", course_col = "course"):
+    """
+    Compute bootstrap confidence intervals for the slice statistic of every course, resampling users within each course.
+    ABROCA is an absolute area, so sampling noise in the ROC curves can only add to it: the statistic is biased upward, most strongly for small groups, and the percentile interval inherits this bias.
+    The bootstrap estimate of the bias is returned along with the basic (reverse percentile) interval, which corrects for it.
+    :param df: pd.DataFrame as for slice_statistics().
+    :param n_resamples: number of bootstrap resamples.
+    :param alpha: the intervals have coverage 1 - alpha.
+    :param random_state: seed for the random streams of the workers, for reproducible results.
+    :param max_workers: number of worker processes; at most one per chunk.
+    :param chunk_size: number of resamples computed at once by each task; memory use is proportional to chunk_size times the number of groups and the number of observations of the largest course.
+    :return: pd.DataFrame indexed by course, with the slice statistic, its bootstrap standard error and bias, the bounds of the percentile and basic intervals, and the number of resamples in which the statistic was defined (none for courses where it is NaN).
+    """
+    inputs = slice_inputs(df, pred_col, label_col, protected_attr_col, majority_protected_attr_val, course_col)
+    ss = _slice_statistics(inputs)[0]
+    boot = _resample(inputs, "bootstrap", n_resamples, random_state, max_workers, chunk_size)
+    boot[:, np.isnan(ss)] = np.nan
+    # resamples in which a group has only one label value, or no observations, are undefined, and dropped
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # courses without any defined resamples are NaN
+        lower = np.nanpercentile(boot, 100 * alpha / 2, axis=0)
+        upper = np.nanpercentile(boot, 100 * (1 - alpha / 2), axis=0)
+        results = pd.DataFrame({"Slice.Statistic": ss,
+                                "se": np.nanstd(boot, axis=0, ddof=1),
+                                "bias": np.nanmean(boot, axis=0) - ss,
+                                "ci_lower": lower,
+                                "ci_upper": upper,
+                                "ci_lower_basic": np.maximum(2 * ss - upper, 0.0),
+                                "ci_upper_basic": 2 * ss - lower,
+                                "n_resamples": np.isfinite(boot).sum(axis=0)},
+                               index=pd.Index(inputs.courses, name=course_col),
+                               columns=["Slice.Statistic", "se", "bias", "ci_lower", "ci_upper", "ci_lower_basic", "ci_upper_basic", "n_resamples"])
+    return results
+
+
+def permutation_test_slice_statistics(df, n_permutations = 1000, random_state = None, max_workers = None, chunk_size = 20, pred_col = "prob", label_col = "label_value", protected_attr_col = "gender", majority_protected_attr_val = "male", course_col = "course"):
+    """
+    Test the slice statistic of every course against the null hypothesis that predictions and labels do not depend on group membership, by permuting the groups of users within each course.
+    Arguments are as for bootstrap_slice_statistics().
+    :return: pd.DataFrame indexed by course, with the slice statistic and its permutation p-value.
+    """
+    inputs = slice_inputs(df, pred_col, label_col, protected_attr_col, majority_protected_attr_val, course_col)
+    ss = _slice_statistics(inputs)[0]
+    null = _resample(inputs, "permutation", n_permutations, random_state, max_workers, chunk_size)
+    null[:, np.isnan(ss)] = np.nan
+    n_defined = np.isfinite(null).sum(axis=0)
+    with np.errstate(invalid="ignore"):
+        p_value = np.where(np.isnan(ss), np.nan, (1 + (null >= ss[None, :]).sum(axis=0)) / (1 + n_defined))
+    return pd.DataFrame({"Slice.Statistic": ss, "p_value": p_value},
+                        index=pd.Index(inputs.courses, name=course_col), columns=["Slice.Statistic", "p_value"])
@@ -0,0 +1,180 @@
+"""
+Indexed local store for the master hash mapping, backed by SQLite.
+
+Each course session exported by create_master_hash_mapping.py is appended to the store once; sessions whose export
+files have not changed since they were added are not read again. Lookups by user id or session user id use indexes,
+so fetching the mappings for a list of users does not scan the whole table. The full row of each export is kept
+(as JSON, in the column order of the export), so gender_lookup() reproduces every column of the session exports.
+"""
+import os
+import re
+import json
+import sqlite3
+import pandas as pd
+
+STORE_FILENAME = "hash_mapping.sqlite"
+HASH_MAPPING_FILE_REGEX = re.compile("^hash_mapping_(\S+)_([0-9\-]+).*\.csv$")
+SCHEMA_VERSION = 2  # stores created with an older schema are rebuilt from the session exports
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hash_mapping (
+    course TEXT NOT NULL,
+    session TEXT NOT NULL,
+    user_id INTEGER,
+    session_user_id TEXT NOT NULL,
+    row_json TEXT NOT NULL,
+    PRIMARY KEY (course, session, session_user_id)
+);
+CREATE INDEX IF NOT EXISTS hash_mapping_user_id ON hash_mapping (user_id);
+CREATE INDEX IF NOT EXISTS hash_mapping_session_user_id ON hash_mapping (session_user_id);
+CREATE TABLE IF NOT EXISTS sessions (
+    course TEXT NOT NULL,
+    session TEXT NOT NULL,
+    source_file TEXT,
+    source_size INTEGER,
+    source_mtime REAL,
+    n_rows INTEGER,
+    columns_json TEXT,
+    PRIMARY KEY (course, session)
+);
+"""
+
+
+def connect(db_fp):
+    """
+    Open (and if necessary create) the store at db_fp.
+    :param db_fp: path to SQLite database file.
+    :return: sqlite3.Connection
+    """
+    con = sqlite3.connect(db_fp)
+    if con.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        with con:
+            con.execute("DROP TABLE IF EXISTS hash_mapping")
+            con.execute("DROP TABLE IF EXISTS sessions")
+    con.executescript(SCHEMA)
+    con.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+    return con
+
+
+def append_session(con, course, session, csv_fp):
+    """
+    Add the hash mapping for a single course session to the store, replacing any rows previously stored for it.
+    Rows which repeat a session_user_id are replaced by its last occurrence, and logged.
+    :param con: connection from connect().
+    :param csv_fp: path to hash_mapping_<course>_<session>.csv exported by docker/export_hash_mapping.py.
+    :return: number of rows stored.
+    """
+    df = pd.read_csv(csv_fp).dropna(subset=["session_user_id"])
+    duplicated = df.duplicated(subset=["session_user_id"], keep="last")
+    if duplicated.any():
+        print("[WARNING] course {} session {}: {} rows with duplicate session_user_id replaced by the last occurrence: {}".format(
+            course, session, duplicated.sum(), ", ".join(str(x) for x in df.loc[duplicated, "session_user_id"].unique())))
+        df = df[~duplicated]
+    columns = list(df.columns)
+    rows = [(course, session, None if pd.isnull(row["user_id"]) else int(row["user_id"]), str(row["session_user_id"]),
+             json.dumps([None if pd.isnull(x) else x for x in row.tolist()]))
+            for _, row in df.astype(object).iterrows()]
+    stat = os.stat(csv_fp)
+    with con:  # single transaction; a session is either fully present or absent
+        con.execute("DELETE FROM hash_mapping WHERE course = ? AND session = ?", (course, session))
+        con.executemany("INSERT INTO hash_mapping (course, session, user_id, session_user_id, row_json) VALUES (?, ?, ?, ?, ?)", rows)
+        con.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (course, session, os.path.basename(csv_fp), stat.st_size, stat.st_mtime, len(rows), json.dumps(columns)))
+    return len(rows)
+
+
+def sync_session_files(con, export_dir):
+    """
+    Append every hash mapping export in export_dir which is new or has changed since it was last added to the store.
+    :param con: connection from connect().
+    :param export_dir: directory of hash_mapping_<course>_<session>.csv files.
+    :return: list of (course, session) tuples which were appended.
+    """
+    stored = {(row[0], row[1]): (row[2], row[3]) for row in con.execute("SELECT course, session, source_size, source_mtime FROM sessions")}
+    appended = []
+    for f in sorted(os.listdir(export_dir)):
+        res = re.search(HASH_MAPPING_FILE_REGEX, f)
+        if not res:
+            continue
+        course, session = res.group(1), res.group(2)
+        fp = os.path.join(export_dir, f)
+        stat = os.stat(fp)
+        if stored.get((course, session)) == (stat.st_size, stat.st_mtime):
+            continue
+        print("[INFO] adding course {} session {} to hash mapping store".format(course, session))
+        append_session(con, course, session, fp)
+        appended.append((course, session))
+    return appended
+
+
+def replace_gender_table(con, gender_df, user_id_col="coursera_user_id"):
+    """
+    Store gender_df as the gender table, indexed on user_id_col.
+    :param con: connection from connect().
+    :param gender_df: pd.DataFrame of inferred gender by coursera user id.
+    :return: None
+    """
+    with con:
+        gender_df.to_sql("gender", con, if_exists="replace", index=False)
+        con.execute("CREATE INDEX IF NOT EXISTS gender_user_id ON gender ({})".format(user_id_col))
+    return
+
+
+def gender_lookup(con, user_id_col="coursera_user_id"):
+    """
+    Join the stored hash mappings with the gender table.
+    :param con: connection from connect().
+    :return: pd.DataFrame with one row per course, session and user with a known gender; the columns are those of the session exports, then course and session, then those of the gender table.
+    """
+    columns = {(course, session): json.loads(columns_json) for course, session, columns_json in con.execute("SELECT course, session, columns_json FROM sessions")}
+    gender_df = pd.read_sql_query("SELECT * FROM gender", con)
+    query = "SELECT h.course, h.session, h.row_json, g.rowid AS gender_row FROM hash_mapping AS h JOIN gender AS g ON h.user_id = g.{} ORDER BY h.course, h.session, h.rowid".format(user_id_col)
+    session_dfs = []
+    for (course, session), df in pd.read_sql_query(query, con).groupby(["course", "session"], sort=True):
+        session_df = pd.DataFrame([json.loads(x) for x in df["row_json"]], columns=columns[(course, session)])
+        session_df["course"] = course
+        session_df["session"] = session
+        # rowids of the gender table are 1, ..., n as it is always replaced in full by replace_gender_table()
+        session_df = pd.concat([session_df, gender_df.iloc[df["gender_row"].values - 1].reset_index(drop=True)], axis=1)
+        session_dfs.append(session_df)
+    if not session_dfs:
+        return pd.DataFrame(columns=["course", "session"] + list(gender_df.columns))
+    return pd.concat(session_dfs, ignore_index=True)
+
+
+def _lookup(con, key_col, values, courses=None):
+    """
+    Fetch rows of hash_mapping where key_col is in values (and course is in courses, if given) using the index on key_col.
+    """
+    with con:
+        con.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_keys (value PRIMARY KEY)")
+        con.execute("DELETE FROM lookup_keys")
+        con.executemany("INSERT OR IGNORE INTO lookup_keys VALUES (?)", [(v,) for v in values])
+    query = "SELECT h.course, h.session, h.user_id, h.session_user_id FROM lookup_keys AS k JOIN hash_mapping AS h ON h.{} = k.value".format(key_col)
+    params = []
+    if courses is not None:
+        courses = list(courses)
+        query += " WHERE h.course IN ({})".format(", ".join("?" * len(courses)))
+        params = courses
+    return pd.read_sql_query(query, con, params=params)
+
+
+def lookup_session_user_ids(con, session_user_ids, courses=None):
+    """
+    Fetch hash mappings for a list of session user ids.
+    :param con: connection from connect().
+    :param session_user_ids: iterable of session_user_id values.
+    :param courses: optional iterable of course names to restrict the lookup to.
+    :return: pd.DataFrame of course, session, user_id, session_user_id.
+    """
+    return _lookup(con, "session_user_id", [str(x) for x in session_user_ids], courses)
+
+
+def lookup_user_ids(con, user_ids, courses=None):
+    """
+    Fetch hash mappings for a list of coursera user ids.
+    :param con: connection from connect().
+    :param user_ids: iterable of user_id values.
+    :param courses: optional iterable of course names to restrict the lookup to.
+    :return: pd.DataFrame of course, session, user_id, session_user_id.
+    """
+    return _lookup(con, "user_id", [int(x) for x in user_ids], courses)